@@ -8,8 +8,12 @@ import fnmatch
 import hashlib
 import logging
 import os
+import queue
 import shutil
+import threading
 from abc import ABC, abstractmethod
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 BUF_SIZE = 1024 * 1024 * 4
@@ -17,6 +21,14 @@ BUF_SIZE = 1024 * 1024 * 4
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# Attributes of a file, as found in a listing: the size, the utc mtime, the
+# checksum, which is None when it is not known, and the replica status of an
+# iRODS data object (1 for a good replica), None for other filesystems
+FileStat = namedtuple('FileStat', ['size', 'mtime', 'checksum', 'replica_status'], defaults=[None])
+# An entry found by walking a tree: the full path, whether it is a directory
+# and the FileStat of a file. stat is None for directories
+WalkEntry = namedtuple('WalkEntry', ['path', 'isdir', 'stat'])
+
 
 class fsFactory():
     _fscreators = {}
@@ -42,6 +54,136 @@ class fsFactory():
 factory = fsFactory()
 
 
+class fsPool():
+    """Thread-safe pool of connections to the filesystem name, created by
+    the factory with the given parameters. With max_connections, at most
+    that many connections are handed out at a time, acquire waits for one
+    to be returned
+    """
+
+    def __init__(self, name, max_connections=0, **params):
+        self.name = name
+        self.params = params
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections) if max_connections else None
+
+    def acquire(self):
+        if self._slots:
+            self._slots.acquire()
+        try:
+            with self._lock:
+                if self._idle:
+                    return self._idle.pop()
+            return factory.createfs(self.name, **self.params)
+        except BaseException:
+            if self._slots:
+                self._slots.release()
+            raise
+
+    def release(self, fs):
+        # Cached file objects may be outdated by the time the connection
+        # is used again
+        fs.invalidate_cache()
+        with self._lock:
+            self._idle.append(fs)
+        if self._slots:
+            self._slots.release()
+
+    def discard(self, fs):
+        fs.cleanup()
+        if self._slots:
+            self._slots.release()
+
+    def cleanup(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for fs in idle:
+            fs.cleanup()
+
+
+def parallel_walk(pool, path, threads, ordered=False, prune=None):
+    """Walk the tree below path like fs_base.walk, listing up to threads
+    directories at the same time. Every thread uses its own connection from
+    the fsPool pool. The entries are yielded per directory, in the order in
+    which the listings complete, or in the order of fs_base.walk when
+    ordered is set. Directories for which prune returns True are not listed
+    """
+    local = threading.local()
+    connections = []
+    # The listings in order of completion, as (entries, number of subdirectories
+    # to list, exception) tuples. Only used when ordered is not set
+    listings = queue.Queue()
+    # Pending listings by directory, only kept when ordered is set
+    futures = {}
+    # The listings that have not completed, cancelled when the walk stops
+    pending = set()
+    pending_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def submit(dirpath):
+        with pending_lock:
+            if stopped.is_set():
+                return None
+            future = executor.submit(list_dir, dirpath)
+            pending.add(future)
+        future.add_done_callback(pending.discard)
+        return future
+
+    def list_dir(dirpath):
+        if not hasattr(local, 'fs'):
+            local.fs = pool.acquire()
+            connections.append(local.fs)
+        try:
+            entries = local.fs.scandir(dirpath)
+        except Exception as ex:
+            if not ordered:
+                listings.put((None, 0, ex))
+            raise
+        subdirs = [entry.path for entry in entries
+                   if entry.isdir and not (prune and prune(entry.path))]
+        # The listing is queued before the listings of the subdirectories,
+        # so the consumer knows how many listings are outstanding
+        if not ordered:
+            listings.put((entries, len(subdirs), None))
+        # Subdirectories are listed right away, not when the consumer gets to them
+        for subdir in subdirs:
+            future = submit(subdir)
+            if ordered and future is not None:
+                futures[subdir] = future
+        return entries, subdirs
+
+    def walk_ordered(dirpath):
+        entries, subdirs = futures.pop(dirpath).result()
+        yield from entries
+        for subdir in subdirs:
+            yield from walk_ordered(subdir)
+
+    executor = ThreadPoolExecutor(threads)
+    try:
+        futures[path] = submit(path)
+        if ordered:
+            yield from walk_ordered(path)
+            return
+        outstanding = 1
+        while outstanding:
+            entries, subdirs, ex = listings.get()
+            if ex is not None:
+                raise ex
+            outstanding += subdirs - 1
+            yield from entries
+    finally:
+        # Listings that did not start are cancelled, shutdown(cancel_futures=True)
+        # needs Python 3.9
+        with pending_lock:
+            stopped.set()
+            for future in list(pending):
+                future.cancel()
+        executor.shutdown(wait=True)
+        for fs in connections:
+            pool.release(fs)
+
+
 # class fsbuilder():
 #    def __init__(self):
 #        self._instance = None
@@ -51,6 +193,10 @@ factory = fsFactory()
 
 
 class fsobject_base(ABC):
+    # Whether the file can be opened several times at once and read from any
+    # offset, so that it can be copied in parts over several connections
+    parallel_reads = False
+
     def __init__(self, fso, path):
         self.fso = fso
         self.path = path
@@ -109,12 +255,22 @@ class fsobject_base(ABC):
         return False
 
     def copyto(self, dest_fs, dest_path):
-        source_fp = self.open('rb')
-        dest_fp = dest_fs.createfile(dest_path)
+        if self.parallel_reads and dest_fs.parallel_copy(self, dest_path):
+            dest_fs.invalidate_cache_entry(dest_path)
+            return
+        source_fp = hashing_stream(self.open('rb'))
+        dest_fp = dest_fs.createfile(dest_path, checksum=self._checksum)
         shutil.copyfileobj(source_fp, dest_fp, BUF_SIZE)
         source_fp.close()
         dest_fp.close()
         dest_fs.invalidate_cache_entry(dest_path)
+        self.copied_checksum(source_fp)
+
+    def copied_checksum(self, stream):
+        # The checksum of the copied data saves reading the source again to
+        # verify the copy. A checksum from a checksum file is kept
+        if self._checksum is None:
+            self._checksum = stream.hexdigest()
 
     @abstractmethod
     def filesize(self):
@@ -131,6 +287,59 @@ class fsobject_base(ABC):
         pass
 
 
+class fsobject_stat(fsobject_base):
+    """File object of which the attributes are known from a listing, so
+    it can be compared without querying the filesystem. The checksum is
+    taken from the file object itself, when it is not known
+    """
+
+    def __init__(self, fso, path, stat):
+        super().__init__(fso, path)
+        self.stat = stat
+        self._checksum = stat.checksum
+
+    def isdir(self):
+        return False
+
+    def isfile(self):
+        return True
+
+    def calculate_checksum(self):
+        return self.fso.getfile(self.path).checksum
+
+    def filesize(self):
+        return self.stat.size
+
+    def utc_mtime(self):
+        return self.stat.mtime
+
+
+class hashing_stream():
+    """Wraps a file object, computing the SHA-256 of the data that is read
+    from or written to it. Without file object, written data is only hashed
+    """
+
+    def __init__(self, fp=None):
+        self.fp = fp
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.sha256.update(data)
+        return data
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.fp.write(data) if self.fp else len(data)
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
 class fopen():
     def __init__(self, ff, mode):
         self.objf = ff
@@ -146,6 +355,10 @@ class fopen():
 
 
 class fs_base(ABC):
+    # Whether the filesystem can extract a tar archive of small files by
+    # itself, see extract_bundle
+    supports_bundles = False
+
     @abstractmethod
     def __init__(self, supportsopen=False):
         self.supportsopen = supportsopen
@@ -178,6 +391,40 @@ class fs_base(ABC):
         result = [a.shortname() for a in self.ls(path) if not a.isdir()]
         return result
 
+    def scandir(self, path):
+        # Returns a WalkEntry for every entry in path. Derived classes
+        # reimplement this when the directory listing provides the file
+        # attributes, this implementation gets every entry separately
+        result = []
+        for entry in self.ls(path):
+            if entry.shortname() in ['.', '..']:
+                continue
+            if entry.isdir():
+                result.append(WalkEntry(entry.path, True, None))
+            else:
+                result.append(WalkEntry(entry.path, False, FileStat(
+                    entry.filesize(), entry.utc_mtime(), None)))
+        return result
+
+    def walk(self, path, prune=None):
+        # Yields a WalkEntry for every directory and file in the tree below
+        # path. The entries of a directory are yielded before the entries of
+        # its subdirectories. Directories for which prune returns True are
+        # yielded, but not listed
+        subdirs = []
+        for entry in self.scandir(path):
+            yield entry
+            if entry.isdir and not (prune and prune(entry.path)):
+                subdirs.append(entry.path)
+        for subdir in subdirs:
+            yield from self.walk(subdir, prune=prune)
+
+    def lsindex(self, path):
+        # Returns a dict with a FileStat for every file in the tree below
+        # path, by path relative to path. Returns None when the filesystem
+        # cannot list a tree at once, the files are then queried one by one
+        return None
+
     def lsdirs(self, path, skip_inaccessible=False):
         if skip_inaccessible:
             result = [a for a in self.ls(
@@ -234,10 +481,35 @@ class fs_base(ABC):
     def mkdir(self, path, parents=False):
         pass
 
-    def createfile(self, path):
+    def createfile(self, path, checksum=None):
+        # checksum is the sha256 of the data that will be written, if known
         logger.error('%s :createfile not implemented in ' % self.__class__)
         exit(2)
 
+    def parallel_copy(self, source, path):
+        # Copies the file object source to path over several connections.
+        # Returns False when the filesystem does not copy source this way,
+        # it is then copied as a single stream
+        return False
+
+    def extract_bundle(self, fp, path):
+        # Extracts the tar archive read from the file object fp into the
+        # directory path, for filesystems that set supports_bundles
+        raise NotImplementedError
+
+    def register_files(self, files):
+        # Registers files, a list of (physical path, path, checksum) tuples,
+        # at path without copying the data, for filesystems that can refer
+        # to files stored elsewhere. Returns the error by path of the files
+        # that could not be registered
+        raise NotImplementedError
+
+    def compute_checksums(self, paths):
+        # Returns the checksums of the files in paths by path, for the files
+        # of which the filesystem computes the checksum itself. Filesystems
+        # where this takes reading the data return an empty dict
+        return {}
+
     def deletefile(self, path):
         logger.error('%s :deletefile not implemented in ' % self.__class__)
         exit(2)
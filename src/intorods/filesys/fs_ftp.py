@@ -6,13 +6,16 @@ Created on Thu May 25 11:00:00 2023
 @author: jansser
 """
 
+import calendar
+import ftplib
 import os
 import stat
+import time
 from datetime import datetime
 
 import ftputil
 
-from intorods.filesys.fs_base import factory, fs_base, fsobject_base
+from intorods.filesys.fs_base import FileStat, WalkEntry, factory, fs_base, fsobject_base
 
 
 class file_ftp(fsobject_base):
@@ -104,6 +107,25 @@ class fs_ftp(fs_base):
             result.append(fileobject)
         return result
 
+    def scandir(self, path):
+        # MLSD lists the type, size and utc modification time of all entries
+        # at once. Servers without MLSD are listed entry by entry
+        try:
+            listing = list(self.ftp._session.mlsd(path, facts=['type', 'size', 'modify']))
+        except ftplib.error_perm:
+            return super().scandir(path)
+        result = []
+        for name, facts in listing:
+            fullpath = path + '/' + name
+            if facts.get('type') == 'dir':
+                result.append(WalkEntry(fullpath, True, None))
+            elif facts.get('type') == 'file':
+                size = int(facts['size']) if 'size' in facts else None
+                mtime = calendar.timegm(time.strptime(facts['modify'][:14], '%Y%m%d%H%M%S')) \
+                    if 'modify' in facts else None
+                result.append(WalkEntry(fullpath, False, FileStat(size, mtime, None)))
+        return result
+
     def mkdir(self, path, parents=False):
         exit(1)
 
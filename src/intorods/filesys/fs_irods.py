@@ -12,61 +12,179 @@ import logging
 import math
 import os
 import re
+import shutil
 import ssl
 import sys
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 
 import irods.keywords as kw
+from irods.api_number import api_number
 from irods.column import Criterion
+from irods.exception import DataObjectDoesNotExist
+from irods.message import Message, StringStringMap, iRODSMessage
+from irods.message.property_types import IntegerProperty, StringProperty, SubmessageProperty
 from irods.models import Collection, CollectionMeta, DataObject
 from irods.session import iRODSSession
 
-from intorods.filesys.fs_base import factory, fs_base, fsobject_base
+from intorods.filesys.fs_base import BUF_SIZE, FileStat, WalkEntry, factory, fs_base, fsobject_base
 
 logger = logging.getLogger(__name__)
 
+# How the checksum of a data object written by intorods gets into the catalog.
+# By default nothing is done when writing, and a missing checksum is computed
+# by the server when it is needed for a comparison. With CHECKSUM_REGISTER the
+# checksum of the source is registered when it is known, e.g. from a checksum
+# file, otherwise the server computes it when the object is closed. With
+# CHECKSUM_VERIFY the server computes the checksum when the object is closed,
+# and fails the close when it differs from the known checksum of the source
+CHECKSUM_SERVER = 'server'
+CHECKSUM_REGISTER = 'register'
+CHECKSUM_VERIFY = 'verify'
+CHECKSUM_MODES = [CHECKSUM_SERVER, CHECKSUM_REGISTER, CHECKSUM_VERIFY]
+# Number of data objects that the server checksums at the same time
+CHECKSUM_THREADS = 4
+# Files of at least PARALLEL_THRESHOLD MB are written in PARALLEL_THREADS
+# parts at the same time, each over its own connection, like iput does.
+# A file that is written in parts is not hashed while it is copied
+PARALLEL_THRESHOLD = 32
+PARALLEL_THREADS = 4
+# Bytes copied at a time by a thread writing a part
+PARALLEL_BUF_SIZE = 4 * 1024 * 1024
+# A bundle of small files is uploaded as a tar archive named
+# BUNDLE_PREFIX<id>.tar, which the server extracts and then removes
+BUNDLE_PREFIX = '.intorods_bundle_'
+BUNDLE_DATA_TYPE = 'tar file'
+# A hex sha256 digest, the only checksum that is passed on to iRODS
+SHA256_HEX = re.compile(r'[0-9a-fA-F]{64}')
+
+
+class StructFileExtAndRegRequest(Message):
+    # The request to extract a structured file, like a tar archive, into a
+    # collection and register its files, as done by ibun -x
+    _name = 'StructFileExtAndRegInp_PI'
+    objPath = StringProperty()
+    collection = StringProperty()
+    oprType = IntegerProperty()
+    flags = IntegerProperty()
+    KeyValPair_PI = SubmessageProperty(StringStringMap)
+
 
 def utc2local(utc):
     return time.mktime(time.localtime(utc))
 
 
+def sha2_hex(cs):
+    # Convert an iRODS sha2 checksum to a hex digest. Returns None for
+    # other checksum types
+    if not cs or not cs.startswith('sha2:'):
+        return None
+    return base64.b64decode(cs[len('sha2:'):]).hex()
+
+
+def replica_status(row):
+    # The replica status of a GenQuery row as a number, None when unknown
+    status = row.get(DataObject.replica_status)
+    return int(status) if status not in (None, '') else None
+
+
+def hex_sha2(checksum):
+    # Convert a hex sha256 digest to an iRODS sha2 checksum. Returns None for
+    # other checksums, like an md5 digest from a checksum file
+    if not checksum or not SHA256_HEX.fullmatch(checksum):
+        return None
+    return 'sha2:' + base64.b64encode(bytes.fromhex(checksum)).decode()
+
+
 class file_irods(fsobject_base):
-    def __init__(self, fso, path):
+    """Data object in iRODS. The size, modification time and checksum are
+    taken from row, a GenQuery row with the WALK_COLUMNS of the object, or
+    queried on first use. The data object itself is only fetched from the
+    catalog when irods_object is used
+    """
+    parallel_reads = True
+
+    def __init__(self, fso, path, row=None):
         super().__init__(fso, path)
         self.refresh()
+        if row is not None:
+            self._set_row(row)
 
     def refresh(self):
-        self.irods_object = self.fso.irods_session.data_objects.get(self.path)
+        # Forget the attributes, they are queried again on next use
+        self._loaded = False
+        self._size = None
+        self._mtime = None
+        self._irods_checksum = None
+        self._replica_status = None
+        self._irods_object = None
+
+    def _set_row(self, row):
+        self._loaded = True
+        self._size = row[DataObject.size]
+        self._mtime = math.floor(cal.timegm(row[DataObject.modify_time].timetuple()))
+        self._irods_checksum = row[DataObject.checksum]
+        self._replica_status = replica_status(row)
+
+    def _load(self):
+        if not self._loaded:
+            row = self.fso._object_row(self.path)
+            if row is None:
+                raise DataObjectDoesNotExist(self.path)
+            self._set_row(row)
+
+    def replica_status(self):
+        # The status of the replica the attributes are taken from, 1 when
+        # the object has a good replica
+        self._load()
+        return self._replica_status
+
+    @property
+    def irods_object(self):
+        if self._irods_object is None:
+            self._irods_object = self.fso.irods_session.data_objects.get(self.path)
+        return self._irods_object
 
     def isdir(self):
         return False
 
     def calculate_checksum(self):
-        cs = self.irods_object.checksum
+        # A checksum that is not in the catalog is computed by the server,
+        # the data is only read back when the server does not use sha256
+        self._load()
+        cs = self._irods_checksum
         if cs is None:
+            cs = self.fso.server_checksum(self.path)
+        sha2 = sha2_hex(cs)
+        if sha2 is None:
+            logger.warning('No sha2 checksum for {}, reading it back'.format(self.path))
             return super().calculate_checksum()
-        else:
-            sha2 = cs.split(':')[1]
-            return base64.b64decode(sha2).hex()
+        return sha2
 
     def filesize(self):
-        return self.irods_object.size
+        self._load()
+        return self._size
 
     def isfile(self):
         return True
 
     def open(self, mode):
-        return self.irods_object.open(mode[:1])
+        return self.fso.irods_session.data_objects.open(self.path, mode[:1])
 
     def set_mtime(self, mtime):
-        new_time = utc2local(mtime)
-        self.irods_object.manager.modDataObjMeta(
-            {"objPath": self.path}, {"dataModify": round(new_time)})
-        self.refresh()
+        # The cached modification time is updated along with the catalog,
+        # the object is not queried again
+        new_time = round(utc2local(mtime))
+        self.fso.irods_session.data_objects.modDataObjMeta(
+            {"objPath": self.path}, {"dataModify": new_time})
+        self._mtime = new_time
 
     def utc_mtime(self):
-        mtime = cal.timegm(self.irods_object.modify_time.timetuple())
-        return math.floor(mtime)
+        if self._mtime is None:
+            self._load()
+        return self._mtime
 
 # TODO
     def local_mtime(self):
@@ -117,9 +235,21 @@ class folder_irods(fsobject_base):
 
 
 class fs_irods(fs_base):
-    def __init__(self, resource='', timeout=None, authfile=None):
+    supports_bundles = True
+
+    def __init__(self, resource='', timeout=None, authfile=None, checksum=CHECKSUM_SERVER,
+                 checksum_threads=CHECKSUM_THREADS, parallel_threshold=PARALLEL_THRESHOLD,
+                 parallel_threads=PARALLEL_THREADS):
         super().__init__(supportsopen=True)
 
+        if checksum not in CHECKSUM_MODES:
+            logger.error(f'Unknown checksum mode {checksum}, use one of {", ".join(CHECKSUM_MODES)}')
+            sys.exit(1)
+        self.checksum_mode = checksum
+        self.checksum_threads = int(checksum_threads)
+        self.parallel_threshold = int(parallel_threshold) * 1024 * 1024
+        self.parallel_threads = int(parallel_threads)
+
         if authfile:
             if not os.path.isfile(authfile):
                 logger.error(f'Authfile {authfile} not found')
@@ -153,8 +283,12 @@ class fs_irods(fs_base):
         coll = self.irods_session.collections.get(path)
         for subcoll in coll.subcollections:
             result.append(folder_irods(self, subcoll.path))
-        for entry in coll.data_objects:
-            result.append(self.getfile(entry.path))
+        # The data objects are created from one query on the collection
+        q = self.irods_session.query(*self.WALK_COLUMNS).filter(
+            Criterion('=', Collection.name, coll.path)).order_by(DataObject.name)
+        for objpath, r in self._object_rows(q.get_results()):
+            self.files[objpath] = file_irods(self, objpath, r)
+            result.append(self.files[objpath])
         return result
 
     def lsdirs(self, path, skip_inaccessible=False):
@@ -175,17 +309,96 @@ class fs_irods(fs_base):
         result = [r[DataObject.name] for r in q]
         return result        
 
+    # Columns of the queries for WalkEntry rows of data objects
+    WALK_COLUMNS = [Collection.name, DataObject.name, DataObject.size, DataObject.modify_time,
+                    DataObject.checksum, DataObject.replica_status]
+
+    @staticmethod
+    def _object_rows(rows):
+        # Yields the path and row of every data object in rows, which are
+        # ordered by collection and name. A data object with several replicas
+        # is yielded once, with the row of a good replica if there is one
+        for (collname, name), replicas in groupby(rows, key=lambda r: (r[Collection.name], r[DataObject.name])):
+            replicas = list(replicas)
+            yield os.path.join(collname, name), next(
+                (r for r in replicas if replica_status(r) == 1), replicas[0])
+
+    def _object_row(self, path):
+        # The WALK_COLUMNS row of the data object path, or None when it
+        # does not exist
+        base, name = self._pathsplit(path)
+        q = self.irods_session.query(*self.WALK_COLUMNS).filter(
+            Criterion('=', Collection.name, base)).filter(
+                Criterion('=', DataObject.name, name))
+        return next((r for _, r in self._object_rows(q.get_results())), None)
+
+    def _object_entries(self, rows):
+        # Yields a WalkEntry for every data object in rows, see _object_rows
+        for objpath, r in self._object_rows(rows):
+            yield WalkEntry(objpath, False, FileStat(
+                r[DataObject.size],
+                math.floor(cal.timegm(r[DataObject.modify_time].timetuple())),
+                sha2_hex(r[DataObject.checksum]), replica_status(r)))
+
+    def scandir(self, path):
+        path = os.path.abspath(path)
+        q = self.irods_session.query(Collection.name).filter(
+            Criterion('=', Collection.parent_name, path))
+        result = [WalkEntry(r[Collection.name], True, None) for r in q.get_results()]
+        q = self.irods_session.query(*self.WALK_COLUMNS).filter(
+            Criterion('=', Collection.name, path)).order_by(DataObject.name)
+        result.extend(self._object_entries(q.get_results()))
+        return result
+
+    def _subtree_rows(self, path, columns, order_by, include_top=True):
+        # Rows of a query on columns for the collections below path and,
+        # when include_top is set, for path itself. The rows are ordered by
+        # the order_by columns, and fetched in pages while iterating
+        criteria = [Criterion('like', Collection.name, path + '/%')]
+        if include_top:
+            criteria.insert(0, Criterion('=', Collection.name, path))
+        for criterion in criteria:
+            q = self.irods_session.query(*columns).filter(criterion)
+            for column in order_by:
+                q = q.order_by(column)
+            for r in q.get_results():
+                collname = r[Collection.name]
+                # _ is a wildcard in like, so check the collection is really below path
+                if collname == path or collname.startswith(path + '/'):
+                    yield r
+
+    def walk(self, path, prune=None):
+        # Yields a WalkEntry for every collection and data object in the tree
+        # below path, the collections first. The whole tree is listed with
+        # a few queries, and nothing is collected, so memory use does not
+        # depend on the size of the tree. The queries cannot leave out
+        # pruned collections, so with prune the tree is walked per collection
+        if prune:
+            yield from super().walk(path, prune=prune)
+            return
+        path = os.path.abspath(path)
+        for r in self._subtree_rows(path, [Collection.name], [Collection.name], include_top=False):
+            yield WalkEntry(r[Collection.name], True, None)
+        yield from self._object_entries(
+            self._subtree_rows(path, self.WALK_COLUMNS, [Collection.name, DataObject.name]))
+
+    def lsindex(self, path):
+        path = os.path.abspath(path)
+        return {os.path.relpath(e.path, path): e.stat for e in self.walk(path) if not e.isdir}
+
     @staticmethod
     def factory(**kwargs):
         return fs_irods(**kwargs)
 
     def fileexists(self, path):
-        base, file = self._pathsplit(path)
-        query = self.irods_session.query(
-            Collection.name, DataObject.name).filter(
-                Criterion('=', Collection.name, base)).filter(
-                    Criterion('=', DataObject.name, file))
-        return bool(list(query.get_results()))
+        # The attributes of an existing object are cached, so comparing it
+        # afterwards takes no further query
+        row = self._object_row(path)
+        if row is None:
+            self.invalidate_cache_entry(path)
+            return False
+        self.files[path] = file_irods(self, path, row)
+        return True
 
     def findfolder(self, name, meta=[]):
         result = []
@@ -223,10 +436,136 @@ class fs_irods(fs_base):
 # Opening an object with create=True should be used for irods4.3.0
 # instead of create and open in two statements.
 # Check: https://github.com/irods/irods/issues/6808
-    def createfile(self, path):
+    def _write_options(self, checksum=None):
         options = {kw.DEST_RESC_NAME_KW: self.resource}
+        if self.checksum_mode == CHECKSUM_REGISTER:
+            options[kw.REG_CHKSUM_KW] = ''
+        elif self.checksum_mode == CHECKSUM_VERIFY:
+            options[kw.VERIFY_CHKSUM_KW] = ''
+        # Without a sha256 checksum the server computes it
+        sha2 = hex_sha2(checksum)
+        if sha2 and self.checksum_mode != CHECKSUM_SERVER:
+            options[kw.CHKSUM_KW] = sha2
+        return options
+
+    def createfile(self, path, checksum=None):
+        options = self._write_options(checksum)
         return self.irods_session.data_objects.open(path, 'w', create=True, **options)
 
+    def parallel_copy(self, source, path):
+        # The object is created on one connection, the other connections
+        # open the same replica with its replica token. Every thread writes
+        # a part of the file, read from its own handle on source. The object
+        # is finalized by closing the first connection, after the others.
+        # When a part fails, the partial object is removed
+        size = source.filesize()
+        if self.parallel_threads < 2 or size < self.parallel_threshold:
+            return False
+        threads = self.parallel_threads
+        options = self._write_options(source._checksum)
+        options.update({kw.NUM_THREADS_KW: str(threads), kw.DATA_SIZE_KW: str(size)})
+        returned_values = {}
+        first, raw = self.irods_session.data_objects.open_with_FileRaw(
+            path, 'w', create=True, returned_values=returned_values, **options)
+        session = returned_values.get('session', self.irods_session)
+        handles = [first]
+        written = False
+        try:
+            replica_token, resc_hier = raw.replica_access_info()
+            for _ in range(threads - 1):
+                handles.append(session.data_objects.open(
+                    path, 'a', create=False, finalize_on_close=False, allow_redirect=False,
+                    **{kw.NUM_THREADS_KW: str(threads), kw.DATA_SIZE_KW: str(size),
+                       kw.RESC_HIER_STR_KW: resc_hier, kw.REPLICA_TOKEN_KW: replica_token}))
+            part_size = size // threads
+            parts = [(handle, i * part_size, part_size if i < threads - 1 else size - i * part_size)
+                     for i, handle in enumerate(handles)]
+            with ThreadPoolExecutor(threads) as executor:
+                for _ in executor.map(lambda part: self._write_part(source, *part), parts):
+                    pass
+            written = True
+        finally:
+            for handle in reversed(handles):
+                handle.close()
+            if not written:
+                try:
+                    self.deletefile(path)
+                except Exception as ex:
+                    logger.warning(f'Cannot remove the partial object {path}: {ex}')
+        return True
+
+    @staticmethod
+    def _write_part(source, dest_fp, offset, length):
+        with source.open('rb') as source_fp:
+            source_fp.seek(offset)
+            dest_fp.seek(offset)
+            while length > 0:
+                data = source_fp.read(min(PARALLEL_BUF_SIZE, length))
+                if not data:
+                    raise IOError(f'{source.path} is shorter than expected')
+                dest_fp.write(data)
+                length -= len(data)
+
+    def extract_bundle(self, fp, path):
+        # The archive is uploaded as a single data object in the collection
+        # path, extracted there by the server and removed afterwards.
+        # Existing data objects are overwritten
+        bundle_path = os.path.join(path, '{}{}.tar'.format(BUNDLE_PREFIX, uuid.uuid4().hex))
+        options = {kw.DEST_RESC_NAME_KW: self.resource, kw.DATA_TYPE_KW: BUNDLE_DATA_TYPE}
+        with self.irods_session.data_objects.open(bundle_path, 'w', create=True, **options) as bundle_fp:
+            shutil.copyfileobj(fp, bundle_fp, BUF_SIZE)
+        try:
+            extract_options = {kw.FORCE_FLAG_KW: '', kw.DATA_TYPE_KW: BUNDLE_DATA_TYPE}
+            if self.resource:
+                extract_options[kw.DEST_RESC_NAME_KW] = self.resource
+            request = StructFileExtAndRegRequest(objPath=bundle_path, collection=path, oprType=0, flags=0,
+                                                 KeyValPair_PI=StringStringMap(extract_options))
+            message = iRODSMessage('RODS_API_REQ', msg=request,
+                                   int_info=api_number['STRUCT_FILE_EXT_AND_REG_AN'])
+            with self.irods_session.pool.get_connection() as conn:
+                conn.send(message)
+                conn.recv()
+        finally:
+            self.irods_session.data_objects.unlink(bundle_path, force=True)
+
+    def register_files(self, files):
+        # The physical path is a path on the resource server. A sha256
+        # checksum from a checksum file is registered as is, without one the
+        # server computes the checksum with checksum=register or verify. The
+        # server has a bulk registration API (BULK_DATA_OBJ_REG_AN), but
+        # python-irodsclient does not expose it, so the files are registered
+        # one by one
+        errors = {}
+        for physical_path, path, checksum in files:
+            options = {}
+            if self.resource:
+                options[kw.DEST_RESC_NAME_KW] = self.resource
+            sha2 = hex_sha2(checksum)
+            if sha2:
+                options[kw.REG_CHKSUM_KW] = sha2
+            elif self.checksum_mode != CHECKSUM_SERVER:
+                options[kw.VERIFY_CHKSUM_KW] = ''
+            try:
+                self.irods_session.data_objects.register(physical_path, path, **options)
+            except Exception as ex:
+                errors[path] = ex
+        return errors
+
+    def server_checksum(self, path):
+        # Has the server compute and register the checksum of path. Returns
+        # the iRODS checksum, or None when it could not be computed
+        try:
+            return self.irods_session.data_objects.chksum(path) or None
+        except Exception as ex:
+            logger.warning(f'Server cannot checksum {path}: {ex}')
+            return None
+
+    def compute_checksums(self, paths):
+        # The server computes the checksums, checksum_threads at a time
+        with ThreadPoolExecutor(self.checksum_threads) as executor:
+            checksums = executor.map(self.server_checksum, paths)
+            return {path: sha2_hex(cs) for path, cs in zip(paths, checksums) if sha2_hex(cs)}
+
     def deletefile(self, path):
         self.irods_session.data_objects.unlink(path, True)
         self.invalidate_cache_entry(path)
@@ -239,4 +578,6 @@ class fs_irods(fs_base):
 
 
 factory.register('irods', fs_irods.factory,
-                 'resource=<dest resource>,timeout=<timeout>,authfile=<authfile>')
+                 'resource=<dest resource>,timeout=<timeout>,authfile=<authfile>,'
+                 'checksum=<server|register|verify>,checksum_threads=<threads>,'
+                 'parallel_threshold=<MB>,parallel_threads=<threads>')
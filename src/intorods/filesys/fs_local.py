@@ -7,13 +7,18 @@ Created on Wed May  8 10:25:59 2019
 """
 
 import glob
+import logging
 import math
 import os
 
-from intorods.filesys.fs_base import factory, fs_base, fsobject_base
+from intorods.filesys.fs_base import FileStat, WalkEntry, factory, fs_base, fsobject_base
+
+logger = logging.getLogger(__name__)
 
 
 class file_local(fsobject_base):
+    parallel_reads = True
+
     def __init__(self, fso, path):
         super().__init__(fso, path)
         self.fp = None
@@ -56,7 +61,7 @@ class fs_local(fs_base):
     def __init__(self):
         super().__init__(supportsopen=True)
 
-    def createfile(self, path):
+    def createfile(self, path, checksum=None):
         return open(path, 'wb')
 
     @staticmethod
@@ -100,6 +105,28 @@ class fs_local(fs_base):
         result = [f.name for f in os.scandir(path) if not f.is_dir()]
         return result
 
+    def scandir(self, path):
+        # A file that cannot be stat'ed, like a broken symbolic link or a file
+        # removed after the listing, gets no stat, so only its own job fails
+        result = []
+        with os.scandir(path) as it:
+            for f in it:
+                if f.is_dir():
+                    result.append(WalkEntry(f.path, True, None))
+                    continue
+                try:
+                    st = f.stat()
+                except OSError as ex:
+                    logger.warning('Cannot stat {}: {}'.format(f.path, ex))
+                    result.append(WalkEntry(f.path, False, None))
+                    continue
+                result.append(WalkEntry(f.path, False, FileStat(
+                    st.st_size, math.floor(st.st_mtime), None)))
+        return result
+
+    def lsindex(self, path):
+        return {os.path.relpath(e.path, path): e.stat for e in self.walk(path) if not e.isdir}
+
     def mkdir(self, path, parents=False):
         if parents:
             os.makedirs(path)
@@ -18,7 +18,7 @@ with warnings.catch_warnings():
     warnings.filterwarnings('ignore', category=CryptographyDeprecationWarning)
     import paramiko
 
-from intorods.filesys.fs_base import factory, fs_base, fsobject_base, fopen
+from intorods.filesys.fs_base import FileStat, WalkEntry, factory, fs_base, fsobject_base, fopen
 
 
 def esc(mystr):
@@ -124,6 +124,17 @@ class fs_scp(fs_base):
             result.append(fileobject)
         return result
 
+    def scandir(self, path):
+        result = []
+        for attr in self.sftp.listdir_attr(path):
+            fullpath = path + '/' + attr.filename
+            if stat.S_ISDIR(attr.st_mode):
+                result.append(WalkEntry(fullpath, True, None))
+            else:
+                result.append(WalkEntry(fullpath, False, FileStat(
+                    attr.st_size, attr.st_mtime, None)))
+        return result
+
     def mkdir(self, path, parents=False):
         exit(1)
 
@@ -19,7 +19,7 @@ with warnings.catch_warnings():
     warnings.filterwarnings('ignore', category=CryptographyDeprecationWarning)
     import paramiko
 
-from intorods.filesys.fs_base import factory, fopen, fs_base, fsobject_base
+from intorods.filesys.fs_base import FileStat, WalkEntry, factory, fopen, fs_base, fsobject_base
 
 
 def esc(mystr):
@@ -27,6 +27,8 @@ def esc(mystr):
 
 
 class file_sftp(fsobject_base):
+    parallel_reads = True
+
     def __init__(self, fso, path):
         super().__init__(fso, path)
         self._lstat = self.fso.sftp.lstat(self.path)
@@ -130,6 +132,17 @@ class fs_sftp(fs_base):
     def lsfilenames(self, path):
         return self.sftp.listdir(path)
 
+    def scandir(self, path):
+        result = []
+        for attr in self.sftp.listdir_attr(path):
+            fullpath = path + '/' + attr.filename
+            if stat.S_ISDIR(attr.st_mode):
+                result.append(WalkEntry(fullpath, True, None))
+            else:
+                result.append(WalkEntry(fullpath, False, FileStat(
+                    attr.st_size, attr.st_mtime, None)))
+        return result
+
     def mkdir(self, path, parents=False):
         exit(1)
 
@@ -12,7 +12,7 @@ import os
 from smb.SMBConnection import SMBConnection
 from smb import smb_constants
 
-from intorods.filesys.fs_base import factory, fs_base, fsobject_base
+from intorods.filesys.fs_base import FileStat, WalkEntry, factory, fs_base, fsobject_base, hashing_stream
 
 logger = logging.getLogger(__name__)
 
@@ -36,9 +36,19 @@ class file_smb(fsobject_base):
             self.fso.share, uxtowin(self.path))
 
     def copyto(self, dest_fs, dest_path):
-        with dest_fs.createfile(dest_path) as destfile:
+        with dest_fs.createfile(dest_path, checksum=self._checksum) as destfile:
+            stream = hashing_stream(destfile)
             self.fso.smb_conn.retrieveFile(
-                self.fso.share, uxtowin(self.path), destfile)
+                self.fso.share, uxtowin(self.path), stream)
+        self.copied_checksum(stream)
+
+    def calculate_checksum(self):
+        # Hash the file while it is retrieved, instead of downloading it
+        # to a temporary file first
+        stream = hashing_stream()
+        self.fso.smb_conn.retrieveFile(
+            self.fso.share, uxtowin(self.path), stream)
+        return stream.hexdigest()
 
     def close(self):
         self.file_obj.close()
@@ -155,6 +165,19 @@ class fs_smb(fs_base):
             result.append(entry.filename)
         return result
 
+    def scandir(self, path):
+        result = []
+        for entry in self.smb_conn.listPath(self.share, uxtowin(path)):
+            if entry.filename in ['.', '..']:
+                continue
+            fullpath = path + '/' + entry.filename
+            if entry.isDirectory:
+                result.append(WalkEntry(fullpath, True, None))
+            else:
+                result.append(WalkEntry(fullpath, False, FileStat(
+                    entry.file_size, int(entry.last_write_time//1), None)))
+        return result
+
     def mkdir(self, path, parents=False):
         if parents:
             parentdir, dir = os.path.split(path)
@@ -0,0 +1,368 @@
+"""
+Compact storage of copy jobs and checksum lists
+
+A sync of millions of files keeps a copy job for every file. Storing these as
+dicts of full path strings and tuples costs a few hundred bytes per file. The
+tables here store the directories of the paths once, the file names,
+checksums, sizes and modification times in flat arrays, and move the rows to an SQLite file when
+they take more memory than allowed.
+"""
+
+import logging
+import os
+import sqlite3
+import tempfile
+from array import array
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Default memory budget of a table, in bytes
+JOB_MEMORY = 512 * 1024 * 1024
+
+# Estimated memory used by a row in memory, besides the file name: the array
+# slots, the entry in the directory index and the name string object
+ROW_BYTES = 180
+
+# Estimated memory used per row to hand out the rows of an in memory table
+# ordered by size: the list slot and the integer of the row number
+ORDER_BYTES = 40
+
+# Checksums are stored in slots of CHECKSUM_BYTES bytes, if they are the
+# lowercase hex representation of that many bytes (sha256). Other checksums
+# are stored as strings
+CHECKSUM_BYTES = 32
+
+# Kind of checksum of a row
+CS_NONE = 0
+CS_PACKED = 1
+CS_TEXT = 2
+
+# Number of rows inserted in the spill database in one statement
+SPILL_BATCH = 10000
+
+# A copy job as stored: the source and destination path, whether checksums
+# should be compared, the checksum, the size and the modification time of the
+# source, as the first fields of CopyJob
+JobRow = namedtuple('JobRow', ['source', 'dest', 'compare_checksums', 'checksum', 'size', 'mtime'])
+
+
+def pack_checksum(checksum):
+    """Returns the kind and the stored value of checksum"""
+    if checksum is None:
+        return CS_NONE, None
+    if len(checksum) == 2 * CHECKSUM_BYTES:
+        try:
+            packed = bytes.fromhex(checksum)
+            if packed.hex() == checksum:
+                return CS_PACKED, packed
+        except ValueError:
+            pass
+    return CS_TEXT, checksum
+
+
+def unpack_checksum(kind, value):
+    if kind == CS_PACKED:
+        return value.hex()
+    return value
+
+
+class JobTable():
+    """
+    Copy jobs by source path, in the order in which they were added. A job
+    set for a source path that is already in the table replaces it, like in
+    a dict. The table is filled with JobRow or CopyJob tuples, and returns
+    job_type tuples, created from the JobRow fields. When the estimated
+    memory use exceeds memory_budget bytes, the rows are moved to an SQLite
+    file in spill_dir, or the default temporary directory
+    """
+
+    def __init__(self, memory_budget=JOB_MEMORY, spill_dir=None, job_type=JobRow):
+        self.memory_budget = memory_budget
+        self.job_type = job_type
+        self.spill_dir = spill_dir
+        self.memory = 0
+        # Directories of the paths, by id and id by directory
+        self._dirs = []
+        self._dir_ids = {}
+        # Row of a source by directory id and file name
+        self._rows = {}
+        self._source_dir = array('l')
+        self._source_name = []
+        self._dest_dir = array('l')
+        self._dest_name = []
+        self._compare = bytearray()
+        self._cs_kind = bytearray()
+        self._cs_packed = bytearray()
+        self._cs_text = {}
+        self._size = array('q')
+        self._mtime = array('q')
+        # The spill database, once the rows are moved to disk
+        self.db = None
+        self.db_path = None
+
+    def _dir_id(self, path):
+        dir_id = self._dir_ids.get(path)
+        if dir_id is None:
+            dir_id = len(self._dirs)
+            self._dirs.append(path)
+            self._dir_ids[path] = dir_id
+            self.memory += ROW_BYTES + len(path)
+        return dir_id
+
+    def _split(self, path):
+        dirname, name = os.path.split(path)
+        return self._dir_id(dirname), name
+
+    def _find(self, path):
+        # Directory id and name of path, without adding the directory
+        dirname, name = os.path.split(path)
+        return self._dir_ids.get(dirname), name
+
+    def _path(self, dir_id, name):
+        if dir_id < 0:
+            return None
+        return os.path.join(self._dirs[dir_id], name)
+
+    def __len__(self):
+        if self.db:
+            return self.db.execute('SELECT count(*) FROM jobs').fetchone()[0]
+        return len(self._source_name)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __contains__(self, source):
+        source_dir, name = self._find(source)
+        if source_dir is None:
+            return False
+        if self.db:
+            return self.db.execute('SELECT 1 FROM jobs WHERE source_dir = ? AND source_name = ?',
+                                   (source_dir, name)).fetchone() is not None
+        return name in self._rows.get(source_dir, ())
+
+    def __setitem__(self, source, job):
+        source_dir, name = self._split(source)
+        if job.dest is None:
+            dest_dir, dest_name = -1, None
+        else:
+            dest_dir, dest_name = self._split(job.dest)
+            # Share the name string with the source, they are mostly equal
+            if dest_name == name:
+                dest_name = name
+        kind, checksum = pack_checksum(job.checksum)
+        size = -1 if job.size is None else job.size
+        mtime = -1 if job.mtime is None else int(job.mtime)
+        if self.db:
+            self._spill_rows([(source_dir, name, dest_dir, dest_name, int(bool(job.compare_checksums)),
+                               kind, checksum, size, mtime)])
+            return
+        rows = self._rows.setdefault(source_dir, {})
+        row = rows.get(name)
+        if row is None:
+            row = len(self._source_name)
+            rows[name] = row
+            self._source_dir.append(source_dir)
+            self._source_name.append(name)
+            self._dest_dir.append(dest_dir)
+            self._dest_name.append(dest_name)
+            self._compare.append(0)
+            self._cs_kind.append(CS_NONE)
+            self._cs_packed.extend(bytes(CHECKSUM_BYTES))
+            self._size.append(-1)
+            self._mtime.append(-1)
+            self.memory += ROW_BYTES + len(name)
+        else:
+            self._dest_dir[row] = dest_dir
+            self._dest_name[row] = dest_name
+            self._cs_text.pop(row, None)
+        self._compare[row] = 1 if job.compare_checksums else 0
+        self._cs_kind[row] = kind
+        if kind == CS_PACKED:
+            self._cs_packed[row * CHECKSUM_BYTES:(row + 1) * CHECKSUM_BYTES] = checksum
+        elif kind == CS_TEXT:
+            self._cs_text[row] = checksum
+            self.memory += len(checksum)
+        self._size[row] = size
+        self._mtime[row] = mtime
+        if self.memory > self.memory_budget:
+            self.spill()
+
+    def add(self, job):
+        self[job.source] = job
+
+    def _job(self, row):
+        cs_kind = self._cs_kind[row]
+        if cs_kind == CS_PACKED:
+            checksum = bytes(self._cs_packed[row * CHECKSUM_BYTES:(row + 1) * CHECKSUM_BYTES]).hex()
+        else:
+            checksum = self._cs_text.get(row)
+        size = self._size[row]
+        mtime = self._mtime[row]
+        return self.job_type(self._path(self._source_dir[row], self._source_name[row]),
+                             self._path(self._dest_dir[row], self._dest_name[row]),
+                             bool(self._compare[row]), checksum, None if size < 0 else size,
+                             None if mtime < 0 else mtime)
+
+    def _db_job(self, source_dir, name, dest_dir, dest_name, compare, cs_kind, checksum, size, mtime):
+        return self.job_type(self._path(source_dir, name), self._path(dest_dir, dest_name),
+                             bool(compare), unpack_checksum(cs_kind, checksum), None if size < 0 else size,
+                             None if mtime < 0 else mtime)
+
+    def __getitem__(self, source):
+        source_dir, name = self._find(source)
+        if source_dir is None:
+            raise KeyError(source)
+        if self.db:
+            row = self.db.execute('SELECT source_dir, source_name, dest_dir, dest_name, compare, '
+                                  'cs_kind, checksum, size, mtime FROM jobs WHERE source_dir = ? AND source_name = ?',
+                                  (source_dir, name)).fetchone()
+            if row is None:
+                raise KeyError(source)
+            return self._db_job(*row)
+        row = self._rows.get(source_dir, {}).get(name)
+        if row is None:
+            raise KeyError(source)
+        return self._job(row)
+
+    def get(self, source, default=None):
+        try:
+            return self[source]
+        except KeyError:
+            return default
+
+    def values(self, largest_first=False):
+        """
+        Yields the jobs in the order in which they were added. With largest_first,
+        the jobs of unknown size come first, then the others by decreasing size.
+        Ordering an in memory table takes ORDER_BYTES per row, a table for which
+        that exceeds the memory budget is moved to disk and ordered there
+        """
+        order = 'id'
+        if largest_first:
+            order = 'size >= 0, size DESC, id'
+            if not self.db and self.memory + ORDER_BYTES * len(self) > self.memory_budget:
+                self.spill()
+        if self.db:
+            for row in self.db.execute('SELECT source_dir, source_name, dest_dir, dest_name, compare, '
+                                       'cs_kind, checksum, size, mtime FROM jobs ORDER BY ' + order):
+                yield self._db_job(*row)
+        elif largest_first:
+            for row in sorted(range(len(self._source_name)),
+                              key=lambda row: (self._size[row] >= 0, -self._size[row])):
+                yield self._job(row)
+        else:
+            for row in range(len(self._source_name)):
+                yield self._job(row)
+
+    def __iter__(self):
+        for job in self.values():
+            yield job.source
+
+    def items(self):
+        for job in self.values():
+            yield job.source, job
+
+    def _spill_rows(self, rows):
+        self.db.executemany('INSERT INTO jobs (source_dir, source_name, dest_dir, dest_name, compare, '
+                            'cs_kind, checksum, size, mtime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                            'ON CONFLICT (source_dir, source_name) DO UPDATE SET dest_dir = excluded.dest_dir, '
+                            'dest_name = excluded.dest_name, compare = excluded.compare, '
+                            'cs_kind = excluded.cs_kind, checksum = excluded.checksum, size = excluded.size, '
+                            'mtime = excluded.mtime',
+                            rows)
+
+    def spill(self):
+        """Move the rows to an SQLite file"""
+        if self.db:
+            return
+        fd, self.db_path = tempfile.mkstemp(prefix='intorods_jobs_', suffix='.db', dir=self.spill_dir)
+        os.close(fd)
+        logger.info('Job table exceeds {} MB, moving {} jobs to {}'.format(
+            self.memory_budget // (1024 * 1024), len(self._source_name), self.db_path))
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('CREATE TABLE jobs (id INTEGER PRIMARY KEY, source_dir INTEGER, source_name TEXT, '
+                        'dest_dir INTEGER, dest_name TEXT, compare INTEGER, cs_kind INTEGER, checksum, '
+                        'size INTEGER, mtime INTEGER, UNIQUE (source_dir, source_name))')
+        rows = []
+        for row in range(len(self._source_name)):
+            cs_kind = self._cs_kind[row]
+            if cs_kind == CS_PACKED:
+                checksum = bytes(self._cs_packed[row * CHECKSUM_BYTES:(row + 1) * CHECKSUM_BYTES])
+            else:
+                checksum = self._cs_text.get(row)
+            rows.append((self._source_dir[row], self._source_name[row], self._dest_dir[row],
+                         self._dest_name[row], self._compare[row], cs_kind, checksum, self._size[row],
+                         self._mtime[row]))
+            if len(rows) >= SPILL_BATCH:
+                self._spill_rows(rows)
+                rows = []
+        self._spill_rows(rows)
+        self._rows = {}
+        self._source_dir = array('l')
+        self._source_name = []
+        self._dest_dir = array('l')
+        self._dest_name = []
+        self._compare = bytearray()
+        self._cs_kind = bytearray()
+        self._cs_packed = bytearray()
+        self._cs_text = {}
+        self._size = array('q')
+        self._mtime = array('q')
+
+    def close(self):
+        """Remove the spill file, if any"""
+        if self.db:
+            self.db.close()
+            self.db = None
+            os.remove(self.db_path)
+            self.db_path = None
+
+    def __del__(self):
+        # A table that is dropped without close still removes its spill file
+        if self.db:
+            self.close()
+
+
+class ChecksumList():
+    """
+    Checksums by path, a dict-like view on a JobTable. The checksum of a path
+    is None when it is unknown
+    """
+
+    def __init__(self, memory_budget=JOB_MEMORY, spill_dir=None):
+        self.table = JobTable(memory_budget=memory_budget, spill_dir=spill_dir)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __bool__(self):
+        return bool(self.table)
+
+    def __contains__(self, path):
+        return path in self.table
+
+    def __setitem__(self, path, checksum):
+        self.table[path] = JobRow(path, None, False, checksum, None, None)
+
+    def __getitem__(self, path):
+        return self.table[path].checksum
+
+    def get(self, path, default=None):
+        job = self.table.get(path)
+        return default if job is None else job.checksum
+
+    def __iter__(self):
+        return iter(self.table)
+
+    def keys(self):
+        return iter(self.table)
+
+    def items(self):
+        for job in self.table.values():
+            yield job.source, job.checksum
+
+    def close(self):
+        self.table.close()
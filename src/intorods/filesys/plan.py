@@ -0,0 +1,231 @@
+"""
+Dry run of a sync
+
+The plan of a sync lists what a sync would do, without creating directories
+or copying data: which files are new, changed or identical at the destination,
+which are excluded, and how long the transfer would take. A plan only compares
+sizes and modification times, and checksums that are known already. It never
+computes a checksum, which would read the data or have the destination
+compute and store it.
+"""
+
+import json
+import logging
+import os
+import time
+
+from intorods.filesys.fs_base import FileStat, fsobject_stat
+from intorods.filesys.jobtable import JOB_MEMORY, JobTable
+from intorods.filesys.statedb import verification
+from intorods.filesys.sync import CopyJob, compile_filter, queue_copyjobs, queue_copyjobs_from_filelist
+
+logger = logging.getLogger(__name__)
+
+# Files that do not exist at the destination, that differ from the source,
+# that are equal to the source, that only a checksum would tell apart, that
+# the state database has verified before, that are not synced because of the
+# exclude patterns or filters, and that are in the checksum file but not in
+# the source
+PLAN_NEW = 'new'
+PLAN_CHANGED = 'changed'
+PLAN_IDENTICAL = 'identical'
+PLAN_UNKNOWN = 'needs_checksum'
+PLAN_VERIFIED = 'verified'
+PLAN_EXCLUDED = 'excluded'
+PLAN_MISSING = 'missing'
+PLAN_CATEGORIES = [PLAN_NEW, PLAN_CHANGED, PLAN_IDENTICAL, PLAN_UNKNOWN, PLAN_VERIFIED, PLAN_EXCLUDED,
+                   PLAN_MISSING]
+
+# Bytes read from the source to measure the throughput
+PLAN_SAMPLE_BYTES = 64 * 1024 * 1024
+
+# Estimated time in seconds spent per transferred file besides the data
+# transfer: querying the destination, creating the object, setting the mtime
+PLAN_FILE_OVERHEAD = 0.05
+
+
+def empty_totals():
+    return {category: {'files': 0, 'bytes': 0} for category in PLAN_CATEGORIES}
+
+
+def add_totals(totals, other):
+    for category in PLAN_CATEGORIES:
+        totals[category]['files'] += other[category]['files']
+        totals[category]['bytes'] += other[category]['bytes']
+
+
+def plan_category(size, mtime, checksum, dest_size, dest_mtime, dest_checksum, compare=True,
+                  compareChecksums=False):
+    """Returns the PLAN_* category of a source file with size, mtime and
+    checksum, of which the destination exists with dest_size, dest_mtime and
+    dest_checksum. The checksums are None when they are not known. Files of
+    a different size differ, otherwise comparing checksums takes both
+    checksums, and the file is PLAN_UNKNOWN without them
+    """
+    if not compare:
+        return PLAN_IDENTICAL
+    if size != dest_size:
+        return PLAN_CHANGED
+    if compareChecksums:
+        if checksum is None or dest_checksum is None:
+            return PLAN_UNKNOWN
+        return PLAN_IDENTICAL if checksum == dest_checksum else PLAN_CHANGED
+    return PLAN_IDENTICAL if mtime == dest_mtime else PLAN_CHANGED
+
+
+def plan_sync(sourcefs, sourcepath, destfs, destpath, compareChecksums=False, filelist={},
+              scan=False, excludelist=[], compare=True, cs_filters=[], scan_filters=[],
+              dest_index=True, job_memory=JOB_MEMORY, state=None):
+    """Compute the plan of syncing sourcepath on sourcefs to destpath on destfs,
+    with the same selection as sync(). The files are compared by plan_category,
+    without computing checksums. Files that the SyncState state has verified
+    are not compared, like in sync(). Nothing is written to the destination.
+    Returns a dict with the number of files and bytes for every PLAN_*
+    category, the number of excluded directories, and the largest file to
+    transfer, used to measure the throughput
+    """
+    totals = empty_totals()
+    totals['excluded_directories'] = 0
+    largest = None
+
+    def on_excluded(entry):
+        if entry.isdir:
+            totals['excluded_directories'] += 1
+            return
+        totals[PLAN_EXCLUDED]['files'] += 1
+        if entry.stat and entry.stat.size:
+            totals[PLAN_EXCLUDED]['bytes'] += entry.stat.size
+
+    copy_jobs = JobTable(memory_budget=job_memory, job_type=CopyJob)
+    try:
+        if scan:
+            queue_copyjobs(sourcefs, sourcepath, destfs, destpath, copy_jobs,
+                           compareChecksums=compareChecksums, excludelist=excludelist,
+                           filter=compile_filter(scan_filters), create_dirs=False,
+                           on_excluded=on_excluded)
+        if filelist:
+            queue_copyjobs_from_filelist(filelist, sourcepath, destfs, destpath, copy_jobs,
+                                         compareChecksums=compareChecksums, excludelist=excludelist,
+                                         filter=compile_filter(cs_filters), create_dirs=False,
+                                         on_excluded=on_excluded)
+
+        dest_exists = destfs.folderexists(destpath)
+        index = None
+        if dest_exists and dest_index:
+            try:
+                index = destfs.lsindex(destpath)
+            except Exception as ex:
+                logger.warning(f'Cannot list destination {destpath}, query files one by one: {ex}')
+
+        for job in copy_jobs.values():
+            if state and state.is_verified(job, verification(compare, job.compare_checksums)):
+                totals[PLAN_VERIFIED]['files'] += 1
+                totals[PLAN_VERIFIED]['bytes'] += job.size
+                continue
+            if job.size is not None:
+                entry = fsobject_stat(sourcefs, job.source, FileStat(job.size, job.mtime, job.checksum))
+            else:
+                # Only listed in the checksum file
+                try:
+                    entry = sourcefs.getfile(job.source)
+                except Exception:
+                    totals[PLAN_MISSING]['files'] += 1
+                    continue
+                if job.checksum:
+                    entry.checksum = job.checksum
+            dest_stat = index.get(os.path.relpath(job.dest, destpath)) if index is not None else None
+            # Files that are not in the destination index are new, unlike
+            # sync() the plan does not query them one by one
+            if not dest_exists or (index is not None and dest_stat is None):
+                category = PLAN_NEW
+            elif dest_stat is None and not destfs.fileexists(job.dest):
+                category = PLAN_NEW
+            else:
+                if dest_stat is None:
+                    dfile = destfs.getfile(job.dest)
+                    dest_stat = FileStat(dfile.filesize(), dfile.utc_mtime(), None)
+                category = plan_category(entry.filesize(), entry.utc_mtime(), job.checksum,
+                                         dest_stat.size, dest_stat.mtime, dest_stat.checksum,
+                                         compare, job.compare_checksums)
+            size = entry.filesize()
+            totals[category]['files'] += 1
+            totals[category]['bytes'] += size
+            if category != PLAN_IDENTICAL and (largest is None or size > largest[1]):
+                largest = (job.source, size)
+    finally:
+        copy_jobs.close()
+    totals['largest'] = largest
+    return totals
+
+
+def measure_throughput(sourcefs, path, sample_bytes=PLAN_SAMPLE_BYTES):
+    """Returns the rate in bytes per second at which path is read from
+    sourcefs, reading at most sample_bytes, or None when it cannot be read
+    """
+    chunk = 1024 * 1024
+    read = 0
+    try:
+        ts_start = time.time()
+        with sourcefs.getfile(path).open('rb') as f:
+            while read < sample_bytes:
+                data = f.read(chunk)
+                if not data:
+                    break
+                read += len(data)
+        elapsed = time.time() - ts_start
+    except Exception as ex:
+        logger.warning('Cannot measure throughput reading {}: {}'.format(path, ex))
+        return None
+    if read == 0 or elapsed <= 0:
+        return None
+    return read / elapsed
+
+
+def estimate_duration(totals, throughput, workers=1):
+    """Returns the estimated duration in seconds of transferring the new and
+    changed files of totals at throughput bytes per second, with workers
+    copy workers sharing the per file overhead
+    """
+    files = totals[PLAN_NEW]['files'] + totals[PLAN_CHANGED]['files']
+    transfer_bytes = totals[PLAN_NEW]['bytes'] + totals[PLAN_CHANGED]['bytes']
+    duration = files * PLAN_FILE_OVERHEAD / max(workers, 1)
+    if throughput:
+        duration += transfer_bytes / throughput
+    return duration
+
+
+def write_plan(path, folders, sourcefs, throughput=0, workers=1):
+    """Write the plan of the folders to path as JSON. folders is a list of
+    (source, destination, totals) tuples. throughput is the transfer rate in
+    bytes per second. Without throughput it is measured by reading the
+    largest file to transfer from sourcefs
+    """
+    measured = not throughput
+    if measured:
+        largest = max((totals['largest'] for _, _, totals in folders if totals['largest']),
+                      key=lambda largest: largest[1], default=None)
+        throughput = measure_throughput(sourcefs, largest[0]) if largest else None
+    total = empty_totals()
+    total['excluded_directories'] = 0
+    plan = {
+        'created': int(time.time()),
+        'throughput': throughput,
+        'throughput_measured': measured,
+        'workers': workers,
+        'folders': []
+    }
+    for source, destination, totals in folders:
+        add_totals(total, totals)
+        total['excluded_directories'] += totals['excluded_directories']
+        folder = {'source': source, 'destination': destination}
+        folder.update({key: value for key, value in totals.items() if key != 'largest'})
+        folder['duration'] = estimate_duration(totals, throughput, workers)
+        plan['folders'].append(folder)
+    total['duration'] = estimate_duration(total, throughput, workers)
+    plan['total'] = total
+    with open(path, 'w') as f:
+        json.dump(plan, f, indent=2)
+    logger.info('Plan written to {}: {} new and {} changed files, {:.2f} GB to transfer in about {:.0f} s'.format(
+        path, total[PLAN_NEW]['files'], total[PLAN_CHANGED]['files'],
+        (total[PLAN_NEW]['bytes'] + total[PLAN_CHANGED]['bytes']) / (1024 * 1024 * 1024), total['duration']))
+    return plan
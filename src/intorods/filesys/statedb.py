@@ -0,0 +1,91 @@
+"""
+Persistent state of the files synced by earlier runs
+
+The state database records, per source file, the size, modification time and
+checksum at the moment its destination was verified, and how it was verified.
+A later run skips files that have not changed since and that were verified at
+least as strictly as the run would, without querying the destination for them.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Number of verified files recorded before the state database is committed
+STATE_COMMIT = 1000
+
+# How the destination of a file was verified, from weak to strict: it exists,
+# it has the same size and modification time, or it has the same checksum
+VERIFY_EXISTS = 0
+VERIFY_STAT = 1
+VERIFY_CHECKSUM = 2
+
+
+def verification(compare, compare_checksums):
+    """Returns how a sync with compare and compare_checksums verifies a file"""
+    if not compare:
+        return VERIFY_EXISTS
+    return VERIFY_CHECKSUM if compare_checksums else VERIFY_STAT
+
+
+class SyncState():
+    """
+    The state database at path. It can be shared by syncs in several threads
+    of a process. A file is verified when it was synced to the same destination,
+    with the same size and modification time, and the same checksum if the
+    checksum file gives one, by a sync that verified it at least as strictly
+    as required, see verification
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (source TEXT PRIMARY KEY, size INTEGER, '
+                        'mtime INTEGER, checksum TEXT, dest TEXT, verified INTEGER, '
+                        'verification INTEGER)')
+
+    def is_verified(self, job, required=VERIFY_STAT):
+        """Returns True when the file of the copy job was verified by an earlier
+        sync, at least as strictly as required
+        """
+        if job.size is None or job.mtime is None:
+            return False
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, checksum, dest, verification FROM files WHERE source = ?',
+                                  (job.source,)).fetchone()
+        if row is None:
+            return False
+        size, mtime, checksum, dest, verified = row
+        return size == job.size and mtime == int(job.mtime) and dest == job.dest and \
+            (job.checksum is None or checksum == job.checksum) and verified >= required
+
+    def record(self, job, verified=VERIFY_STAT):
+        """Record the file of the copy job as verified at its destination, in
+        the way given by verified
+        """
+        if job.size is None or job.mtime is None:
+            return
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files (source, size, mtime, checksum, dest, verified, '
+                            'verification) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (job.source, job.size, int(job.mtime), job.checksum, job.dest, int(time.time()),
+                             verified))
+            self.uncommitted += 1
+            if self.uncommitted >= STATE_COMMIT:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -1,20 +1,34 @@
+import asyncio
+import contextlib
+import functools
+import heapq
+import io
+import itertools
 import logging
 import math
 import multiprocessing as mp
 import os
 import queue
 import re
+import tarfile
+import threading
 import time
+import types
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-from intorods.filesys.fs_base import factory
-from intorods.filesys.yml_filter import PathFilter
+from intorods.filesys.fs_base import (WalkEntry, factory, fopen, fsobject_stat, fsPool, hashing_stream,
+                                     parallel_walk)
+from intorods.filesys.jobtable import JOB_MEMORY, JobTable
+from intorods.filesys.statedb import verification
+from intorods.filesys.yml_filter import CompiledPathFilter, PathFilter
 
 # The sync_worker tries to copy each object max MAX_RETRIES times,
-# if comparison fails. After that, the object is added to the error_queue,
+# if comparison fails. After that, a failure is reported for the object,
 # and sync_worker continues with the next object
 MAX_RETRIES = 2
-# After trying to copy all objects, copying is retried (again) for objects in the
-# error queue. This happens at most MAX_ERRQUEUE_RETRIES times
+# Objects for which a failure is reported are queued again for copying.
+# This happens at most MAX_ERRQUEUE_RETRIES times per object
 MAX_ERRQUEUE_RETRIES = 2
 # MONITOR_INTERVAL determines the frequency at which stats are reported
 # and at which the state of worker processes is checked
@@ -24,21 +38,106 @@ MONITOR_INTERVAL = 5
 # automatically start a new sync worker if there are still objects to copy
 # in the queue
 MAX_OBJECTS_PER_PROCESS = 2000
+# A sync has at most JOB_QUEUE_SIZE units queued or being synced. The next
+# units are only read from the scan or the job table when results come back
+JOB_QUEUE_SIZE = 10000
+# Small files are grouped into batches, that a worker syncs as one unit.
+# Only files with a size of at most BATCH_FILE_MAX_SIZE are batched, larger
+# files and files with an unknown size are synced by themselves.
+# BATCH_BYTES is the default maximum cumulative size of a batch
+BATCH_FILE_MAX_SIZE = 1024 * 1024
+BATCH_BYTES = 16 * 1024 * 1024
+# Scheduling policies for the order in which the units are handed out:
+# SCHEDULE_FIFO keeps the order in which files are found, SCHEDULE_LARGEST_FIRST
+# starts with the largest files and backfills with the small ones, so all
+# workers finish at about the same time
+SCHEDULE_FIFO = 'fifo'
+SCHEDULE_LARGEST_FIRST = 'largest'
+# Engines to run the sync workers: as separate processes, as threads
+# sharing a pool of filesystem connections, or as asyncio tasks. See ENGINES
+ENGINE_PROCESSES = 'processes'
+ENGINE_THREADS = 'threads'
+ENGINE_ASYNCIO = 'asyncio'
+# The asyncio engine keeps at most MAX_REQUESTS units of jobs in flight, over
+# at most MAX_CONNECTIONS connections per filesystem. The number of concurrent
+# transfers is limited by the number of workers
+MAX_REQUESTS = 64
+MAX_CONNECTIONS = 8
+# When registering in place, the jobs are handed to the workers in units of
+# REGISTER_BATCH files, whatever their size, since no data is transferred
+REGISTER_BATCH = 1000
+
+# Messages on the result queue. Every unit taken from the job queue is answered
+# with a JOB_RESULTS message, holding the result of each job in the unit: one of
+# JOB_SYNCED, JOB_FAILED or JOB_SKIPPED. A worker sends WORKER_EXIT when it stops.
+# DISPATCHER_EXIT stops the thread that delivers the results to the coordinators
+JOB_RESULTS = 'results'
+JOB_SYNCED = 'synced'
+JOB_FAILED = 'failed'
+JOB_SKIPPED = 'skipped'
+# Files that are not synced since the state database has them verified
+JOB_VERIFIED = 'verified'
+WORKER_EXIT = 'exit'
+DISPATCHER_EXIT = 'dispatcher_exit'
+
+# Exclude patterns containing $, \Z, \b, \B or a lookahead can stop matching
+# when characters are added to a path, so they never exclude a whole tree
+ASSERTION_RE = re.compile(r'\$|\\[ZbB]|\(\?[=!]')
 
 logger = logging.getLogger(__name__)
 
+# A copy job: the source and destination path, whether checksums should be
+# compared, the checksum from the checksum file, the source file size and
+# modification time and the FileStat of the destination from the destination index.
+# checksum, size and mtime are None when unknown, dest_stat is None when the
+# destination was not found in the index
+CopyJob = namedtuple('CopyJob', ['source', 'dest', 'compare_checksums', 'checksum', 'size', 'mtime',
+                                 'dest_stat'],
+                     defaults=[None, None, None])
 
-def sync_worker(process_id, q, sq, error_queue, sfs_name, sfs_opts, dfs_name, dfs_opts, compare, minimum_age):
-    """The sync worker syncs items from the queue q
-    sfs_name, sfs_opts, dfs_name and dfs_opts contain the source and destination
-    filesystem name and connect parameters.
-    Items that fail to copy/sync are added to the error queue.
-    On succesfull sync, the size of the synced object is added to the 
-    statistics queue sq
+
+def dest_equal(entry, destfs, destfile, dest_stat=None, compare=True, compareChecksums=False):
+    """Compare the source file object entry to destfile on destfs.
+    dest_stat is the FileStat of destfile from the destination index, if known.
+    Returns None when destfile does not exist, otherwise whether it equals the
+    source. Without compare, an existing destination is taken as equal.
+    Errors querying the destination are raised, a destination that cannot
+    be compared is unequal. A checksum missing from dest_stat is only
+    computed when the size and modification time of destfile match
+    """
+    if dest_stat is None and not destfs.fileexists(destfile):
+        return None
+    if not compare:
+        # No file comparison required, existence of dest object is enough
+        return True
+    if dest_stat is not None:
+        dfile = fsobject_stat(destfs, destfile, dest_stat)
+    else:
+        dfile = destfs.getfile(destfile)
+    try:
+        if compareChecksums and dest_stat is not None and dest_stat.checksum is None:
+            if (entry.filesize(), entry.utc_mtime()) != (dest_stat.size, dest_stat.mtime):
+                return False
+        return entry.compareto(dfile, compareChecksums=compareChecksums)
+    except Exception as ex:
+        logger.error('error comparing {} to {}. Exception: {}'.format(
+            entry.path, destfile, ex))
+        return False
+
+
+def sync_file(process_id, source_fs, destfs, item, compare, minimum_age, limiter=None):
+    """Sync a single file described by the job item from source_fs to destfs.
+    The optional limiter is a BandwidthLimiter that is consulted before the
+    file is copied.
+    Returns a tuple (result, size, copies), where result is one of JOB_SYNCED,
+    JOB_FAILED or JOB_SKIPPED, size is the size of the synced file and copies
+    the number of copy attempts that were made
     """
 
     def copyobj(entry, dfs, dfile):
         try:
+            if limiter:
+                limiter.consume(entry.filesize())
             entry.copyto(dfs, dfile)
             dfs.getfile(dfile).set_mtime(entry.utc_mtime())
         except Exception as ex:
@@ -47,98 +146,293 @@ def sync_worker(process_id, q, sq, error_queue, sfs_name, sfs_opts, dfs_name, df
             return False
         return True
 
-    source_fs = factory.createfs(sfs_name, **sfs_opts)
-    destfs = factory.createfs(dfs_name, **dfs_opts)
-    objects_copied = 0
-    # Start the copy loop
-    while objects_copied < MAX_OBJECTS_PER_PROCESS:
+    sourcefile, destfile, compareChecksums, checksum = item[:4]
+    dest_stat = item.dest_stat
+    copies = 0
+
+    # Get source file object
+    try:
+        entry = source_fs.getfile(sourcefile)
+        if minimum_age:
+            now = math.floor(time.time())
+            if entry.utc_mtime() >= (now - minimum_age):
+                logger.debug('T{}: File {} is omitted since it was modified shortly.'.format(
+                    process_id, sourcefile))
+                return JOB_SKIPPED, 0, copies
+    except:
+        logger.debug('T{}: Error getting source file {}.'.format(
+            process_id, sourcefile))
+        return JOB_FAILED, 0, copies
+
+    # Assign checksum from checksum file
+    if checksum:
+        entry.checksum = checksum
+
+    # Try copying the object MAX_RETRIES times
+    retry_counter = 0
+    equal = False
+    while retry_counter < MAX_RETRIES:
+        # Check for existing destination and continue if equal. The state
+        # from the destination index is only used for the first attempt
         try:
-            # Fetch an item to copy from the queue
-            item = q.get(True, 2)
-        except queue.Empty:
-            logger.debug('T{}: Empty queue: exit'.format(process_id))
-            break
-        if item is None:
-            logger.debug('T{}: Empty queue item: exit'.format(process_id))
+            equal = dest_equal(entry, destfs, destfile, dest_stat, compare, compareChecksums)
+        except:
+            logger.error('T{}: error querying dest filesystem for {}'.format(
+                process_id, destfile))
             break
-        sourcefile, destfile, compareChecksums, checksum = item
+        if equal is not None:
+            if equal:
+                return JOB_SYNCED, entry.filesize(), copies
+            else:
+                logger.debug('T{}: objects {} and {} are not equal'.format(
+                    process_id, entry.path, destfile))
+                try:
+                    destfs.deletefile(destfile)
+                except:
+                    logger.error('T{}: error deleting {}'.format(
+                        process_id, destfile))
+            dest_stat = None
 
-        # Get source file object
+        # Here the actual copy is done.
+        copies += 1
+        if not copyobj(entry, destfs, destfile):
+            logger.error('T{}: copying {} failed'.format(
+                process_id, entry.path))
+
+        retry_counter += 1
+
+    logger.error('T{}: copying of {} to {} failed'.format(
+        process_id, entry.path, destfile))
+    return JOB_FAILED, 0, copies
+
+
+def sync_bundle(process_id, source_fs, destfs, jobs, compare, minimum_age, limiter=None):
+    """Sync the files of the jobs, which are small, as a bundle. The files
+    that differ from the destination are packed in a tar archive, which destfs
+    extracts in the deepest directory holding all of them. The extracted
+    files are verified with a listing of their directories: the size, and
+    the checksum for jobs that compare checksums. A modification time that
+    the extraction did not keep is set afterwards.
+    Files that are not in the bundle or not verified are synced one by one
+    with sync_file.
+    Returns the (result, size) tuple of every job and the number of copies
+    """
+    results = [None] * len(jobs)
+    # The jobs to bundle, as (index, job, source file object)
+    bundled = []
+    for i, job in enumerate(jobs):
         try:
-            entry = source_fs.getfile(sourcefile)
-            if minimum_age:
-                now = math.floor(time.time())
-                if entry.utc_mtime() >= (now - minimum_age):
-                    logger.debug('T{}: File {} is omitted since it was modified shortly.'.format(
-                        process_id, sourcefile))
-                    break
-        except:
-            logger.debug('T{}: Error getting source file {}.'.format(
-                process_id, sourcefile))
-            error_queue.put(item)
+            entry = source_fs.getfile(job.source)
+            if minimum_age and entry.utc_mtime() >= math.floor(time.time()) - minimum_age:
+                results[i] = (JOB_SKIPPED, 0)
+                continue
+            if job.checksum:
+                entry.checksum = job.checksum
+            equal = dest_equal(entry, destfs, job.dest, job.dest_stat, compare, job.compare_checksums)
+            if equal:
+                results[i] = (JOB_SYNCED, entry.filesize())
+                continue
+            if equal is not None:
+                destfs.deletefile(job.dest)
+        except Exception as ex:
+            logger.debug('T{}: cannot bundle {}: {}'.format(process_id, job.source, ex))
+            continue
+        bundled.append((i, job, entry))
+
+    copies = 0
+    if len(bundled) > 1:
+        copies += len(bundled)
+        try:
+            verified = copy_bundle(destfs, bundled, limiter=limiter)
+        except Exception as ex:
+            logger.error('T{}: ERROR COPYING bundle of {} files. Exception: {}'.format(
+                process_id, len(bundled), ex))
+            verified = set()
+        for i, job, entry in bundled:
+            if job.dest in verified:
+                results[i] = (JOB_SYNCED, entry.filesize())
+
+    # The destination state from the index is outdated for the remaining jobs
+    for i, job in enumerate(jobs):
+        if results[i] is None:
+            result, size, job_copies = sync_file(process_id, source_fs, destfs, job._replace(dest_stat=None),
+                                                 compare, minimum_age, limiter=limiter)
+            copies += job_copies
+            results[i] = (result, size)
+    return results, copies
+
+
+def copy_bundle(destfs, bundled, limiter=None):
+    """Copy the files of bundled, a list of (index, job, source file object)
+    tuples, to destfs as a tar archive. Returns the set of destination paths
+    that were verified
+    """
+    root = os.path.commonpath([os.path.dirname(job.dest) for _, job, _ in bundled])
+    if limiter:
+        limiter.consume(sum(entry.filesize() for _, _, entry in bundled))
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        for _, job, entry in bundled:
+            info = tarfile.TarInfo(os.path.relpath(job.dest, root))
+            info.size = entry.filesize()
+            info.mtime = entry.utc_mtime()
+            with fopen(entry, 'rb') as fp:
+                stream = hashing_stream(fp)
+                tar.addfile(info, stream)
+            entry.copied_checksum(stream)
+    archive.seek(0)
+    destfs.extract_bundle(archive, root)
+
+    # List the directories of the extracted files
+    destfs.invalidate_cache()
+    listing = {}
+    for dirname in set(os.path.dirname(job.dest) for _, job, _ in bundled):
+        for e in destfs.scandir(dirname):
+            if not e.isdir:
+                listing[os.path.join(dirname, os.path.basename(e.path))] = e.stat
+    checksums = destfs.compute_checksums([job.dest for _, job, entry in bundled
+                                          if job.compare_checksums and job.dest in listing
+                                          and listing[job.dest].checksum is None
+                                          and listing[job.dest].size == entry.filesize()])
+    verified = set()
+    for _, job, entry in bundled:
+        dest_stat = listing.get(job.dest)
+        if dest_stat is None or dest_stat.size != entry.filesize():
             continue
+        if job.compare_checksums:
+            dest_checksum = checksums.get(job.dest) or fsobject_stat(destfs, job.dest, dest_stat).checksum
+            if dest_checksum != entry.checksum:
+                continue
+        if dest_stat.mtime != entry.utc_mtime():
+            destfs.getfile(job.dest).set_mtime(entry.utc_mtime())
+        verified.add(job.dest)
+    return verified
 
-        # Assign checksum from checksum file
-        if checksum:
-            entry.checksum = checksum
 
-        # Try copying the object MAX_RETRIES times
-        retry_counter = 0
-        equal = False
-        while retry_counter < MAX_RETRIES:
-            # Check for existing destination and continue if equal
+def physical_path(path, register):
+    """Returns the path at which the resource server finds the source file
+    path. register is a (source prefix, physical prefix) pair: a path below
+    the source prefix is found below the physical prefix. Other paths are
+    found at the same absolute path
+    """
+    path = os.path.abspath(path)
+    prefix, physical = register
+    prefix = prefix.rstrip('/')
+    if prefix and (path == prefix or path.startswith(prefix + '/')):
+        return physical.rstrip('/') + path[len(prefix):]
+    return path
+
+
+def register_unit(process_id, source_fs, destfs, jobs, compare, minimum_age, register):
+    """Register the source files of the jobs in place at destfs, see
+    physical_path for register. A destination that exists and equals the
+    source is left alone. A destination that exists but differs is not
+    replaced, since it may be the source file itself, registered earlier;
+    its job fails. The checksum from the checksum file is registered with
+    the file.
+    Returns the (result, size) tuple of every job
+    """
+    results = [None] * len(jobs)
+    # The files to register, as (index, physical path, destination, checksum, size)
+    files = []
+    for i, job in enumerate(jobs):
+        try:
+            entry = source_fs.getfile(job.source)
+            if minimum_age and entry.utc_mtime() >= math.floor(time.time()) - minimum_age:
+                results[i] = (JOB_SKIPPED, 0)
+                continue
+            if job.checksum:
+                entry.checksum = job.checksum
+            equal = dest_equal(entry, destfs, job.dest, job.dest_stat, compare, job.compare_checksums)
+        except Exception as ex:
+            logger.error('T{}: error registering {}. Exception: {}'.format(process_id, job.source, ex))
+            results[i] = (JOB_FAILED, 0)
+            continue
+        if equal:
+            results[i] = (JOB_SYNCED, entry.filesize())
+        elif equal is not None:
+            logger.error('T{}: {} exists and differs from {}, not registered'.format(
+                process_id, job.dest, job.source))
+            results[i] = (JOB_FAILED, 0)
+        else:
+            files.append((i, physical_path(job.source, register), job.dest, job.checksum, entry.filesize()))
+
+    errors = destfs.register_files([(physical, dest, checksum) for _, physical, dest, checksum, _ in files])
+    for i, physical, dest, _, size in files:
+        if dest in errors:
+            logger.error('T{}: ERROR REGISTERING {} as {}. Exception: {}'.format(
+                process_id, physical, dest, errors[dest]))
+            results[i] = (JOB_FAILED, 0)
+        else:
+            results[i] = (JOB_SYNCED, size)
+    return results
+
+
+def sync_units(worker_id, q, rq, current, source_fs, destfs, compare, minimum_age, limiter=None,
+               bundle=False, register=None):
+    """Sync units from the queue q, until None is received or
+    MAX_OBJECTS_PER_PROCESS objects have been copied.
+    Items on q are (unit_id, jobs) tuples, where jobs is a list of one or
+    more copy jobs. The outcome of every unit is reported to the result queue
+    rq as (JOB_RESULTS, unit_id, results), with a (result, size) tuple for
+    each job. While a unit is being synced, its unit_id is kept in
+    current.value, so the coordinator can recover the unit if the worker dies.
+    With bundle, units of several jobs are synced with sync_bundle when
+    destfs supports bundles. With register, the files are registered in
+    place instead of copied, see register_unit.
+    Returns True when the worker stopped because of MAX_OBJECTS_PER_PROCESS
+    """
+    objects_copied = 0
+    # Start the copy loop
+    while objects_copied < MAX_OBJECTS_PER_PROCESS:
+        # Fetch an item to copy from the queue
+        item = q.get()
+        if item is None:
+            logger.debug('T{}: Empty queue item: exit'.format(worker_id))
+            return False
+        unit_id, jobs = item
+        current.value = unit_id
+        if register is not None:
+            results = register_unit(worker_id, source_fs, destfs, jobs, compare, minimum_age, register)
+            jobs = []
+        elif bundle and len(jobs) > 1 and destfs.supports_bundles:
+            results, copies = sync_bundle(worker_id, source_fs, destfs, jobs, compare, minimum_age,
+                                          limiter=limiter)
+            objects_copied += copies
+            jobs = []
+        else:
+            results = []
+        for job in jobs:
             try:
-                dest_exists = destfs.fileexists(destfile)
-            except:
-                logger.error('T{}: error querying dest filesystem for {}'.format(
-                    process_id, destfile))
-                break
-            if dest_exists:
-                if compare:
-                    try:
-                        dfile = destfs.getfile(destfile)
-                    except:
-                        logger.error('T{}: error getting destfile object {}'.format(
-                            process_id, destfile))
-                        break
-                    try:
-                        equal = entry.compareto(
-                            dfile, compareChecksums=compareChecksums)
-                    except Exception as ex:
-                        logger.error('T{}: error comparing {} to {}. Exception: {}'.format(
-                            process_id, entry.path, destfile, ex))
-                        equal = False
-                else:
-                    # No file comparison required, existence of dest object is enough
-                    equal = True
+                result, size, copies = sync_file(
+                    worker_id, source_fs, destfs, job, compare, minimum_age, limiter=limiter)
+            except Exception as ex:
+                logger.error('T{}: error syncing {}. Exception: {}'.format(
+                    worker_id, job.source, ex))
+                result, size, copies = JOB_FAILED, 0, 1
+            # objects_copied is only used to terminate the worker after a certain number of copy actions
+            objects_copied += copies
+            results.append((result, size))
+        rq.put((JOB_RESULTS, unit_id, results))
+        current.value = -1
+        # Workers can live for several syncs, so do not keep file objects
+        # of units that are done
+        source_fs.invalidate_cache()
+        destfs.invalidate_cache()
+    return True
 
-                if equal:
-                    sq.put(entry.filesize())
-                    break
-                else:
-                    logger.debug('T{}: objects {} and {} are not equal'.format(
-                        process_id, entry.path, destfile))
-                    try:
-                        destfs.deletefile(destfile)
-                    except:
-                        logger.error('T{}: error deleting {}'.format(
-                            process_id, destfile))
-
-            # Here the actual copy is done.
-            # objects_copied is only used to terminate the thread after a certain number of copy actions
-            objects_copied += 1
-            if not copyobj(entry, destfs, destfile):
-                logger.error('T{}: copying {} failed'.format(
-                    process_id, entry.path))
-
-            retry_counter += 1
-
-        if not equal:
-            logger.error('T{}: copying of {} to {} failed'.format(
-                process_id, entry.path, destfile))
-            # This is a potential deadlock in case of lots of errors
-            # https://stackoverflow.com/questions/59951832/python-multiprocessing-queue-makes-code-hang-with-large-data
-            error_queue.put(item)
+
+def sync_worker(process_id, q, rq, current, sfs_name, sfs_opts, dfs_name, dfs_opts, compare, minimum_age,
+                limiter=None, bundle=False, register=None):
+    """The sync worker process syncs units from the queue q, see sync_units.
+    sfs_name, sfs_opts, dfs_name and dfs_opts contain the source and destination
+    filesystem name and connect parameters.
+    """
+    source_fs = factory.createfs(sfs_name, **sfs_opts)
+    destfs = factory.createfs(dfs_name, **dfs_opts)
+    sync_units(process_id, q, rq, current, source_fs, destfs, compare, minimum_age, limiter=limiter,
+               bundle=bundle, register=register)
+    rq.put((WORKER_EXIT, process_id, 0))
 
     # Destroy FS objects
     source_fs.cleanup()
@@ -147,145 +441,869 @@ def sync_worker(process_id, q, sq, error_queue, sfs_name, sfs_opts, dfs_name, df
     logger.debug('T{}: Finish'.format(process_id))
 
 
-def sync(sourcefs, sourcepath, destfs, destpath, sfs_name, sfs_opts, dfs_name, dfs_opts,
-         compareChecksums=False, filelist={}, scan=False, worker_processes=1, excludelist=[],
-         compare=True, minimum_age=0, cs_filters=[], scan_filters=[]):
-    # Initialize MP
-    job_queue = mp.Queue()
-    error_queue = mp.Queue()
-    stats_queue = mp.Queue()
-
-    # Create copy processes list
-    procs = []
-
-    def new_copy_process(i):
-        logger.debug('Creating copy process {}'.format(i))
-        p = mp.Process(target=sync_worker, args=(i, job_queue, stats_queue, error_queue,
-                                                 sfs_name, sfs_opts, dfs_name, dfs_opts,
-                                                 compare, minimum_age))
+def sync_thread_worker(thread_id, q, rq, current, source_pool, dest_pool, compare, minimum_age,
+                       limiter=None, bundle=False, register=None):
+    """The sync worker thread syncs units from the queue q, see sync_units.
+    The filesystem connections are taken from the connection pools source_pool
+    and dest_pool, and returned afterwards. Connections of a worker that
+    reached MAX_OBJECTS_PER_PROCESS are closed instead.
+    """
+    source_fs = source_pool.acquire()
+    destfs = dest_pool.acquire()
+    exhausted = True
+    try:
+        exhausted = sync_units(thread_id, q, rq, current, source_fs, destfs, compare, minimum_age,
+                               limiter=limiter, bundle=bundle, register=register)
+    finally:
+        if exhausted:
+            source_pool.discard(source_fs)
+            dest_pool.discard(destfs)
+        else:
+            source_pool.release(source_fs)
+            dest_pool.release(destfs)
+        rq.put((WORKER_EXIT, thread_id, 0))
+
+    logger.debug('T{}: Finish'.format(thread_id))
+
+
+class BandwidthLimiter():
+    """Limits the average transfer rate of all workers together to rate
+    bytes per second. A transfer is started when the budget is not
+    exhausted, and its size is taken from the budget beforehand, so
+    the transfers that follow a large file wait until it is paid back.
+    The state is kept in shared memory, so a limiter can be shared by
+    worker processes
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = mp.Lock()
+        # The budget is at most one second of transfers
+        self.budget = mp.Value('d', rate, lock=False)
+        self.updated = mp.Value('d', time.monotonic(), lock=False)
+
+    def consume(self, size):
+        # Wait until size bytes may be transferred
+        with self.lock:
+            now = time.monotonic()
+            self.budget.value = min(self.rate, self.budget.value + (now - self.updated.value) * self.rate)
+            self.updated.value = now
+            wait = -self.budget.value / self.rate if self.budget.value < 0 else 0
+            self.budget.value -= size
+        if wait:
+            time.sleep(wait)
+
+
+class SyncEngine():
+    """Base class of the engines that run the sync workers.
+    The coordinator puts units on the job queue, the engine starts and stops
+    the workers. The workers report the outcome on the result queue, from
+    which a dispatcher thread delivers it to the channel the unit was
+    submitted for. Since every sync has its own channel, several syncs
+    can run concurrently on the same engine.
+    An engine can be used for several subsequent syncs, the workers and
+    their filesystem connections stay alive until stop is called.
+    max_bandwidth limits the transfer rate of all workers together, in
+    bytes per second. 0 means no limit. With bundle, the workers sync
+    batches of small files as bundles, see sync_bundle. With register, the
+    workers register the files in place instead, see register_unit.
+    max_requests, workers and max_connections are used by AsyncioEngine
+    """
+
+    def __init__(self, sfs_name, sfs_opts, dfs_name, dfs_opts, compare=True, minimum_age=0,
+                 queue_size=0, max_requests=MAX_REQUESTS, max_bandwidth=0, bundle=False,
+                 register=None, workers=1, max_connections=MAX_CONNECTIONS):
+        self.sfs_name = sfs_name
+        self.sfs_opts = sfs_opts
+        self.dfs_name = dfs_name
+        self.dfs_opts = dfs_opts
+        self.compare = compare
+        self.minimum_age = minimum_age
+        self.bundle = bundle
+        self.register = register
+        self.limiter = BandwidthLimiter(max_bandwidth) if max_bandwidth else None
+        self.job_queue, self.result_queue = self._create_queues(queue_size)
+        # Workers by worker id, with the object holding the unit id the
+        # worker is working on
+        self.workers = {}
+        self.worker_count = 0
+        # Unit ids are unique for the lifetime of the engine, so a late
+        # result is never taken for a unit of a later sync
+        self.unit_count = 0
+        # The channel of every unit that is not answered yet, by unit id
+        self.unit_channels = {}
+        # The lock protects the state above, which is shared by the
+        # coordinators and the dispatcher
+        self.lock = threading.RLock()
+        self.workers_changed = threading.Condition(self.lock)
+        self.dispatcher = None
+
+    def new_unit_id(self):
+        with self.lock:
+            self.unit_count += 1
+            return self.unit_count
+
+    def _create_queues(self, queue_size):
+        raise NotImplementedError
+
+    def _start_worker(self, worker_id, current):
+        raise NotImplementedError
+
+    def _start_dispatcher(self):
+        with self.lock:
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+                self.dispatcher.start()
+
+    def _dispatch(self):
+        # Deliver the messages on the result queue until DISPATCHER_EXIT
+        while True:
+            kind, message_id, results = self.result_queue.get()
+            if kind == DISPATCHER_EXIT:
+                break
+            if kind == WORKER_EXIT:
+                self.worker_exited(message_id)
+            else:
+                self._deliver(message_id, results)
+
+    def _deliver(self, unit_id, results):
+        with self.lock:
+            channel = self.unit_channels.pop(unit_id, None)
+        if channel is not None:
+            channel.put((JOB_RESULTS, unit_id, results))
+
+    def start_workers(self, number):
+        # Start workers until number workers are running
+        self._start_dispatcher()
+        with self.lock:
+            while len(self.workers) < number:
+                worker_id = self.worker_count
+                self.worker_count += 1
+                logger.debug('Creating copy worker {}'.format(worker_id))
+                current = self._current()
+                self.workers[worker_id] = (self._start_worker(worker_id, current), current)
+
+    def _current(self):
+        return types.SimpleNamespace(value=-1)
+
+    def _current_units(self, current):
+        return [current.value] if current.value >= 0 else []
+
+    def check_workers(self):
+        # Handle finished workers. The units that were being synced by
+        # workers that ended without reporting them are answered with
+        # None as results
+        lost = []
+        with self.lock:
+            for worker_id, (worker, current) in list(self.workers.items()):
+                if not worker.is_alive():
+                    worker.join()
+                    del self.workers[worker_id]
+                    if self._current_units(current):
+                        logger.error('Copy worker {} ended while syncing'.format(worker_id))
+                        lost.extend(self._current_units(current))
+            self.workers_changed.notify_all()
+        for unit_id in lost:
+            self._deliver(unit_id, None)
+
+    def worker_exited(self, worker_id):
+        logger.debug('Copy worker {} has ended'.format(worker_id))
+        with self.lock:
+            worker = self.workers.pop(worker_id, None)
+            self.workers_changed.notify_all()
+        if worker is not None:
+            worker[0].join()
+
+    def open_channel(self):
+        # Returns a new channel, on which the results of the units that are
+        # put for this channel are delivered
+        return queue.Queue()
+
+    def put(self, channel, item, timeout):
+        self._start_dispatcher()
+        with self.lock:
+            self.unit_channels[item[0]] = channel
+        self.job_queue.put(item, True, timeout)
+
+    def get(self, channel, timeout):
+        return channel.get(True, timeout)
+
+    def get_nowait(self, channel):
+        return channel.get_nowait()
+
+    def stop(self):
+        # Stop all workers. This should only be done when no units are pending
+        logger.debug('Wait for copy workers to finish')
+        with self.lock:
+            for _ in self.workers:
+                self.job_queue.put(None)
+            while self.workers:
+                if not self.workers_changed.wait(MONITOR_INTERVAL):
+                    self.check_workers()
+            dispatcher, self.dispatcher = self.dispatcher, None
+        if dispatcher is not None:
+            self.result_queue.put((DISPATCHER_EXIT, 0, None))
+            dispatcher.join()
+
+    def cleanup(self):
+        pass
+
+
+class ProcessEngine(SyncEngine):
+    """Runs the sync workers as processes, communicating through
+    multiprocessing queues. Every process connects to the source and
+    destination filesystem by itself
+    """
+
+    def _create_queues(self, queue_size):
+        return mp.Queue(queue_size), mp.Queue()
+
+    def _current(self):
+        return mp.Value('q', -1, lock=False)
+
+    def _start_worker(self, worker_id, current):
+        p = mp.Process(target=sync_worker, args=(worker_id, self.job_queue, self.result_queue, current,
+                                                 self.sfs_name, self.sfs_opts, self.dfs_name, self.dfs_opts,
+                                                 self.compare, self.minimum_age, self.limiter,
+                                                 self.bundle, self.register),
+                       daemon=True)
         p.start()
         return p
 
-    def handle_statistics(ts_start, total_bytes_copied, total_files_copied):
-        ts_now = time.time()
-        while stats_queue.qsize() > 0:
-            bytes_copied = stats_queue.get()
-            total_files_copied += 1
-            total_bytes_copied += bytes_copied
-        byterate = total_bytes_copied/(ts_now-ts_start)
-        filerate = total_files_copied/(ts_now-ts_start)
-        timeleft = qsize/filerate if filerate > 0 else 0
-        avg_size = total_bytes_copied/total_files_copied if total_files_copied > 0 else 0
-        logger.info('QUEUE SIZE : {:6d} COPYRATE: {:4.0f}  BYTERATE: {:5.2f} MB/s  AVG SIZE : {:8.2f} kB  TIME: {:.2f} s  ERRORS : {:6d}'.format(
-            qsize, filerate, byterate/(1024*1024), avg_size/1024, timeleft, error_queue.qsize()))
-        return total_bytes_copied, total_files_copied
 
-    if not destfs.folderexists(destpath):
-        destfs.mkdir(destpath)
+class ThreadEngine(SyncEngine):
+    """Runs the sync workers as threads of the current process. The workers
+    share a pool of connections per filesystem, so connections are reused
+    by subsequent workers
+    """
 
-    ts_start = time.time()
+    def __init__(self, sfs_name, sfs_opts, dfs_name, dfs_opts, compare=True, minimum_age=0,
+                 queue_size=0, max_requests=MAX_REQUESTS, max_bandwidth=0, bundle=False,
+                 register=None, workers=1, max_connections=MAX_CONNECTIONS):
+        super().__init__(sfs_name, sfs_opts, dfs_name, dfs_opts, compare=compare,
+                         minimum_age=minimum_age, queue_size=queue_size, max_bandwidth=max_bandwidth,
+                         bundle=bundle, register=register, workers=workers,
+                         max_connections=max_connections)
+        self.source_pool = fsPool(sfs_name, **sfs_opts)
+        self.dest_pool = fsPool(dfs_name, **dfs_opts)
+
+    def _create_queues(self, queue_size):
+        return queue.Queue(queue_size), queue.Queue()
+
+    def _start_worker(self, worker_id, current):
+        t = threading.Thread(target=sync_thread_worker, args=(worker_id, self.job_queue, self.result_queue, current,
+                                                              self.source_pool, self.dest_pool,
+                                                              self.compare, self.minimum_age, self.limiter,
+                                                              self.bundle, self.register),
+                             daemon=True)
+        t.start()
+        return t
 
-    # Enqueue files to copy
-    # copy_jobs is a dict with struct { src_filename : (src_filename, dst_filename, cmp_checksum, checksum_value) }
-    # this ensures all source file will be present only once
-    copy_jobs = {}
+    def cleanup(self):
+        self.source_pool.cleanup()
+        self.dest_pool.cleanup()
 
-    # Start with scanning the source. since here no cs value will be included
-    if scan:
-        logger.debug('Queue copy jobs from source fs')
-        spf = PathFilter(scan_filters)
+
+class AsyncioEngine(ThreadEngine):
+    """Runs the jobs as asyncio tasks on an event loop in a single worker
+    thread, with at most max_requests units in flight. A unit holds its
+    request slot from the moment it is taken from the job queue until its
+    results are reported. The filesystem calls themselves are blocking, they
+    run in an executor. The filesystem clients do not support concurrent
+    requests on a single connection, so a connection per filesystem is taken
+    from the pools for every comparison and every transfer, and returned
+    right after it. At most max_connections connections per filesystem are
+    open, the other jobs in flight wait for one.
+    The jobs of a unit are first compared to the destination at the same
+    time. At most workers transfers run at the same time, a file that has to
+    be copied waits for a transfer slot before it takes its connections. With
+    bundle, the files of a unit that have to be copied are synced as a bundle,
+    see sync_bundle. With register, a unit is registered in one call, see
+    register_unit
+    """
+
+    def __init__(self, sfs_name, sfs_opts, dfs_name, dfs_opts, compare=True, minimum_age=0,
+                 queue_size=0, max_requests=MAX_REQUESTS, max_bandwidth=0, bundle=False,
+                 register=None, workers=1, max_connections=MAX_CONNECTIONS):
+        super().__init__(sfs_name, sfs_opts, dfs_name, dfs_opts, compare=compare,
+                         minimum_age=minimum_age, queue_size=queue_size, max_bandwidth=max_bandwidth,
+                         bundle=bundle, register=register)
+        self.max_requests = max_requests
+        self.transfers = threading.BoundedSemaphore(max(workers, 1))
+        # Whether the destination supports bundles, known once a connection
+        # has been made
+        self.bundles_supported = None
+        # A transfer holds its connections, so there are at least as many
+        # connections as transfers
+        connections = max(max_connections, workers, 1)
+        self.source_pool = fsPool(sfs_name, max_connections=connections, **sfs_opts)
+        self.dest_pool = fsPool(dfs_name, max_connections=connections, **dfs_opts)
+
+    def start_workers(self, number):
+        # All jobs run on a single event loop
+        super().start_workers(min(number, 1))
+
+    def _current(self):
+        return types.SimpleNamespace(units=set())
+
+    def _current_units(self, current):
+        return list(current.units)
+
+    def _start_worker(self, worker_id, current):
+        t = threading.Thread(target=asyncio.run, args=(self._serve(worker_id, current),),
+                             daemon=True)
+        t.start()
+        return t
+
+    async def _serve(self, worker_id, current):
+        loop = asyncio.get_running_loop()
+        requests = asyncio.Semaphore(self.max_requests)
+        tasks = set()
+        with ThreadPoolExecutor(self.max_requests) as executor:
+            while True:
+                # A new unit is only taken when a request slot is available,
+                # the slot is released when the unit is done
+                await requests.acquire()
+                item = await loop.run_in_executor(None, self.job_queue.get)
+                if item is None:
+                    logger.debug('T{}: Empty queue item: exit'.format(worker_id))
+                    requests.release()
+                    break
+                unit_id, jobs = item
+                current.units.add(unit_id)
+                task = asyncio.ensure_future(
+                    self._sync_unit(worker_id, unit_id, jobs, current, requests, executor))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        self.result_queue.put((WORKER_EXIT, worker_id, 0))
+
+    async def _sync_unit(self, worker_id, unit_id, jobs, current, requests, executor):
+        loop = asyncio.get_running_loop()
+        try:
+            if self.register is not None:
+                results = await loop.run_in_executor(executor, self._register_blocking, worker_id, jobs)
+            else:
+                results = await self._sync_jobs(worker_id, jobs, executor)
+            self.result_queue.put((JOB_RESULTS, unit_id, results))
+            current.units.discard(unit_id)
+        finally:
+            requests.release()
+
+    async def _sync_jobs(self, worker_id, jobs, executor):
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[loop.run_in_executor(executor, self._compare_blocking, worker_id, job)
+                                         for job in jobs])
+        # The jobs that have to be copied. Their destination was deleted if
+        # it differed, so the state from the index is outdated
+        copies = [(i, jobs[i]._replace(dest_stat=None)) for i, result in enumerate(results) if result is None]
+        if (self.bundle and len(copies) > 1
+                and await loop.run_in_executor(executor, self._supports_bundles)):
+            copy_results = await loop.run_in_executor(executor, self._bundle_blocking, worker_id,
+                                                        [job for _, job in copies])
+        else:
+            copy_results = await asyncio.gather(*[loop.run_in_executor(executor, self._copy_blocking,
+                                                                         worker_id, job)
+                                                    for _, job in copies])
+        for (i, _), result in zip(copies, copy_results):
+            results[i] = result
+        return results
+
+    @contextlib.contextmanager
+    def _connections(self):
+        # A connection to each filesystem, held for a single comparison or
+        # transfer. Every job takes the source connection first
+        source_fs = self.source_pool.acquire()
+        try:
+            destfs = self.dest_pool.acquire()
+            try:
+                yield source_fs, destfs
+            finally:
+                self.dest_pool.release(destfs)
+        finally:
+            self.source_pool.release(source_fs)
+
+    def _supports_bundles(self):
+        if self.bundles_supported is None:
+            destfs = self.dest_pool.acquire()
+            self.bundles_supported = destfs.supports_bundles
+            self.dest_pool.release(destfs)
+        return self.bundles_supported
+
+    def _compare_blocking(self, worker_id, job):
+        # Returns the (result, size) tuple of a job that needs no transfer, or
+        # None when the file has to be copied. A destination that differs is
+        # deleted
         try:
-            queue_copyjobs(sourcefs, sourcepath, destfs, destpath, copy_jobs,
-                           compareChecksums=compareChecksums, excludelist=excludelist, filter=spf)
+            with self._connections() as (source_fs, destfs):
+                entry = source_fs.getfile(job.source)
+                if self.minimum_age and entry.utc_mtime() >= math.floor(time.time()) - self.minimum_age:
+                    return JOB_SKIPPED, 0
+                if job.checksum:
+                    entry.checksum = job.checksum
+                equal = dest_equal(entry, destfs, job.dest, job.dest_stat, self.compare, job.compare_checksums)
+                if equal:
+                    return JOB_SYNCED, entry.filesize()
+                if equal is not None:
+                    destfs.deletefile(job.dest)
         except Exception as ex:
-            logger.error(f'ERROR queueing jobs for {sourcepath}: {ex}')
-            return False
+            logger.error('T{}: error syncing {}. Exception: {}'.format(
+                worker_id, job.source, ex))
+            return JOB_FAILED, 0
+        return None
 
-    if filelist:
-        logger.debug('Queue copy jobs from filelist')
-        cpf = PathFilter(cs_filters)
+    def _copy_blocking(self, worker_id, job):
         try:
-            queue_copyjobs_from_filelist(filelist, sourcepath, destfs, destpath, copy_jobs,
-                                         compareChecksums=compareChecksums, excludelist=excludelist, filter=cpf)
+            with self.transfers, self._connections() as (source_fs, destfs):
+                result, size, _ = sync_file(worker_id, source_fs, destfs, job, self.compare,
+                                            self.minimum_age, limiter=self.limiter)
         except Exception as ex:
-            logger.debug(f'ERROR queueing jobs for {sourcepath}: {ex}')
-            return False
+            logger.error('T{}: error syncing {}. Exception: {}'.format(
+                worker_id, job.source, ex))
+            result, size = JOB_FAILED, 0
+        return result, size
+
+    def _bundle_blocking(self, worker_id, jobs):
+        try:
+            with self.transfers, self._connections() as (source_fs, destfs):
+                return sync_bundle(worker_id, source_fs, destfs, jobs, self.compare, self.minimum_age,
+                                   limiter=self.limiter)[0]
+        except Exception as ex:
+            logger.error('T{}: error syncing bundle of {} files. Exception: {}'.format(
+                worker_id, len(jobs), ex))
+            return [(JOB_FAILED, 0)] * len(jobs)
+
+    def _register_blocking(self, worker_id, jobs):
+        try:
+            with self._connections() as (source_fs, destfs):
+                return register_unit(worker_id, source_fs, destfs, jobs, self.compare,
+                                     self.minimum_age, self.register)
+        except Exception as ex:
+            logger.error('T{}: error registering {} files. Exception: {}'.format(
+                worker_id, len(jobs), ex))
+            return [(JOB_FAILED, 0)] * len(jobs)
+
+
+ENGINES = {
+    ENGINE_PROCESSES: ProcessEngine,
+    ENGINE_THREADS: ThreadEngine,
+    ENGINE_ASYNCIO: AsyncioEngine
+}
 
-    total_files = len(copy_jobs)
-
-    for job in copy_jobs.values():
-        job_queue.put(job)
-
-    qsize = job_queue.qsize()
-    total_bytes_copied = 0
-    total_files_copied = 0
-
-    error_retries = 0
-    process_id = 0
-    while error_retries < MAX_ERRQUEUE_RETRIES:
-        while qsize > 0:
-            # Show/handle statistics
-            total_bytes_copied, total_files_copied = handle_statistics(
-                ts_start, total_bytes_copied, total_files_copied)
-
-            # Handle finished processes
-            for p in procs:
-                if not p.is_alive():
-                    logger.debug('A copy process has ended')
-                    p.join()
-                    procs.remove(p)
-            # Create copy processes if necessary
-            desired_processes = min([qsize, worker_processes])
-            while len(procs) < desired_processes:
-                procs.append(new_copy_process(process_id))
-                process_id += 1
-            time.sleep(min(MONITOR_INTERVAL, max(qsize//10, 1)))
-            qsize = job_queue.qsize()
-
-        while error_queue.qsize() > 0:
-            logger.debug('Re-queing {}'.format('x'))
-            job_queue.put(error_queue.get())
-        qsize = job_queue.qsize()
-        error_retries += 1
-
-    logger.debug('Wait for copy jobs to finish')
-    errors = 0
-    for t in procs:
-        # the other side of the deadlock
-        # when we reach this point all error_retries have been triggered, anything left in the error_queue is just needed for reporting
-        # however the last run is still ongoing, so we can't just join the children,
-        # the current implementation polls for a maximum of 100sec per thread, and makes sure the error_queue is regularly read and emptied.
+
+def sync(sourcefs, sourcepath, destfs, destpath, sfs_name, sfs_opts, dfs_name, dfs_opts,
+         compareChecksums=False, filelist={}, scan=False, worker_processes=1, excludelist=[],
+         compare=True, minimum_age=0, cs_filters=[], scan_filters=[], streaming=False,
+         batch_files=1, batch_bytes=BATCH_BYTES, schedule=SCHEDULE_FIFO, engine=ENGINE_PROCESSES,
+         max_requests=MAX_REQUESTS, max_bandwidth=0, dest_index=True, scan_threads=1,
+         job_memory=JOB_MEMORY, state=None, bundle=False, register=None,
+         max_connections=MAX_CONNECTIONS):
+    """Sync sourcepath on sourcefs to destpath on destfs using worker_processes
+    parallel sync workers.
+    When streaming is set, the copy jobs are fed to the workers while the source
+    is still being scanned. Otherwise all copy jobs are collected in a JobTable
+    before copying starts. Either way at most JOB_QUEUE_SIZE units are queued
+    or being synced, the next units are read as results come back.
+    Small files are synced in batches of at most batch_files files and
+    batch_bytes bytes. A batch_files value of 1 disables batching.
+    With bundle, the batches are copied as tar archives that the destination
+    extracts by itself, when it supports that, see sync_bundle.
+    With register, the source files are registered in place at destfs
+    instead of copied, see register_unit. register is a (source prefix,
+    physical prefix) pair, see physical_path.
+    schedule determines the order in which the files are synced, see
+    SCHEDULE_FIFO and SCHEDULE_LARGEST_FIRST. The JobTable hands out the jobs
+    in that order, see JobTable.values. Scheduling requires all jobs to be
+    known beforehand, so it is not applied in streaming mode.
+    engine is the name of the engine that runs the workers, see ENGINES, or
+    a SyncEngine instance. An engine instance is left running after the sync,
+    so it can be used for the next sync, or by several syncs at the same time.
+    max_requests is the number of units in flight for the asyncio engine, and
+    max_connections the number of connections per filesystem it uses.
+    max_bandwidth limits the transfer rate in bytes per second, 0 means no limit.
+    When dest_index is set, the destination tree is listed at once, and the
+    workers compare against the listing instead of querying every
+    destination file. Files that are not in the listing are still queried.
+    When checksums are compared, the workers have the destination filesystem
+    compute the checksums missing from the listing, see dest_equal.
+    With scan_threads > 1, the source is scanned by scan_threads threads,
+    each listing directories on its own connection.
+    The copy jobs are kept in a JobTable, which is moved to a temporary
+    file when it takes more than job_memory bytes.
+    state is an optional SyncState. Files that it has verified and that did
+    not change are not synced, and files that are synced are recorded in it.
+    Only files of which the scan gives the size and modification time are
+    recorded and skipped.
+    The workers report the outcome of every job on a result channel of this
+    sync. The coordinator blocks on this channel, and finishes as soon as the
+    last job has been answered.
+    Returns True when all files were synced succesfully
+    """
+    if schedule not in (SCHEDULE_FIFO, SCHEDULE_LARGEST_FIRST):
+        raise ValueError('Unknown schedule {}'.format(schedule))
+    if isinstance(engine, SyncEngine):
+        workers = engine
+    else:
+        workers = ENGINES[engine](sfs_name, sfs_opts, dfs_name, dfs_opts, compare=compare,
+                                  minimum_age=minimum_age, queue_size=JOB_QUEUE_SIZE,
+                                  max_requests=max_requests, max_bandwidth=max_bandwidth,
+                                  bundle=bundle, register=register, workers=worker_processes,
+                                  max_connections=max_connections)
+    channel = workers.open_channel()
+
+    # Units of jobs that are queued or being synced, with the number of times
+    # they have been queued again, by unit id
+    pending = {}
+    # Number of jobs in the pending units
+    pending_jobs = [0]
+    # Failed jobs that have to be queued again, with their number of retries
+    retry_jobs = []
+    stats = {JOB_SYNCED: 0, JOB_FAILED: 0, JOB_SKIPPED: 0, JOB_VERIFIED: 0, 'bytes': 0}
+
+    def manage_workers():
+        workers.check_workers()
+        # Create copy workers if necessary
+        workers.start_workers(min([len(pending), worker_processes]))
+
+    def handle_result(message):
+        _, unit_id, results = message
+        unit, attempt = pending.pop(unit_id, (None, 0))
+        if unit is None:
+            return
+        pending_jobs[0] -= len(unit)
+        # A unit of a worker that ended without reporting it has all
+        # jobs answered as failed
+        if results is None:
+            results = [(JOB_FAILED, 0)] * len(unit)
+        for job, (result, size) in zip(unit, results):
+            if result == JOB_FAILED and attempt < MAX_ERRQUEUE_RETRIES:
+                logger.debug('Re-queing {}'.format(job.source))
+                retry_jobs.append((job, attempt + 1))
+                continue
+            stats[result] += 1
+            stats['bytes'] += size
+            if state and result == JOB_SYNCED:
+                state.record(job, verification(compare, job.compare_checksums))
+
+    def handle_statistics():
+        ts_now = time.time()
+        byterate = stats['bytes']/(ts_now-ts_start)
+        filerate = stats[JOB_SYNCED]/(ts_now-ts_start)
+        timeleft = pending_jobs[0]/filerate if filerate > 0 else 0
+        avg_size = stats['bytes']/stats[JOB_SYNCED] if stats[JOB_SYNCED] > 0 else 0
+        logger.info('QUEUE SIZE : {:6d} COPYRATE: {:4.0f}  BYTERATE: {:5.2f} MB/s  AVG SIZE : {:8.2f} kB  TIME: {:.2f} s  ERRORS : {:6d}'.format(
+            pending_jobs[0], filerate, byterate/(1024*1024), avg_size/1024, timeleft, stats[JOB_FAILED]))
+
+    def wait_for_results(timeout):
+        # Handle the results that are available, waiting at most timeout
+        # seconds for the first one
+        try:
+            handle_result(workers.get(channel, timeout))
+            while True:
+                handle_result(workers.get_nowait(channel))
+        except queue.Empty:
+            pass
+
+    def submit_retries():
+        while retry_jobs:
+            job, attempt = retry_jobs.pop()
+            submit([job], attempt)
+
+    def submit(unit, attempt=0):
+        # Wait for results until there is room for the unit
+        while len(pending) >= JOB_QUEUE_SIZE:
+            manage_workers()
+            wait_for_results(1)
+        unit_id = workers.new_unit_id()
+        pending[unit_id] = (unit, attempt)
+        pending_jobs[0] += len(unit)
+        if len(workers.workers) < worker_processes:
+            manage_workers()
         while True:
-            logger.debug(f"waiting to join {t}")
-            t.join(100)
-            # after timeout check the error queue to prevent deadlock
-            while error_queue.qsize() > 0:
-                error_queue.get()
-                errors += 1
-            if not t.is_alive():
+            try:
+                workers.put(channel, (unit_id, unit), 1)
                 break
+            except queue.Full:
+                wait_for_results(0)
+                manage_workers()
+
+    if not destfs.folderexists(destpath):
+        destfs.mkdir(destpath)
+
+    ts_start = time.time()
+    spf = compile_filter(scan_filters)
+    cpf = compile_filter(cs_filters)
+
+    scan_pool = None
+    walk = None
+    if scan_threads > 1:
+        scan_pool = fsPool(sfs_name, **sfs_opts)
+        walk = functools.partial(parallel_walk, scan_pool, threads=scan_threads)
+
+    if streaming:
+        logger.debug('Stream copy jobs from filelist and source fs')
+        jobs = stream_copyjobs(sourcefs, sourcepath, destfs, destpath,
+                               compareChecksums=compareChecksums, filelist=filelist, scan=scan,
+                               excludelist=excludelist, cs_filter=cpf, scan_filter=spf, walk=walk,
+                               job_memory=job_memory)
+    else:
+        # Enqueue files to copy
+        # copy_jobs is a table with struct { src_filename : CopyJob(src_filename, dst_filename, cmp_checksum, checksum_value, size) }
+        # this ensures all source file will be present only once
+        copy_jobs = JobTable(memory_budget=job_memory, job_type=CopyJob)
+
+        # Start with scanning the source. since here no cs value will be included
+        if scan:
+            logger.debug('Queue copy jobs from source fs')
+            try:
+                queue_copyjobs(sourcefs, sourcepath, destfs, destpath, copy_jobs,
+                               compareChecksums=compareChecksums, excludelist=excludelist, filter=spf,
+                               walk=walk)
+            except Exception as ex:
+                logger.error(f'ERROR queueing jobs for {sourcepath}: {ex}')
+                copy_jobs.close()
+                return False
+            finally:
+                if scan_pool:
+                    scan_pool.cleanup()
+
+        if filelist:
+            logger.debug('Queue copy jobs from filelist')
+            try:
+                queue_copyjobs_from_filelist(filelist, sourcepath, destfs, destpath, copy_jobs,
+                                             compareChecksums=compareChecksums, excludelist=excludelist, filter=cpf)
+            except Exception as ex:
+                logger.debug(f'ERROR queueing jobs for {sourcepath}: {ex}')
+                copy_jobs.close()
+                return False
+        if schedule == SCHEDULE_LARGEST_FIRST:
+            # Predicted from a separate pass over the table, before the
+            # verified files are left out
+            load, total_bytes, unknown = largest_worker_load(
+                batch_copyjobs(copy_jobs.values(largest_first=True), batch_files=batch_files,
+                               batch_bytes=batch_bytes), worker_processes)
+            logger.info('Largest worker load: {:.2f} MB on the busiest of {} workers, ideal {:.2f} MB. '
+                        '{} units of unknown size not included'.format(
+                            load/(1024*1024), worker_processes,
+                            total_bytes/worker_processes/(1024*1024), unknown))
+        jobs = copy_jobs.values(largest_first=schedule == SCHEDULE_LARGEST_FIRST)
 
-    total_bytes_copied, total_files_copied = handle_statistics(
-        ts_start, total_bytes_copied, total_files_copied)
+    def unverified_jobs(jobs):
+        for job in jobs:
+            if state.is_verified(job, verification(compare, job.compare_checksums)):
+                stats[JOB_VERIFIED] += 1
+            else:
+                yield job
+
+    def indexed_jobs(jobs):
+        # The destination is only listed when there is a job left to compare
+        jobs = iter(jobs)
+        for job in jobs:
+            try:
+                index = destfs.lsindex(destpath)
+            except Exception as ex:
+                logger.warning(f'Cannot list destination {destpath}, query files one by one: {ex}')
+                index = None
+            jobs = itertools.chain([job], jobs)
+            if index is None:
+                yield from jobs
+            else:
+                logger.debug('Destination index of {} holds {} files'.format(destpath, len(index)))
+                yield from index_copyjobs(jobs, destpath, index)
+            return
+
+    if state:
+        jobs = unverified_jobs(jobs)
+    if dest_index:
+        jobs = indexed_jobs(jobs)
+
+    if register is not None:
+        jobs = iter(jobs)
+        units = iter(lambda: list(itertools.islice(jobs, REGISTER_BATCH)), [])
+    else:
+        units = batch_copyjobs(jobs, batch_files=batch_files, batch_bytes=batch_bytes)
+    if streaming and schedule != SCHEDULE_FIFO:
+        logger.warning('Schedule {} is ignored in streaming mode'.format(schedule))
+
+    total_files = 0
+    queue_error = False
+
+    # Feed the job queue. In streaming mode the jobs are generated while
+    # feeding, and the copy processes are started as soon as the first job
+    # is available. With JOB_QUEUE_SIZE units pending, the next unit is only
+    # read from the scan or the job table when the workers catch up
+    ts_monitor = time.time() + MONITOR_INTERVAL
+    try:
+        for unit in units:
+            submit(unit)
+            total_files += len(unit)
+            submit_retries()
+            if time.time() > ts_monitor:
+                wait_for_results(0)
+                handle_statistics()
+                ts_monitor = time.time() + MONITOR_INTERVAL
+    except Exception as ex:
+        logger.error(f'ERROR queueing jobs for {sourcepath}: {ex}')
+        queue_error = True
+
+    # Wait for the outcome of all jobs
+    while pending or retry_jobs:
+        submit_retries()
+        manage_workers()
+        wait_for_results(max(ts_monitor - time.time(), 0))
+        if time.time() > ts_monitor:
+            handle_statistics()
+            ts_monitor = time.time() + MONITOR_INTERVAL
+
+    # All jobs are done: stop the copy workers, unless the engine is
+    # owned by the caller
+    if workers is not engine:
+        workers.stop()
+        workers.cleanup()
+    if scan_pool:
+        scan_pool.cleanup()
+    if not streaming:
+        copy_jobs.close()
+    if state:
+        state.commit()
+
+    handle_statistics()
 
     logger.info('Had {} files to sync, handled {}'.format(
-        total_files, total_files_copied))
-    logger.info('Files with sync error: {}'.format(errors))
-    success = (errors == 0) and (total_files_copied == total_files)
+        total_files, stats[JOB_SYNCED]))
+    logger.info('Files with sync error: {}'.format(stats[JOB_FAILED]))
+    if stats[JOB_SKIPPED]:
+        logger.info('Files skipped because of recent changes: {}'.format(stats[JOB_SKIPPED]))
+    if state:
+        logger.info('Files skipped because they were verified before: {}'.format(stats[JOB_VERIFIED]))
+    success = (stats[JOB_FAILED] == 0) and (stats[JOB_SYNCED] == total_files) and not queue_error
 
     return success
 
 
+def index_copyjobs(jobs, destpath, index):
+    """Set the dest_stat of the copy jobs from the destination index, a
+    dict with the FileStat of the files below destpath by relative path
+    """
+    for job in jobs:
+        dest_stat = index.get(os.path.relpath(job.dest, destpath))
+        yield job._replace(dest_stat=dest_stat) if dest_stat is not None else job
+
+
+def batch_copyjobs(jobs, batch_files=1, batch_bytes=BATCH_BYTES):
+    """Group the copy jobs into units of at most batch_files jobs with a
+    cumulative size of at most batch_bytes. Only jobs for files with a known
+    size of at most BATCH_FILE_MAX_SIZE are batched, all other jobs are
+    yielded as a unit by themselves
+    """
+    batch = []
+    batch_size = 0
+    for job in jobs:
+        if batch_files <= 1 or job.size is None or job.size > BATCH_FILE_MAX_SIZE:
+            yield [job]
+            continue
+        if batch and batch_size + job.size > batch_bytes:
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(job)
+        batch_size += job.size
+        if len(batch) >= batch_files:
+            yield batch
+            batch = []
+            batch_size = 0
+    if batch:
+        yield batch
+
+
+def unit_size(unit):
+    """Returns the cumulative size of the jobs in unit, or None if the size
+    of any of the jobs is unknown
+    """
+    sizes = [job.size for job in unit]
+    if None in sizes:
+        return None
+    return sum(sizes)
+
+
+def largest_worker_load(units, workers):
+    """Predict the number of bytes transferred by the busiest worker, when
+    the units are handed out in the given order to the first idle worker.
+    Returns a tuple (load, total_bytes, unknown), where unknown is the
+    number of units of unknown size, that are not included in the prediction
+    """
+    loads = [0] * max(workers, 1)
+    total_bytes = 0
+    unknown = 0
+    for unit in units:
+        size = unit_size(unit)
+        if size is None:
+            unknown += 1
+            continue
+        heapq.heapreplace(loads, loads[0] + size)
+        total_bytes += size
+    return max(loads), total_bytes, unknown
+
+
+def stream_copyjobs(sourcefs, sourcepath, destfs, destpath, compareChecksums=False,
+                    filelist={}, scan=False, excludelist=[], cs_filter=None, scan_filter=None,
+                    walk=None, job_memory=JOB_MEMORY):
+    """Generate the copy jobs for a sync while the source is being scanned.
+    The jobs from the filelist are generated first, since these carry the
+    checksum from the checksum file. Files found by scanning the source are
+    skipped when already generated from the filelist, so every source file
+    is yielded only once
+    """
+    listed = JobTable(memory_budget=job_memory)
+    try:
+        if filelist:
+            for job in iter_copyjobs_from_filelist(filelist, sourcepath, destfs, destpath,
+                                                   compareChecksums=compareChecksums,
+                                                   excludelist=excludelist, filter=cs_filter):
+                listed.add(job)
+                yield job
+        if scan:
+            for job in iter_copyjobs(sourcefs, sourcepath, destfs, destpath,
+                                     compareChecksums=compareChecksums,
+                                     excludelist=excludelist, filter=scan_filter, walk=walk):
+                if job.source not in listed:
+                    yield job
+    finally:
+        listed.close()
+
+
 def queue_copyjobs_from_filelist(filelist, sourcepath, destfs, destpath, copy_jobs,
-                                 compareChecksums=True, excludelist=[], filter=None):
-    dircache = []
+                                 compareChecksums=True, excludelist=[], filter=None,
+                                 create_dirs=True, on_excluded=None):
     copy_counter = 0
+    for job in iter_copyjobs_from_filelist(filelist, sourcepath, destfs, destpath,
+                                           compareChecksums=compareChecksums,
+                                           excludelist=excludelist, filter=filter,
+                                           create_dirs=create_dirs, on_excluded=on_excluded):
+        # Keep the size and modification time of a file found by scanning
+        scanned = copy_jobs.get(job.source)
+        if scanned is not None:
+            job = job._replace(size=scanned.size, mtime=scanned.mtime)
+        copy_jobs[job.source] = job
+        copy_counter += 1
+    return copy_counter
+
 
-    exclude_relist = [re.compile(exclude, re.IGNORECASE)
-                      for exclude in excludelist]
+def iter_copyjobs_from_filelist(filelist, sourcepath, destfs, destpath,
+                                compareChecksums=True, excludelist=[], filter=None,
+                                create_dirs=True, on_excluded=None):
+    # Without create_dirs the destination directories are not created.
+    # on_excluded is called with a WalkEntry for every excluded file
+    dircache = set()
 
-    for filename in filelist:
+    exclude_relist = compile_excludes(excludelist)
+
+    for filename, checksum in filelist.items():
+        src_filename = os.path.join(sourcepath, filename)
         if filter and (not filter.isFileIncluded(filename)):
+            if on_excluded:
+                on_excluded(WalkEntry(src_filename, False, None))
             continue
 
         # Skip files that match one of the exclude patterns
@@ -294,26 +1312,70 @@ def queue_copyjobs_from_filelist(filelist, sourcepath, destfs, destpath, copy_jo
             if exclude_re.match(filename):
                 match = True
         if match:
+            if on_excluded:
+                on_excluded(WalkEntry(src_filename, False, None))
             continue
         #
         destfile = os.path.abspath(os.path.join(destpath, filename))
         destdir = os.path.dirname(destfile)
         # Create the destination directory, if non-existing
-        if not destdir in dircache:
+        if create_dirs and not destdir in dircache:
             if not destfs.folderexists(destdir):
                 destfs.mkdir(destdir)
-            dircache.append(destdir)
+            dircache.add(destdir)
         # Add files to the copy queue
-        src_filename = os.path.join(sourcepath, filename)
-        copy_jobs[src_filename] = (src_filename, destfile,
-                                   compareChecksums, filelist[filename])
-        copy_counter += 1
-    return copy_counter
+        yield CopyJob(src_filename, destfile, compareChecksums, checksum)
+
+
+def compile_excludes(excludelist):
+    """
+    Compiles the exclude patterns, patterns that are compiled already are kept
+    """
+    return [exclude if isinstance(exclude, re.Pattern) else re.compile(exclude, re.IGNORECASE)
+            for exclude in excludelist]
+
+
+def compile_filter(filters):
+    """
+    Returns a CompiledPathFilter for a list of filter rules, or the filter itself
+    if it is a PathFilter already
+    """
+    if isinstance(filters, PathFilter):
+        return filters
+    return CompiledPathFilter(filters)
+
+
+def excludes_tree(exclude_re, reldir):
+    """True when the exclude pattern matches every file path below the
+    relative directory reldir. This is the case when the pattern matches
+    a prefix of 'reldir/', unless it contains an assertion that depends on
+    the characters after the match
+    """
+    if ASSERTION_RE.search(exclude_re.pattern):
+        return False
+    return exclude_re.match(reldir + '/') is not None
 
 
 def queue_copyjobs(sourcefs, sourcebase, destfs, destbase, copy_jobs,
-                   compareChecksums=False, excludelist=[], relpath='', filter=None):
+                   compareChecksums=False, excludelist=[], relpath='', filter=None, walk=None,
+                   create_dirs=True, on_excluded=None):
+    copy_counter = 0
+    for job in iter_copyjobs(sourcefs, sourcebase, destfs, destbase,
+                             compareChecksums=compareChecksums, excludelist=excludelist,
+                             relpath=relpath, filter=filter, walk=walk,
+                             create_dirs=create_dirs, on_excluded=on_excluded):
+        copy_jobs[job.source] = job
+        copy_counter += 1
+    return copy_counter
 
+
+def iter_copyjobs(sourcefs, sourcebase, destfs, destbase,
+                  compareChecksums=False, excludelist=[], relpath='', filter=None, walk=None,
+                  create_dirs=True, on_excluded=None):
+    # walk is a function that walks the tree below a path on the source,
+    # sourcefs.walk by default. Without create_dirs the destination
+    # directories are not created. on_excluded is called with the WalkEntry
+    # of every excluded file, and of every directory that is not scanned
     #
     # PATH variable example
     #
@@ -328,44 +1390,54 @@ def queue_copyjobs(sourcefs, sourcebase, destfs, destbase, copy_jobs,
     # |                                                                  |           relfilepath                      |
     # |                                        destdir                              |
 
-    dircache = []
-    copy_counter = 0
+    dircache = set()
 
-    exclude_relist = [re.compile(exclude, re.IGNORECASE)
-                      for exclude in excludelist]
+    exclude_relist = compile_excludes(excludelist)
 
     sourcepath = os.path.join(sourcebase, relpath)
 
     # I guess only intorods knows what the base directory was sync is called for.
     #parentdir = sourcebase.split(os.sep)[-1]
 
-    for entry in sourcefs.lsdirnames(sourcepath):
-        relsubdir = os.path.join(relpath, entry)
-        copy_counter += queue_copyjobs(sourcefs, sourcebase, destfs, destbase, copy_jobs,
-                                       compareChecksums=compareChecksums, excludelist=excludelist, relpath=relsubdir, filter=filter)
+    def prune(dirpath):
+        # Skip directories in which no file can be included
+        reldir = os.path.relpath(dirpath, sourcebase)
+        if (filter and filter.isTreeExcluded(reldir)) or \
+                any(excludes_tree(exclude_re, reldir) for exclude_re in exclude_relist):
+            logger.debug('Skipping excluded directory {}'.format(dirpath))
+            if on_excluded:
+                on_excluded(WalkEntry(dirpath, True, None))
+            return True
+        return False
 
-    for entry in sourcefs.lsfilenames(sourcepath):
+    # walk provides the size of every file, so files are not queried one by one
+    for entry in (walk or sourcefs.walk)(sourcepath, prune=prune):
+        if entry.isdir:
+            continue
 
-        relfilepath = os.path.join(relpath, entry)
+        relfilepath = os.path.relpath(entry.path, sourcebase)
         # Skip files that match one of the exclude patterns
         if filter and (not filter.isFileIncluded(relfilepath)):
+            if on_excluded:
+                on_excluded(entry)
             continue
         match = False
         for exclude_re in exclude_relist:
             if exclude_re.match(relfilepath):
                 match = True
         if match:
+            if on_excluded:
+                on_excluded(entry)
             continue
 
-        destdir = os.path.join(destbase, relpath).rstrip('/')
-        if not destdir in dircache:
+        destdir = os.path.dirname(os.path.join(destbase, relfilepath)).rstrip('/')
+        if create_dirs and not destdir in dircache:
             if not destfs.folderexists(destdir):
                 destfs.mkdir(destdir, parents=True)
-            dircache.append(destdir)
+            dircache.add(destdir)
 
         src_filename = os.path.join(sourcebase, relfilepath)
-        copy_jobs[src_filename] = (src_filename, os.path.join(
-            destbase, relfilepath), compareChecksums, None)
-        copy_counter += 1
-
-    return copy_counter
+        # A file without stat is queried, and fails, in the worker
+        size, mtime = (entry.stat.size, entry.stat.mtime) if entry.stat else (None, None)
+        yield CopyJob(src_filename, os.path.join(destbase, relfilepath), compareChecksums, None,
+                      size, mtime)
@@ -1,7 +1,11 @@
+import functools
 import json
+import logging
 import os
 import re
 
+logger = logging.getLogger(__name__)
+
 
 # returns number of non-empty path components
 def path_length( path ):
@@ -97,6 +101,22 @@ class PathFilter:
             include = entry[0]
         return include
 
+    # /path/to/directory
+    # True when no file in the directory or below it can be included, so
+    # the directory does not need to be listed
+    def isTreeExcluded( self, path ):
+        if self.isDirIncluded( path ):
+            return False
+        npath = os.path.normpath( path )
+        #an include rule below the directory can include files again
+        for entry in self._dir_filter:
+            if entry[0] and self.is_a_subpath( entry[1], npath ) != None:
+                return False
+        for fpath in self._file_filter_include:
+            if self.is_a_subpath( fpath, npath ) != None:
+                return False
+        return True
+
     # /path/to/filename.txt
     def isFileIncluded( self, path_and_file ):
         ncand = os.path.normpath( path_and_file )
@@ -127,3 +147,113 @@ class PathFilter:
             print( f"WARN: multiple matches for path: '{path_and_file}'")
         return includeFile
 
+
+
+# Number of directories for which the decisions are cached
+DIR_CACHE_SIZE = 65536
+
+
+class CompiledPathFilter(PathFilter):
+    """PathFilter with the same results, that is faster for many rules and
+    files. The dir rules are stored in a prefix trie, the decisions are
+    cached per directory and the file rules of a directory are merged into
+    a single regex for the includes and one for the excludes.
+    """
+
+    def __init__(self, filter):
+        super().__init__(filter)
+        # Trie of the dir rules. Every node is a dict of child nodes by path
+        # component, with the rules for the path of the node under the key
+        # None, as (index, include) tuples in the order of the filter
+        self._trie = {}
+        # The '/' rules match every path
+        self._root_rules = []
+        for index, (include, fpath) in enumerate(self._dir_filter):
+            if fpath == '/':
+                self._root_rules.append((index, include))
+                continue
+            node = self._trie
+            for part in self._split(fpath):
+                node = node.setdefault(part, {})
+            node.setdefault(None, []).append((index, include))
+        self._include_re = {path: self._merge(entries) for path, entries in self._file_filter_include.items()}
+        self._exclude_re = {path: self._merge(entries) for path, entries in self._file_filter_exclude.items()}
+        self._dir_included = functools.lru_cache(maxsize=DIR_CACHE_SIZE)(self._nearest_include)
+        self._file_rules = functools.lru_cache(maxsize=DIR_CACHE_SIZE)(self._dir_file_rules)
+
+    @staticmethod
+    def _split(npath):
+        # The leading slashes of a normalized path are the first component,
+        # since '/A' and '//A' are different paths for PathFilter
+        root = npath[:len(npath) - len(npath.lstrip('/'))]
+        return [root] + [p for p in npath.split('/') if p]
+
+    @staticmethod
+    def _merge(entries):
+        # Merge the regexes of the entries into a single alternation. Regexes
+        # with groups are kept apart, their group numbers would change
+        regexes = [entry[2] for entry in entries]
+        if all(regex.groups == 0 for regex in regexes):
+            try:
+                return [re.compile('|'.join('(?:{})'.format(regex.pattern) for regex in regexes),
+                                   re.IGNORECASE)]
+            except re.error:
+                pass
+        return regexes
+
+    def _nearest_include(self, path):
+        # The rule with the lowest score wins, the first one in the filter
+        # when several rules have the same score
+        parts = self._split(os.path.normpath(path))
+        depth = len(parts) - 1
+        best = None
+        node = self._trie.get(parts[0])
+        for level, part in enumerate(parts[1:], 1):
+            if node is None:
+                break
+            node = node.get(part)
+            if node is not None and None in node:
+                index, include = node[None][0]
+                best = (depth - level, index, include)
+        if depth == 0 and node is not None and None in node:
+            # A rule for a path of slashes only matches that path itself
+            index, include = node[None][0]
+            best = (0, index, include)
+        if self._root_rules:
+            index, include = self._root_rules[0]
+            if best is None or (depth, index) < best[:2]:
+                best = (depth, index, include)
+        return True if best is None else best[2]
+
+    def _dir_file_rules(self, path):
+        return (self._dir_included(path),
+                self._include_re.get(path, []), self._exclude_re.get(path, []),
+                len(self._file_filter_include.get(path, [])) + len(self._file_filter_exclude.get(path, [])))
+
+    # /path/to/directory
+    def isDirIncluded( self, path ):
+        return self._dir_included( path )
+
+    # /path/to/filename.txt
+    def isFileIncluded( self, path_and_file ):
+        path, filename = os.path.split( path_and_file )
+        if not path:
+            path = os.sep
+        if not filename:
+            logger.warning( f"path '{path_and_file}' doesn't contain a filename" )
+            return False
+
+        includeFile, inFilter, exFilter, rules = self._file_rules( path )
+        included = any( regex.match( filename ) for regex in inFilter )
+        excluded = any( regex.match( filename ) for regex in exFilter )
+        if rules > 1 and ( included or excluded ):
+            # The rules are counted one by one for the warning only
+            matches = sum( 1 for entry in self._file_filter_include.get( path, [] ) + self._file_filter_exclude.get( path, [] )
+                           if entry[2].match( filename ) )
+            if matches > 1:
+                logger.warning( f"multiple matches for path: '{path_and_file}'" )
+        if excluded:
+            return False
+        if included:
+            return True
+        return includeFile
@@ -15,10 +15,11 @@ import os
 import re
 import sys
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import irods.exception as ex
 import yaml
-from jsonschema import ValidationError, validate
+from jsonschema import ValidationError
 
 import intorods.filesys.fs_ftp
 import intorods.filesys.fs_irods
@@ -27,9 +28,18 @@ import intorods.filesys.fs_scp
 import intorods.filesys.fs_sftp
 
 from .filesys.fs_base import factory
+from .filesys.jobtable import JOB_MEMORY, ChecksumList
+from .filesys.plan import plan_sync, write_plan
+from .filesys.statedb import SyncState
 from .filesys.fs_smb import wintoux
 from .filesys.loghandlers import log_to_stdout, log_to_syslog
-from .filesys.sync import sync
+from .filesys.sync import (BATCH_BYTES, ENGINE_PROCESSES, ENGINES, JOB_QUEUE_SIZE,
+                           MAX_CONNECTIONS, MAX_REQUESTS, SCHEDULE_FIFO, SCHEDULE_LARGEST_FIRST, compile_excludes,
+                           sync)
+from .filesys.yml_filter import CompiledPathFilter
+from .manifest import (FILE_FORMAT_BASECLEAR, FILE_FORMAT_GENERIC_JSON, FILE_FORMAT_TEXT,
+                       MANIFEST_PARSERS, MANIFEST_RECORDS, ManifestError, ManifestValidator,
+                       iter_manifest, manifest_validator)
 
 logger = logging.getLogger(None)
 for _ in ("irods.connection", "irods.manager.metadata_manager", "irods.message", "irods.pool", 
@@ -37,13 +47,8 @@ for _ in ("irods.connection", "irods.manager.metadata_manager", "irods.message",
     logging.getLogger(_).disabled = True
 logger.setLevel(logging.WARNING)
 
-FILE_FORMAT_TEXT = 'text'
-
-#the baseclear format
-FILE_FORMAT_BASECLEAR = 'baseclear'
 BASECLEAR_SCHEMA_FILE = 'schemas/baseclear_checksum_file_schema.json'
 
-FILE_FORMAT_GENERIC_JSON = 'generic'
 GENERIC_JSON_SCHEMA_FILE = 'schemas/pipeline_output_schema.json'
 
 METADATA_TEMPLATE = {
@@ -81,17 +86,53 @@ def parse_extra_options(options):
     return outp
 
 
-def parse_checksum_file(fs_source, folder, abs_or_rel_checksumfile, file_format, json_schema):
+def load_filter_file(filter_file):
+    """
+    Returns the filter rules from a yaml filter file, an empty list without file
+    """
+    if not filter_file:
+        return []
+    with open(filter_file, 'r') as f:
+        data = yaml.safe_load(f)
+        return data.get("filter", [])
+
+
+class SelectionConfig():
     """
-        returns a dictionary, containing complete/path/to/file --> hash-value
+    The file and folder selection of a run: the compiled filters from the filter
+    files, the exclude patterns, the folder pattern and the validator of the
+    checksum file schema. It is built once and shared by all folders
+    """
+
+    def __init__(self, cs_filter_file='', scan_filter_file='', excludelist=[], pattern='',
+                 checksumfileformat='', checksumfileschema=''):
+        self.cs_filter = CompiledPathFilter(load_filter_file(cs_filter_file))
+        self.scan_filter = CompiledPathFilter(load_filter_file(scan_filter_file))
+        self.excludes = compile_excludes(excludelist)
+        self.pattern = re.compile(pattern + '$', re.IGNORECASE) if pattern else None
+        # The (optional) schema definition is global, and should be read and parsed only once,
+        # checksumfileschema is set by default.
+        self.validator = None
+        if checksumfileformat in [FILE_FORMAT_BASECLEAR, FILE_FORMAT_GENERIC_JSON]:
+            with open(checksumfileschema) as f:
+                self.validator = ManifestValidator(json.load(f), MANIFEST_RECORDS[checksumfileformat])
+
+
+def parse_checksum_file(fs_source, folder, abs_or_rel_checksumfile, file_format, json_schema,
+                        memory_budget=JOB_MEMORY):
+    """
+        returns a ChecksumList, containing complete/path/to/file --> hash-value
+        it is moved to a temporary file when it takes more than memory_budget bytes
         returns None to indicate to caller the checksumfile is missing / invalid, either abort or continue with next folder...
+        json_schema is the schema of the json formats, or a ManifestValidator for it
+        the checksumfile is read record by record, and may be compressed with gzip or zstd
         
     """
     if not abs_or_rel_checksumfile.startswith('/'):
         checksumfile = os.path.join(folder.path, abs_or_rel_checksumfile)
     else:
         checksumfile = abs_or_rel_checksumfile
-    cslist = {}
+    cslist = ChecksumList(memory_budget=memory_budget)
     logger.debug('Searching checksums-file %s' % checksumfile)
     csfile_list = fs_source.glob(checksumfile)
     if not 1 == len(csfile_list):
@@ -114,79 +155,28 @@ def parse_checksum_file(fs_source, folder, abs_or_rel_checksumfile, file_format,
     # checksumfile /dir1/dir2/subdir/checksums
     if not rel_csfile_name.startswith('..'):
         cslist[wintoux(rel_csfile_name)] = None
-    #depending on file format, change behavior....
-    if file_format == FILE_FORMAT_TEXT:
-        with csfile.open('r') as fh:
-            lines = fh.readlines()
-            for line in lines:
-                if not type(line) is str:
-                    line = line.decode('utf-8')
-                hashvalue, filename = line.rstrip().split('  ')
-                cslist[wintoux(filename)] = hashvalue
-        return cslist
-
-    elif file_format == FILE_FORMAT_GENERIC_JSON:
-        with csfile.open('r') as fh:
-            csf_content = json.load(fh)
-            try:
-                validate(instance=csf_content, schema=json_schema)
-            except ValidationError as ex:
-                logger.error("ERROR validating checksumfile '{}' threw: '{}'".format(
-                    checksumfilepath, ex.message))
-                return None
-            #parse content
-            for data_object in csf_content['objects']:
-                hashvalue = data_object['checksum']
-                filepath = wintoux(data_object['path'])
-                objtype = data_object['type']
-                if objtype != 'dataobject':
-                    continue
-                if filepath in cslist:
-                    logger.error(
-                        "ERROR parsing checksumfile '{}' is referenced multiple times".format(filepath))
-                    return None
-                #further sanity checks?
-                cslist[filepath] = hashvalue
-        return cslist
-
-    elif file_format == FILE_FORMAT_BASECLEAR:
-        #magic string, sub directory the actual seqencer files are contained (within further directory structures)
-        #Better would be to define this folder in a field of the json-file
-        #TODO: once BaseClear abides by the new format, remove magic strings and use always path-property
-        SEQUENCE_FILE_DIR = 'raw_sequences'
-        #validate against schema definition
-        with csfile.open('r') as fh:
-            csf_content = json.load(fh)
-            try:
-                validate(instance=csf_content, schema=json_schema)
-            except ValidationError as ex:
-                logger.error("ERROR validating checksumfile '{}' threw: '{}'".format(
-                    checksumfilepath, ex.message))
-                return None
-            #parse content
-            for sample in csf_content['samples']:
-                flowcellid = sample['flowcellid']
-                for pair in sample['pairs']:
-                    if 'path' in pair.keys():
-                        path = pair['path']
-                    else:
-                        path = os.path.join(SEQUENCE_FILE_DIR, flowcellid)
-                    hashvalue = pair['checksum']
-                    filename = pair['filename']
-                    filepath = os.path.join(path, filename)
-                    ux_filepath = wintoux(filepath)
-                    if ux_filepath in cslist:
-                        logger.error("ERROR parsing checksumfile '{}', file: '{}' is referenced multiple times".format(
-                            checksumfilepath, ux_filepath))
-                        return None
-                    #further sanity checks?
-                    cslist[ux_filepath] = hashvalue
-        return cslist
-    else:
+    if file_format not in MANIFEST_PARSERS:
         logger.error('Unknown file format "%s" for checksum file!' %
                      file_format)
         return None
-
+    try:
+        validator = manifest_validator(json_schema, file_format)
+        with csfile.open('rb') as fh:
+            for filepath, hashvalue in iter_manifest(fh, file_format, validator):
+                ux_filepath = wintoux(filepath)
+                if file_format != FILE_FORMAT_TEXT and ux_filepath in cslist:
+                    logger.error("ERROR parsing checksumfile '{}', file: '{}' is referenced multiple times".format(
+                        checksumfilepath, ux_filepath))
+                    return None
+                cslist[ux_filepath] = hashvalue
+    except ValidationError as ex:
+        logger.error("ERROR validating checksumfile '{}' threw: '{}'".format(
+            checksumfilepath, ex.message))
+        return None
+    except ManifestError as ex:
+        logger.error("ERROR parsing checksumfile '{}': {}".format(checksumfilepath, ex))
+        return None
+    return cslist
 
 def resolve_meta_template(value, sourcefolder, destfolder):
     """Replace template variables in metadata:
@@ -224,7 +214,21 @@ def sync_folder(fs_source, folder, fs_dest, destfolder, objdfolder,
                 minimum_age,
                 cs_filters,
                 scan_filters,
-                scan):
+                scan,
+                streaming=False,
+                batch_files=1,
+                batch_bytes=BATCH_BYTES,
+                schedule=SCHEDULE_FIFO,
+                engine=ENGINE_PROCESSES,
+                max_requests=MAX_REQUESTS,
+                max_connections=MAX_CONNECTIONS,
+                max_bandwidth=0,
+                dest_index=True,
+                scan_threads=1,
+                job_memory=JOB_MEMORY,
+                state=None,
+                bundle=False,
+                register=None):
     logger.debug('Replicating to irods folder {}'.format(objdfolder.path))
     syncresult = sync(fs_source, folder.path, fs_dest, destfolder,
                       sfs_name, sfs_opts, dfs_name, dfs_opts,
@@ -235,7 +239,21 @@ def sync_folder(fs_source, folder, fs_dest, destfolder, objdfolder,
                       minimum_age=minimum_age,
                       scan_filters=scan_filters,
                       cs_filters=cs_filters,
-                      scan=scan)
+                      scan=scan,
+                      streaming=streaming,
+                      batch_files=batch_files,
+                      batch_bytes=batch_bytes,
+                      schedule=schedule,
+                      engine=engine,
+                      max_requests=max_requests,
+                      max_connections=max_connections,
+                      max_bandwidth=max_bandwidth,
+                      dest_index=dest_index,
+                      scan_threads=scan_threads,
+                      job_memory=job_memory,
+                      state=state,
+                      bundle=bundle,
+                      register=register)
     if syncresult:
         logger.info('Folders are EQUAL')
         # Add metadata from metadata list
@@ -260,7 +278,24 @@ def replicate_data_folder(sfs_name, sfs_opts, dfs_name, dfs_opts,
                           minimum_age=None,
                           cs_filter_file='',
                           scan=False,
-                          scan_filter_file=''):
+                          scan_filter_file='',
+                          streaming=False,
+                          batch_files=1,
+                          batch_bytes=BATCH_BYTES,
+                          schedule=SCHEDULE_FIFO,
+                          engine=ENGINE_PROCESSES,
+                          max_requests=MAX_REQUESTS,
+                          max_connections=MAX_CONNECTIONS,
+                          max_bandwidth=0,
+                          parallel_folders=1,
+                          dest_index=True,
+                          scan_threads=1,
+                          job_memory=JOB_MEMORY,
+                          state_db=None,
+                          plan_file=None,
+                          plan_throughput=0,
+                          bundle=False,
+                          register=None):
     """Replicate a data folder from source filesystem to destination 
     file system by iterating over the direct subfolders of the given
     sourcepath and syncing them piecewise.
@@ -309,15 +344,45 @@ def replicate_data_folder(sfs_name, sfs_opts, dfs_name, dfs_opts,
             directories before starting sync.
         copy_procs: Integer, number of processes to use for parallel file
             transfer.
+        streaming: Start copying while the source folder is still being scanned.
+        batch_files: Maximum number of small files synced as one unit.
+        batch_bytes: Maximum cumulative size of a batch of small files.
+        schedule: Order in which files are synced, by discovery or largest first.
+        engine: Run the copy workers as processes, threads or asyncio tasks.
+            The workers are started once and used for all folders.
+        max_requests: Number of units of files in flight for the asyncio engine.
+        max_connections: Number of connections per filesystem of the asyncio engine.
+        max_bandwidth: Maximum transfer rate of all workers together, in bytes
+            per second. 0 means no limit.
+        parallel_folders: Number of folders synced at the same time. The folders
+            share the copy workers and the bandwidth, and every folder gets its
+            metadata as soon as it is done.
+        dest_index: List each destination folder at once, instead of querying
+            the destination files one by one.
+        scan_threads: Number of threads listing source directories at the same time.
+        job_memory: Memory in bytes for the copy jobs and checksums of a folder,
+            beyond which they are moved to a temporary SQLite file.
+        state_db: Path of the SQLite state database. Unchanged files that an earlier
+            run has verified are not synced again.
+        plan_file: Do not sync, but write what would be synced to this JSON file.
+        plan_throughput: Transfer rate in bytes per second for the duration estimate
+            of the plan. 0 measures it by reading a file from the source.
+        bundle: Copy the batches of small files as tar archives that the destination
+            extracts by itself.
+        register: Register the source files in place instead of copying them, as a
+            (source prefix, physical prefix) pair mapping the source paths to the paths
+            on the resource server. None copies the files.
+
+    Returns:
+        True when all selected folders were synced, also in a plan. An exception
+        of a folder synced in the background is raised after the selection.
     """
 
-    # The (optional) schema definition is global, and should be read and parsed only once,
-    # checksumfileschema is set by default.
-    if checksumfileformat in [FILE_FORMAT_BASECLEAR, FILE_FORMAT_GENERIC_JSON]:
-        with open(checksumfileschema) as f:
-            JSON_SCHEMA = json.load(f)
-    else:
-        JSON_SCHEMA = None
+    # The filters, excludes, pattern and schema are the same for all folders,
+    # so they are loaded and compiled only once
+    selection = SelectionConfig(cs_filter_file, scan_filter_file, excludelist, pattern,
+                                checksumfileformat, checksumfileschema)
+    state = SyncState(state_db) if state_db else None
 
     # Check all the remote data folders for first level subfolders
     logger.debug('Replicate %s to %s' % (sourcepath, destpath))
@@ -325,6 +390,76 @@ def replicate_data_folder(sfs_name, sfs_opts, dfs_name, dfs_opts,
     fs_source = factory.createfs(sfs_name, **sfs_opts)
     fs_dest = factory.createfs(dfs_name, **dfs_opts)
 
+    # The copy workers and their connections are kept alive for all folders
+    sync_engine = None
+    if not plan_file:
+        sync_engine = ENGINES[engine](sfs_name, sfs_opts, dfs_name, dfs_opts,
+                                      compare=compare, minimum_age=minimum_age,
+                                      queue_size=JOB_QUEUE_SIZE,
+                                      max_requests=max_requests,
+                                      max_bandwidth=max_bandwidth,
+                                      bundle=bundle,
+                                      register=register,
+                                      workers=copy_procs,
+                                      max_connections=max_connections)
+    # The plans of the folders, as (source, destination, totals)
+    plans = []
+
+    def run_plan(fs_source, folder, fs_dest, destfolder, cslist):
+        return plan_sync(fs_source, folder.path, fs_dest, destfolder,
+                         compareChecksums=compareChecksums, filelist=cslist, scan=scan,
+                         excludelist=selection.excludes, compare=compare,
+                         cs_filters=selection.cs_filter, scan_filters=selection.scan_filter,
+                         dest_index=dest_index, job_memory=job_memory, state=state)
+
+    def run_sync(fs_source, folder, fs_dest, destfolder, objdfolder, cslist):
+        return sync_folder(fs_source, folder, fs_dest, destfolder, objdfolder,
+                           sfs_name, sfs_opts, dfs_name, dfs_opts,
+                           compareChecksums,
+                           cslist,
+                           metadata,
+                           copy_procs,
+                           selection.excludes,
+                           compare,
+                           minimum_age,
+                           selection.cs_filter,
+                           selection.scan_filter,
+                           scan,
+                           streaming=streaming,
+                           batch_files=batch_files,
+                           batch_bytes=batch_bytes,
+                           schedule=schedule,
+                           engine=sync_engine,
+                           max_requests=max_requests,
+                           max_connections=max_connections,
+                           dest_index=dest_index,
+                           scan_threads=scan_threads,
+                           job_memory=job_memory,
+                           state=state,
+                           bundle=bundle,
+                           register=register)
+
+    def run_concurrent_sync(folder, destfolder, cslist):
+        # Concurrent syncs do not share filesystem connections, every
+        # sync uses its own ones
+        folder_source = factory.createfs(sfs_name, **sfs_opts)
+        folder_dest = factory.createfs(dfs_name, **dfs_opts)
+        try:
+            return run_sync(folder_source, folder, folder_dest, destfolder,
+                            folder_dest.getfolder(destfolder), cslist)
+        except Exception as e:
+            logger.error('SYNC FAILED for folder {}: {}'.format(folder.path, e))
+            return False
+        finally:
+            folder_source.cleanup()
+            folder_dest.cleanup()
+
+    # With parallel_folders > 1, the selected folders are synced in the
+    # background while the selection continues
+    folder_executor = ThreadPoolExecutor(parallel_folders) if parallel_folders > 1 and not plan_file else None
+    # The results of the folder syncs, futures for the background ones
+    results = []
+
     """
     Skip skip_subdirs subdirs, to handle minion data export
     """
@@ -342,131 +477,133 @@ def replicate_data_folder(sfs_name, sfs_opts, dfs_name, dfs_opts,
                 dirs = dirs + folderlist(fs, subfolder.path, levels-1)
         return dirs
 
-    for folder in folderlist(fs_source, sourcepath, levels=skip_subdirs):
-        logger.debug("Process folder %s" % folder.path)
-        if pattern:
-            rePattern = re.compile(pattern + '$', re.IGNORECASE)
-            if not rePattern.match(folder.shortname()):
-                logger.debug('Folder %s does not match pattern %s' %
-                             (folder.shortname(), pattern))
-                continue
-        if flagfile:
-            # Note: flagfile may contain wildcards!
-            # List files matching the 'flagfile' pattern,
-            # determine the age of the newest one
-            # and check against flag_age
-            myflagfile = os.path.join(folder.path, flagfile)
-            flagfile_list = fs_source.glob(myflagfile)
-            min_age = 1E10
-            if not flagfile_list:
-                logger.debug('Cannot find flagfile %s' % myflagfile)
-                continue
-            for ff in flagfile_list:
-                age = int(time.time() - fs_source.getfile(ff).utc_mtime())
-                min_age = min(min_age, age)
-            if min_age < flag_age:
-                logger.info('Flag file(s) too new. Age is {}, min age is {}'.format(
-                    min_age, flag_age))
-                continue
-
-        if minage > 0 or maxage < 999999999:
-            logger.debug('Checking folder age {} - {}'.format(minage, maxage))
-            folderage = int(time.time()) - fs_source.foldermtime(folder.path)
-            logger.debug('Remote folder age is {} s'.format(folderage))
-            if minage > 0:
-                if folderage < minage:
-                    logger.info('Recent changes - skipping folder')
+    # The folder syncs, the workers and the state are also stopped when a folder raises
+    try:
+        for folder in folderlist(fs_source, sourcepath, levels=skip_subdirs):
+            logger.debug("Process folder %s" % folder.path)
+            if selection.pattern:
+                if not selection.pattern.match(folder.shortname()):
+                    logger.debug('Folder %s does not match pattern %s' %
+                                 (folder.shortname(), pattern))
+                    continue
+            if flagfile:
+                # Note: flagfile may contain wildcards!
+                # List files matching the 'flagfile' pattern,
+                # determine the age of the newest one
+                # and check against flag_age
+                myflagfile = os.path.join(folder.path, flagfile)
+                flagfile_list = fs_source.glob(myflagfile)
+                min_age = 1E10
+                if not flagfile_list:
+                    logger.debug('Cannot find flagfile %s' % myflagfile)
+                    continue
+                for ff in flagfile_list:
+                    age = int(time.time() - fs_source.getfile(ff).utc_mtime())
+                    min_age = min(min_age, age)
+                if min_age < flag_age:
+                    logger.info('Flag file(s) too new. Age is {}, min age is {}'.format(
+                        min_age, flag_age))
                     continue
-            if folderage > maxage:
-                logger.info('Folder too old : %s - skipping' %
-                            formattime(folderage))
-                continue
-
-        cslist = {}
-        if checksumfile:
-            cslist = parse_checksum_file(
-                fs_source, folder, checksumfile, checksumfileformat, JSON_SCHEMA)
-            if not cslist:
-                continue
-
-        destfolder = os.path.join(destpath, folder.shortname())
-        if not fs_dest.folderexists(destfolder):
-            fs_dest.mkdir(destfolder)
 
-        objdfolder = fs_dest.getfolder(destfolder)
-        sync_this_folder = True
+            if minage > 0 or maxage < 999999999:
+                logger.debug('Checking folder age {} - {}'.format(minage, maxage))
+                folderage = int(time.time()) - fs_source.foldermtime(folder.path)
+                logger.debug('Remote folder age is {} s'.format(folderage))
+                if minage > 0:
+                    if folderage < minage:
+                        logger.info('Recent changes - skipping folder')
+                        continue
+                if folderage > maxage:
+                    logger.info('Folder too old : %s - skipping' %
+                                formattime(folderage))
+                    continue
 
-        # Check timestamps on destination folder:
-        if timestamp_list:
-            logger.debug(
-                'Verifying required timestamps on {}'.format(objdfolder.path))
-            now = int(time.time())
-            for t in timestamp_list:
-                try:
-                    v_str = objdfolder.getmeta(t)
-                    v = float(v_str)
-                except KeyError:
-                    logger.error('timestamp attr {} missing on folder {}'.format(
-                        t, objdfolder.path))
-                    sync_this_folder = False
-                    break
-                except ValueError:
-                    logger.error('timestamp attr {} on folder {} has invalid value {}'.format(
-                        t, objdfolder.path, v_str))
-                    sync_this_folder = False
-                    break
-                if now < (int(v) + int(timestamp_list[t])):
-                    logger.info('timestamp attr {} on folder {} too new. Wait {} seconds'.format(
-                        t, objdfolder.path, int(v)+int(timestamp_list[t])-now))
-                    sync_this_folder = False
-                    break
-
-        # Params completion_avu determines copy selection
-        # behaviour:
-        # completion_avu == None: no check for completion attribute will be done
-        #   when selecting folders to copy
-        # completion_avu != None:
-        #   only folders where completion_avu is not present will be copied
-
-        if completion_avu and sync_this_folder:
-            sync_this_folder = not test_completion_avu(
-                objdfolder, completion_avu)
-            if not sync_this_folder:
+            cslist = {}
+            if checksumfile:
+                cslist = parse_checksum_file(
+                    fs_source, folder, checksumfile, checksumfileformat, selection.validator,
+                    memory_budget=job_memory)
+                if not cslist:
+                    continue
+
+            destfolder = os.path.join(destpath, folder.shortname())
+            if fs_dest.folderexists(destfolder):
+                objdfolder = fs_dest.getfolder(destfolder)
+            elif plan_file:
+                # A plan does not create the destination folder
+                objdfolder = None
+            else:
+                fs_dest.mkdir(destfolder)
+                objdfolder = fs_dest.getfolder(destfolder)
+            sync_this_folder = True
+
+            # Check timestamps on destination folder:
+            if timestamp_list and objdfolder is None:
+                logger.error('timestamp attrs missing on folder {}, it does not exist'.format(destfolder))
+                sync_this_folder = False
+            elif timestamp_list:
                 logger.debug(
-                    'Import for folder %s already marked complete' % folder.path)
-
-        # Load the content of the filter files
-        cs_filters = []
-        if cs_filter_file:
-            with open(cs_filter_file, 'r') as f:
-                data = yaml.safe_load(f)
-                cs_filters = data.get("filter", [])
-
-        scan_filters = []
-        if scan_filter_file:
-            with open(scan_filter_file, 'r') as f:
-                data = yaml.safe_load(f)
-                scan_filters = data.get("filter", [])
-
-        logger.info(f"Sync this folder: {folder.path}")
-
-        if sync_this_folder:
-            sync_folder(fs_source, folder, fs_dest, destfolder, objdfolder,
-                        sfs_name, sfs_opts, dfs_name, dfs_opts,
-                        compareChecksums,
-                        cslist,
-                        metadata,
-                        copy_procs,
-                        excludelist,
-                        compare,
-                        minimum_age,
-                        cs_filters,
-                        scan_filters,
-                        scan)
-            # SYNC might take a long time:
-            # so refresh the connections
-            fs_source.refresh()
-            fs_dest.refresh()
+                    'Verifying required timestamps on {}'.format(objdfolder.path))
+                now = int(time.time())
+                for t in timestamp_list:
+                    try:
+                        v_str = objdfolder.getmeta(t)
+                        v = float(v_str)
+                    except KeyError:
+                        logger.error('timestamp attr {} missing on folder {}'.format(
+                            t, objdfolder.path))
+                        sync_this_folder = False
+                        break
+                    except ValueError:
+                        logger.error('timestamp attr {} on folder {} has invalid value {}'.format(
+                            t, objdfolder.path, v_str))
+                        sync_this_folder = False
+                        break
+                    if now < (int(v) + int(timestamp_list[t])):
+                        logger.info('timestamp attr {} on folder {} too new. Wait {} seconds'.format(
+                            t, objdfolder.path, int(v)+int(timestamp_list[t])-now))
+                        sync_this_folder = False
+                        break
+
+            # Params completion_avu determines copy selection
+            # behaviour:
+            # completion_avu == None: no check for completion attribute will be done
+            #   when selecting folders to copy
+            # completion_avu != None:
+            #   only folders where completion_avu is not present will be copied
+
+            if completion_avu and sync_this_folder and objdfolder is not None:
+                sync_this_folder = not test_completion_avu(
+                    objdfolder, completion_avu)
+                if not sync_this_folder:
+                    logger.debug(
+                        'Import for folder %s already marked complete' % folder.path)
+
+            logger.info(f"Sync this folder: {folder.path}")
+
+            if sync_this_folder and plan_file:
+                plans.append((folder.path, destfolder, run_plan(fs_source, folder, fs_dest, destfolder, cslist)))
+            elif sync_this_folder and folder_executor:
+                results.append(folder_executor.submit(run_concurrent_sync, folder, destfolder, cslist))
+            elif sync_this_folder:
+                results.append(run_sync(fs_source, folder, fs_dest, destfolder, objdfolder, cslist))
+                # SYNC might take a long time:
+                # so refresh the connections
+                fs_source.refresh()
+                fs_dest.refresh()
+
+        results = [result.result() if isinstance(result, Future) else result for result in results]
+        if plan_file:
+            write_plan(plan_file, plans, fs_source, throughput=plan_throughput, workers=copy_procs)
+    finally:
+        if folder_executor:
+            folder_executor.shutdown(wait=True)
+        if sync_engine:
+            sync_engine.stop()
+            sync_engine.cleanup()
+        if state:
+            state.close()
+    return all(results)
 
 
 def replicate_single_folder(sfs_name, sfs_opts, dfs_name, dfs_opts,
@@ -482,7 +619,23 @@ def replicate_single_folder(sfs_name, sfs_opts, dfs_name, dfs_opts,
                             minimum_age=None,
                             scan=False,
                             cs_filter_file='',
-                            scan_filter_file=''):
+                            scan_filter_file='',
+                            streaming=False,
+                            batch_files=1,
+                            batch_bytes=BATCH_BYTES,
+                            schedule=SCHEDULE_FIFO,
+                            engine=ENGINE_PROCESSES,
+                            max_requests=MAX_REQUESTS,
+                            max_connections=MAX_CONNECTIONS,
+                            max_bandwidth=0,
+                            dest_index=True,
+                            scan_threads=1,
+                            job_memory=JOB_MEMORY,
+                            state_db=None,
+                            plan_file=None,
+                            plan_throughput=0,
+                            bundle=False,
+                            register=None):
 
     fs_source = factory.createfs(sfs_name, **sfs_opts)
     fs_dest = factory.createfs('irods', **dfs_opts)
@@ -492,52 +645,71 @@ def replicate_single_folder(sfs_name, sfs_opts, dfs_name, dfs_opts,
     try:
         objdfolder = fs_dest.getfolder(destfolder)
     except ex.CollectionDoesNotExist:
-        objdfolder = fs_dest.mkdir(destfolder)
+        # A plan does not create the destination collection
+        if not plan_file:
+            objdfolder = fs_dest.mkdir(destfolder)
 
-    if completion_avu:
+    if completion_avu and objdfolder is not None:
         if test_completion_avu(objdfolder, completion_avu):
             logger.debug(
                 'Import for folder %s already marked complete' % sourcepath)
             return
 
-    if checksumfileformat in [FILE_FORMAT_BASECLEAR, FILE_FORMAT_GENERIC_JSON]:
-        with open(checksumfileschema) as f:
-            JSON_SCHEMA = json.load(f)
-    else:
-        JSON_SCHEMA = None
+    selection = SelectionConfig(cs_filter_file, scan_filter_file, excludelist,
+                                checksumfileformat=checksumfileformat,
+                                checksumfileschema=checksumfileschema)
 
     cslist = {}
     if checksumfile:
         cslist = parse_checksum_file(
-            fs_source, folder, checksumfile, checksumfileformat, JSON_SCHEMA)
+            fs_source, folder, checksumfile, checksumfileformat, selection.validator,
+            memory_budget=job_memory)
         if not cslist:
             logger.error('Given checksum file is empty')
             sys.exit(0)
 
-    cs_filters = []
-    if cs_filter_file:
-        with open(cs_filter_file, 'r') as f:
-            data = yaml.safe_load(f)
-            cs_filters = data.get("filter", [])
-
-    scan_filters = []
-    if scan_filter_file:
-        with open(scan_filter_file, 'r') as f:
-            data = yaml.safe_load(f)
-            scan_filters = data.get("filter", [])
-    success = sync_folder(fs_source, folder, fs_dest, destfolder, objdfolder,
-                          sfs_name, sfs_opts,
-                          'irods', dfs_opts,
-                          compareChecksums,
-                          cslist,
-                          metadata,
-                          copy_procs,
-                          excludelist,
-                          compare,
-                          minimum_age,
-                          cs_filters,
-                          scan_filters,
-                          scan)
+    state = SyncState(state_db) if state_db else None
+    try:
+        if plan_file:
+            totals = plan_sync(fs_source, folder.path, fs_dest, destfolder,
+                               compareChecksums=compareChecksums, filelist=cslist, scan=scan,
+                               excludelist=selection.excludes, compare=compare,
+                               cs_filters=selection.cs_filter, scan_filters=selection.scan_filter,
+                               dest_index=dest_index, job_memory=job_memory, state=state)
+            write_plan(plan_file, [(folder.path, destfolder, totals)], fs_source,
+                       throughput=plan_throughput, workers=copy_procs)
+            sys.exit(0)
+
+        success = sync_folder(fs_source, folder, fs_dest, destfolder, objdfolder,
+                              sfs_name, sfs_opts,
+                              'irods', dfs_opts,
+                              compareChecksums,
+                              cslist,
+                              metadata,
+                              copy_procs,
+                              selection.excludes,
+                              compare,
+                              minimum_age,
+                              selection.cs_filter,
+                              selection.scan_filter,
+                              scan,
+                              streaming=streaming,
+                              batch_files=batch_files,
+                              batch_bytes=batch_bytes,
+                              schedule=schedule,
+                              engine=engine,
+                              max_requests=max_requests,
+                              max_connections=max_connections,
+                              max_bandwidth=max_bandwidth,
+                              dest_index=dest_index,
+                              scan_threads=scan_threads,
+                              job_memory=job_memory,
+                              state=state,
+                              bundle=bundle,
+                              register=register)
+    finally:
+        if state:
+            state.close()
     if success:
         sys.exit(0)
     sys.exit(1)
@@ -633,6 +805,43 @@ def main():
         '-z', '--no_compare', help='Do not compare existing objects by size/date/checksum', action="store_true")
     parser.add_argument('-t', '--copy_procs',
                         help='Number of copy processes', type=int, default=1)
+    parser.add_argument('--streaming', help='Start copying while the source is still being scanned',
+                        action="store_true")
+    parser.add_argument('--batch_files', help='Maximum number of small files to sync as one unit',
+                        type=int, default=1)
+    parser.add_argument('--batch_size', help='Maximum cumulative size of a batch of small files in MB',
+                        type=int, default=BATCH_BYTES // (1024 * 1024))
+    parser.add_argument('--schedule', help='Order in which files are synced: in the order they are found ("%s") '
+                        'or largest files first ("%s")' % (SCHEDULE_FIFO, SCHEDULE_LARGEST_FIRST),
+                        choices=[SCHEDULE_FIFO, SCHEDULE_LARGEST_FIRST], default=SCHEDULE_FIFO)
+    parser.add_argument('--engine', help='Run the copy workers as processes, threads or asyncio tasks. '
+                        'Asyncio tasks take a connection for every comparison or copy of a file',
+                        choices=list(ENGINES), default=ENGINE_PROCESSES)
+    parser.add_argument('--max_requests', help='Number of files in flight for the asyncio engine',
+                        type=int, default=MAX_REQUESTS)
+    parser.add_argument('--max_connections', help='Number of connections to the source and to iRODS for the asyncio engine',
+                        type=int, default=MAX_CONNECTIONS)
+    parser.add_argument('--max_bandwidth', help='Maximum transfer rate of all copy workers together in MB/s, 0 for no limit',
+                        type=float, default=0)
+    parser.add_argument('--parallel_folders', help='Number of folders synced at the same time in --search mode',
+                        type=int, default=1)
+    parser.add_argument('--no_dest_index', help='Query the destination objects one by one instead of listing the destination at once',
+                        action='store_true')
+    parser.add_argument('--scan_threads', help='Number of threads listing source directories at the same time',
+                        type=int, default=1)
+    parser.add_argument('--job_memory', help='Memory in MB for the copy jobs of a folder, beyond which they are moved to a temporary file',
+                        type=int, default=JOB_MEMORY // (1024 * 1024))
+    parser.add_argument('--state_db', help='SQLite database recording the verified files, so unchanged files are skipped by later runs',
+                        default=None)
+    parser.add_argument('--plan', help='Do not sync, but write the files and bytes that would be synced to this JSON file',
+                        default=None)
+    parser.add_argument('--plan_throughput', help='Transfer rate in MB/s for the duration estimate of --plan, 0 to measure it',
+                        type=float, default=0)
+    parser.add_argument('--bundle', help='Copy batches of small files as tar archives that iRODS extracts, requires --batch_files',
+                        action='store_true')
+    parser.add_argument('--register', help='Register the source files in iRODS at their physical path instead of copying them. '
+                        'An optional SOURCE_PREFIX=PHYSICAL_PREFIX maps the source paths to the paths on the resource server',
+                        nargs='?', const='', default=None, metavar='SOURCE_PREFIX=PHYSICAL_PREFIX')
 
     # Logging options
     parser.add_argument('--data_source_name',
@@ -672,6 +881,13 @@ def main():
     dest_options = parse_extra_options(args.irods_options)
     dest_options.update({'resource': args.resource})
 
+    # Source paths are registered at the same path on the resource server,
+    # unless a prefix mapping is given
+    register = None
+    if args.register is not None:
+        source_prefix, _, physical_prefix = args.register.partition('=')
+        register = (source_prefix, physical_prefix)
+
     timestamp_list = {opt.split('=')[0]: opt.split('=')[1]
                       for opt in args.timestamp_age}
 
@@ -683,28 +899,47 @@ def main():
         if args.checksum_file and args.checksum_file.startswith('/'):
             logger.error('Chksum file path cannot be an absolute path when --search parameter is supplied')
             sys.exit(1)
-        replicate_data_folder(args.source_fs, source_options, 'irods', dest_options,
-                              args.source_path, args.coll,
-                              compareChecksums=args.verify_checksums,
-                              minage=args.minage, maxage=args.maxage,
-                              flagfile=args.flag_filename,
-                              flag_age=args.flag_age,
-                              checksumfile=args.checksum_file,
-                              checksumfileformat=args.checksum_file_format,
-                              checksumfileschema=args.checksum_file_schema,
-                              pattern=args.folder_pattern,
-                              metadata=metadata,
-                              skip_subdirs=args.skip_subdirs,
-                              copy_procs=args.copy_procs,
-                              excludelist=args.exclude,
-                              completion_avu=args.completion_avu,
-                              compare=not args.no_compare,
-                              timestamp_list=timestamp_list,
-                              minimum_age=args.last_write,
-                              cs_filter_file=args.checksum_filter_file,
-                              scan=scan,
-                              scan_filter_file=args.scan_filter_file
-                              )
+        success = replicate_data_folder(args.source_fs, source_options, 'irods', dest_options,
+                                        args.source_path, args.coll,
+                                        compareChecksums=args.verify_checksums,
+                                        minage=args.minage, maxage=args.maxage,
+                                        flagfile=args.flag_filename,
+                                        flag_age=args.flag_age,
+                                        checksumfile=args.checksum_file,
+                                        checksumfileformat=args.checksum_file_format,
+                                        checksumfileschema=args.checksum_file_schema,
+                                        pattern=args.folder_pattern,
+                                        metadata=metadata,
+                                        skip_subdirs=args.skip_subdirs,
+                                        copy_procs=args.copy_procs,
+                                        excludelist=args.exclude,
+                                        completion_avu=args.completion_avu,
+                                        compare=not args.no_compare,
+                                        timestamp_list=timestamp_list,
+                                        minimum_age=args.last_write,
+                                        cs_filter_file=args.checksum_filter_file,
+                                        scan=scan,
+                                        scan_filter_file=args.scan_filter_file,
+                                        streaming=args.streaming,
+                                        batch_files=args.batch_files,
+                                        batch_bytes=args.batch_size * 1024 * 1024,
+                                        schedule=args.schedule,
+                                        engine=args.engine,
+                                        max_requests=args.max_requests,
+                                        max_connections=args.max_connections,
+                                        max_bandwidth=args.max_bandwidth * 1024 * 1024,
+                                        parallel_folders=args.parallel_folders,
+                                        dest_index=not args.no_dest_index,
+                                        scan_threads=args.scan_threads,
+                                        job_memory=args.job_memory * 1024 * 1024,
+                                        state_db=args.state_db,
+                                        plan_file=args.plan,
+                                        plan_throughput=args.plan_throughput * 1024 * 1024,
+                                        bundle=args.bundle,
+                                        register=register
+                                        )
+        if not success:
+            sys.exit(1)
     else:
         if args.coll[-1] == '/':
             destination_coll = os.path.join(
@@ -726,7 +961,23 @@ def main():
                                 minimum_age=args.last_write,
                                 scan_filter_file=args.scan_filter_file,
                                 cs_filter_file=args.checksum_filter_file,
-                                scan=scan
+                                scan=scan,
+                                streaming=args.streaming,
+                                batch_files=args.batch_files,
+                                batch_bytes=args.batch_size * 1024 * 1024,
+                                schedule=args.schedule,
+                                engine=args.engine,
+                                max_requests=args.max_requests,
+                                max_connections=args.max_connections,
+                                max_bandwidth=args.max_bandwidth * 1024 * 1024,
+                                dest_index=not args.no_dest_index,
+                                scan_threads=args.scan_threads,
+                                job_memory=args.job_memory * 1024 * 1024,
+                                state_db=args.state_db,
+                                plan_file=args.plan,
+                                plan_throughput=args.plan_throughput * 1024 * 1024,
+                                bundle=args.bundle,
+                                register=register
                                 )
 
 
@@ -0,0 +1,310 @@
+"""
+Streaming parsers for checksum manifests
+
+A manifest is read record by record, so a manifest of millions of files is
+never held in memory as a whole. The parsers yield (path, checksum) pairs.
+Manifests compressed with gzip or zstd are decompressed on the fly.
+"""
+
+import copy
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+
+from jsonschema import validators
+from jsonschema.exceptions import ValidationError, best_match
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+FILE_FORMAT_TEXT = 'text'
+
+#the baseclear format
+FILE_FORMAT_BASECLEAR = 'baseclear'
+
+FILE_FORMAT_GENERIC_JSON = 'generic'
+
+# The array of records in the json formats
+MANIFEST_RECORDS = {
+    FILE_FORMAT_GENERIC_JSON: 'objects',
+    FILE_FORMAT_BASECLEAR: 'samples'
+}
+
+#magic string, sub directory the actual seqencer files are contained (within further directory structures)
+#Better would be to define this folder in a field of the json-file
+#TODO: once BaseClear abides by the new format, remove magic strings and use always path-property
+SEQUENCE_FILE_DIR = 'raw_sequences'
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Characters read from a manifest at a time
+READ_SIZE = 1024 * 1024
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# Keywords of the record array schema that are checked record by record. A schema
+# with other keywords on the record array is validated as a whole document
+STREAMED_KEYWORDS = {'type', 'items', 'uniqueItems', 'minItems', 'maxItems',
+                     'title', 'description', '$comment', 'default', 'examples'}
+
+# Keywords of the record array checked by the ManifestValidator itself
+COUNTED_KEYWORDS = ('uniqueItems', 'minItems', 'maxItems')
+
+
+class ManifestError(ValueError):
+    """A manifest that is not valid json or not in the expected format"""
+
+
+class ManifestValidator():
+    """
+    Validates a json manifest record by record. The records are validated with the
+    items schema of the record array, the rest of the document with the schema itself.
+    uniqueItems, minItems and maxItems of the record array are checked on the fly,
+    keeping a digest per record for uniqueItems. For a record array with other
+    keywords the records are kept, and the whole document is validated at the end.
+    """
+
+    def __init__(self, schema, records):
+        cls = validators.validator_for(schema)
+        cls.check_schema(schema)
+        self.records = records
+        self.array = schema.get('properties', {}).get(records, {})
+        self.streamed = isinstance(self.array, dict) and set(self.array) <= STREAMED_KEYWORDS
+        self._reset()
+        if self.streamed and any(k in self.array for k in COUNTED_KEYWORDS):
+            # The header has an empty record array, its size is checked here
+            schema = copy.deepcopy(schema)
+            for keyword in COUNTED_KEYWORDS:
+                schema['properties'][records].pop(keyword, None)
+        self.document = cls(schema)
+        items = self.array.get('items', {}) if isinstance(self.array, dict) else {}
+        self.record = self.document.evolve(schema=items)
+
+    def _reset(self):
+        self.count = 0
+        self.digests = set()
+        self.held = []
+
+    def begin(self):
+        """Returns a copy of the validator to check one manifest with"""
+        validator = copy.copy(self)
+        validator._reset()
+        return validator
+
+    @staticmethod
+    def _check(validator, instance):
+        error = best_match(validator.iter_errors(instance))
+        if error is not None:
+            raise error
+
+    def _error(self, keyword, message, instance):
+        return ValidationError(message, validator=keyword, validator_value=self.array[keyword],
+                               path=[self.records], instance=instance, schema=self.array)
+
+    def validate_header(self, header):
+        """Validates the document with an empty record array, after the last record"""
+        if not self.streamed:
+            if self.records in header:
+                header = dict(header)
+                header[self.records] = self.held
+            self._check(self.document, header)
+            return
+        self._check(self.document, header)
+        if self.records in header and self.count < self.array.get('minItems', 0):
+            raise self._error('minItems', "'{}' has {} records, expected at least {}".format(
+                self.records, self.count, self.array['minItems']), self.count)
+
+    def validate_record(self, record):
+        self._check(self.record, record)
+        self.count += 1
+        if not self.streamed:
+            self.held.append(record)
+            return
+        if self.count > self.array.get('maxItems', self.count):
+            raise self._error('maxItems', "'{}' has more than {} records".format(
+                self.records, self.array['maxItems']), record)
+        if self.array.get('uniqueItems'):
+            digest = hashlib.sha256(json.dumps(record, sort_keys=True).encode()).digest()
+            if digest in self.digests:
+                raise self._error('uniqueItems', "record {} of '{}' is not unique: {!r}".format(
+                    self.count - 1, self.records, record), record)
+            self.digests.add(digest)
+
+
+def manifest_validator(json_schema, file_format):
+    """
+    Returns the validator for the records of a manifest in file_format. json_schema
+    is the schema, or a ManifestValidator already
+    """
+    if json_schema is None or isinstance(json_schema, ManifestValidator):
+        return json_schema
+    return ManifestValidator(json_schema, MANIFEST_RECORDS[file_format])
+
+
+def open_manifest(fh):
+    """
+    Returns a text stream of the binary stream fh, decompressing gzip and
+    zstd manifests
+    """
+    if hasattr(fh, 'peek'):
+        magic = fh.peek(4)[:4]
+    else:
+        magic = fh.read(4)
+        fh.seek(0)
+    if magic.startswith(GZIP_MAGIC):
+        fh = gzip.GzipFile(fileobj=fh, mode='rb')
+    elif magic == ZSTD_MAGIC:
+        if zstd is None:
+            raise ManifestError('zstd compressed manifest, but no zstd module is available')
+        if hasattr(zstd, 'ZstdFile'):
+            fh = zstd.ZstdFile(fh, mode='rb')
+        else:
+            fh = zstd.ZstdDecompressor().stream_reader(fh)
+    return io.TextIOWrapper(fh, encoding='utf-8')
+
+
+class JsonStream():
+    """Decodes the json values of a text stream one at a time"""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        data = self.fh.read(READ_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next character that is not whitespace, '' at the end"""
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ManifestError('Expected one of "{}" in manifest, found "{}"'.format(chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decodes the next value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may continue in the next read
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as ex:
+                if self.eof:
+                    raise ManifestError('Invalid json in manifest: {}'.format(ex))
+            self._fill()
+
+
+def iter_json_records(fh, records, header):
+    """
+    Yields the elements of the array records of the json document one by one. The
+    other top level members are stored in header, with an empty array for records
+    """
+    stream = JsonStream(fh)
+    stream.expect('{')
+    if stream.peek() == '}':
+        stream.expect('}')
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == records and stream.peek() == '[':
+            stream.expect('[')
+            header[key] = []
+            if stream.peek() == ']':
+                stream.expect(']')
+            else:
+                while True:
+                    yield stream.value()
+                    if stream.expect(',]') == ']':
+                        break
+        else:
+            header[key] = stream.value()
+        if stream.expect(',}') == '}':
+            break
+
+
+def iter_text_manifest(fh):
+    """Yields the (path, checksum) pairs of a text manifest: lines '<checksum>  <path>'"""
+    for line in fh:
+        line = line.rstrip()
+        if not line:
+            continue
+        hashvalue, filename = line.split('  ', 1)
+        yield filename, hashvalue
+
+
+def iter_generic_manifest(fh, validator=None):
+    """Yields the (path, checksum) pairs of the data objects in a generic json manifest"""
+    header = {}
+    records = iter_json_records(fh, MANIFEST_RECORDS[FILE_FORMAT_GENERIC_JSON], header)
+    for data_object in records:
+        if validator:
+            validator.validate_record(data_object)
+        if data_object['type'] != 'dataobject':
+            continue
+        yield data_object['path'], data_object['checksum']
+    # The header is complete after the last record
+    if validator:
+        validator.validate_header(header)
+
+
+def iter_baseclear_manifest(fh, validator=None):
+    """Yields the (path, checksum) pairs of the files in a baseclear manifest"""
+    header = {}
+    records = iter_json_records(fh, MANIFEST_RECORDS[FILE_FORMAT_BASECLEAR], header)
+    for sample in records:
+        if validator:
+            validator.validate_record(sample)
+        flowcellid = sample['flowcellid']
+        for pair in sample['pairs']:
+            if 'path' in pair.keys():
+                path = pair['path']
+            else:
+                path = os.path.join(SEQUENCE_FILE_DIR, flowcellid)
+            yield os.path.join(path, pair['filename']), pair['checksum']
+    if validator:
+        validator.validate_header(header)
+
+
+MANIFEST_PARSERS = {
+    FILE_FORMAT_TEXT: lambda fh, validator: iter_text_manifest(fh),
+    FILE_FORMAT_GENERIC_JSON: iter_generic_manifest,
+    FILE_FORMAT_BASECLEAR: iter_baseclear_manifest
+}
+
+
+def iter_manifest(fh, file_format, validator=None):
+    """
+    Yields the (path, checksum) pairs of the manifest in the binary stream fh.
+    Raises ManifestError, or ValidationError for a record not matching the schema
+    """
+    if validator:
+        validator = validator.begin()
+    yield from MANIFEST_PARSERS[file_format](open_manifest(fh), validator)
@@ -7,7 +7,7 @@ import unittest
 sys.path.insert(1, os.path.join(sys.path[0], ".."))
 
 from intorods.intorods import (BASECLEAR_SCHEMA_FILE, FILE_FORMAT_BASECLEAR,
-                               FILE_FORMAT_TEXT, factory, parse_checksum_file)
+                               FILE_FORMAT_TEXT, SelectionConfig, factory, parse_checksum_file)
 
 
 class TestParseChecksumFile(unittest.TestCase):
@@ -92,5 +92,37 @@ class TestParseChecksumFile(unittest.TestCase):
                                       FILE_FORMAT_BASECLEAR, 
                                       JSON_SCHEMA )
         self.assertIsNotNone( result )
+
+    def test_json_format_with_validator(self):
+        """
+        Test the parsing of the json format with the validator of a selection config
+        """
+        fs_source = factory.createfs( "local" )
+        selection = SelectionConfig( checksumfileformat=FILE_FORMAT_BASECLEAR,
+                                     checksumfileschema=BASECLEAR_SCHEMA_FILE )
+        for _ in range(2):
+            result = parse_checksum_file( fs_source,
+                                          fs_source.getfile("./test/data"),
+                                          "json_checksumfile1.json",
+                                          FILE_FORMAT_BASECLEAR,
+                                          selection.validator )
+            self.assertIsNotNone( result )
+            self.assertEqual( result["raw_sequences/4711/file1"], "1231231231123123123112312312311231231231123123123112312312311231" )
+
+
+    def test_selection_config(self):
+        """
+        Test the selection config loads the filter file and compiles the patterns
+        """
+        selection = SelectionConfig( scan_filter_file="./test/test_filter/filter_scan.yml",
+                                     excludelist=["\\.tmp$"], pattern="run_[0-9]+" )
+        self.assertIsNone( selection.validator )
+        self.assertTrue( selection.pattern.match("RUN_12") )
+        self.assertIsNone( selection.pattern.match("run_12x") )
+        self.assertTrue( selection.excludes[0].search("a/b.TMP") )
+        self.assertTrue( selection.scan_filter.isFileIncluded("/a.pdf") )
+        self.assertFalse( selection.scan_filter.isFileIncluded("/a.txt") )
+
+
 if __name__ == '__main__':
     unittest.main()
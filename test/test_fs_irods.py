@@ -0,0 +1,368 @@
+import base64
+import hashlib
+import io
+import os
+import re
+import unittest
+from datetime import datetime, timezone
+
+import irods.keywords as kw
+from irods.api_number import api_number
+from irods.exception import DataObjectDoesNotExist
+from irods.models import Collection, DataObject
+import mock
+
+from intorods.filesys import fs_irods
+
+CHECKSUM = hashlib.sha256(b'data').hexdigest()
+IRODS_CHECKSUM = 'sha2:' + base64.b64encode(bytes.fromhex(CHECKSUM)).decode()
+MTIME = 1700000000
+
+
+def object_row(path, size=4, checksum=IRODS_CHECKSUM, replica_status='1'):
+    collname, name = path.rsplit('/', 1)
+    return {Collection.name: collname, DataObject.name: name, DataObject.size: size,
+            DataObject.modify_time: datetime.fromtimestamp(MTIME, timezone.utc),
+            DataObject.checksum: checksum, DataObject.replica_status: replica_status}
+
+
+class Catalog():
+    """
+    Answers GenQueries on collection names and data object rows like the catalog,
+    with '=' and 'like' criteria and ordering. The rows are returned one at a time,
+    fetched counts the rows that were returned
+    """
+
+    def __init__(self, collections, objects):
+        self.collections = [{Collection.name: name, Collection.parent_name: os.path.dirname(name)}
+                            for name in collections]
+        self.objects = objects
+        self.queries = []
+        self.fetched = 0
+
+    def query(self, *columns):
+        return CatalogQuery(self, columns)
+
+
+class CatalogQuery():
+
+    def __init__(self, catalog, columns):
+        self.catalog = catalog
+        self.columns = columns
+        self.criteria = []
+        self.order = []
+
+    def filter(self, *criteria):
+        self.criteria.extend(criteria)
+        return self
+
+    def order_by(self, column):
+        self.order.append(column)
+        return self
+
+    @staticmethod
+    def _match(criterion, row):
+        value = row[criterion.query_key]
+        if criterion.op == '=':
+            return value == criterion.value
+        pattern = ''.join('.' if c == '_' else '.*' if c == '%' else re.escape(c) for c in criterion.value)
+        return re.fullmatch(pattern, value) is not None
+
+    def get_results(self):
+        self.catalog.queries.append(self)
+        rows = self.catalog.objects if DataObject.name in self.columns else self.catalog.collections
+        rows = [r for r in rows if all(self._match(c, r) for c in self.criteria)]
+        rows.sort(key=lambda r: [r[column] for column in self.order])
+        for r in rows:
+            self.catalog.fetched += 1
+            yield r
+
+
+class TestFsIrods(unittest.TestCase):
+    """
+    The iRODS session is replaced by a mock, the tests check what is asked of the server
+    """
+
+    def create_fs(self, **options):
+        with mock.patch.object(fs_irods, 'iRODSSession'):
+            return fs_irods.fs_irods(resource='resc', **options)
+
+    @staticmethod
+    def set_object_rows(fs, rows):
+        # The rows returned by the query for a single data object
+        query = fs.irods_session.query.return_value.filter.return_value.filter.return_value
+        query.get_results.return_value = rows
+
+    def test_createfile_register(self):
+        fs = self.create_fs(checksum='register')
+        fs.createfile('/zone/file', checksum=CHECKSUM)
+        options = fs.irods_session.data_objects.open.call_args.kwargs
+        self.assertEqual(options[kw.REG_CHKSUM_KW], '')
+        self.assertEqual(options[kw.CHKSUM_KW], IRODS_CHECKSUM)
+
+    def test_createfile_other_checksum(self):
+        fs = self.create_fs(checksum='register')
+        # An md5 or invalid checksum is left to the server
+        for checksum in [hashlib.md5(b'data').hexdigest(), 'z' * 64]:
+            fs.createfile('/zone/file', checksum=checksum)
+            options = fs.irods_session.data_objects.open.call_args.kwargs
+            self.assertEqual(options[kw.REG_CHKSUM_KW], '')
+            self.assertNotIn(kw.CHKSUM_KW, options)
+
+    def test_hex_sha2(self):
+        self.assertEqual(fs_irods.hex_sha2(CHECKSUM), IRODS_CHECKSUM)
+        self.assertEqual(fs_irods.hex_sha2(CHECKSUM.upper()), IRODS_CHECKSUM)
+        for checksum in [None, '', hashlib.md5(b'data').hexdigest(), 'z' * 64, CHECKSUM + '0']:
+            self.assertIsNone(fs_irods.hex_sha2(checksum))
+
+    def test_createfile_verify(self):
+        fs = self.create_fs(checksum='verify')
+        fs.createfile('/zone/file')
+        options = fs.irods_session.data_objects.open.call_args.kwargs
+        self.assertEqual(options[kw.VERIFY_CHKSUM_KW], '')
+        self.assertNotIn(kw.CHKSUM_KW, options)
+
+    def test_createfile_server(self):
+        fs = self.create_fs()
+        fs.createfile('/zone/file', checksum=CHECKSUM)
+        options = fs.irods_session.data_objects.open.call_args.kwargs
+        self.assertEqual(options, {'create': True, kw.DEST_RESC_NAME_KW: 'resc'})
+
+    def test_checksum_computed_by_server(self):
+        fs = self.create_fs()
+        self.set_object_rows(fs, [object_row('/zone/file', checksum=None)])
+        fs.irods_session.data_objects.chksum.return_value = IRODS_CHECKSUM
+        self.assertEqual(fs.getfile('/zone/file').checksum, CHECKSUM)
+        fs.irods_session.data_objects.chksum.assert_called_once_with('/zone/file')
+        fs.irods_session.data_objects.open.assert_not_called()
+
+    def test_file_queried_once(self):
+        """
+        Test a data object is queried on first use only, and a good replica is used
+        """
+        fs = self.create_fs()
+        self.set_object_rows(fs, [object_row('/zone/file', size=3, replica_status='0'),
+                                  object_row('/zone/file')])
+        fs.irods_session.query.reset_mock()
+        f = fs.getfile('/zone/file')
+        fs.irods_session.query.assert_not_called()
+        self.assertEqual(f.filesize(), 4)
+        self.assertEqual(f.utc_mtime(), MTIME)
+        self.assertEqual(f.checksum, CHECKSUM)
+        self.assertEqual(f.replica_status(), 1)
+        self.assertEqual(fs.irods_session.query.call_count, 1)
+        fs.irods_session.data_objects.get.assert_not_called()
+
+    def test_file_missing(self):
+        fs = self.create_fs()
+        self.set_object_rows(fs, [])
+        self.assertFalse(fs.fileexists('/zone/missing'))
+        with self.assertRaises(DataObjectDoesNotExist):
+            fs.getfile('/zone/missing').filesize()
+
+    def set_catalog(self, fs):
+        # A tree below /zone/my_run, and a collection /zone/myXrun that matches
+        # /zone/my_run/% in a like query
+        catalog = Catalog(['/zone/my_run', '/zone/my_run/sub', '/zone/my_run/sub/deeper', '/zone/my_run/stale',
+                           '/zone/myXrun', '/zone/myXrun/sub'],
+                          [object_row('/zone/my_run/a'),
+                           object_row('/zone/my_run/sub/b', size=3, replica_status='0'),
+                           object_row('/zone/my_run/sub/b', size=4),
+                           object_row('/zone/my_run/sub/deeper/c', checksum=None),
+                           object_row('/zone/my_run/stale/d', size=5, replica_status='0'),
+                           object_row('/zone/my_run/stale/d', size=6, replica_status='0'),
+                           object_row('/zone/myXrun/sub/e')])
+        fs.irods_session.query.side_effect = catalog.query
+        return catalog
+
+    def test_walk(self):
+        fs = self.create_fs()
+        catalog = self.set_catalog(fs)
+        entries = list(fs.walk('/zone/my_run'))
+        # The collections first, the objects once, with a good replica if there is one
+        self.assertEqual(entries, [
+            ('/zone/my_run/stale', True, None),
+            ('/zone/my_run/sub', True, None),
+            ('/zone/my_run/sub/deeper', True, None),
+            ('/zone/my_run/a', False, fs_irods.FileStat(4, MTIME, CHECKSUM, 1)),
+            ('/zone/my_run/stale/d', False, fs_irods.FileStat(5, MTIME, CHECKSUM, 0)),
+            ('/zone/my_run/sub/b', False, fs_irods.FileStat(4, MTIME, CHECKSUM, 1)),
+            ('/zone/my_run/sub/deeper/c', False, fs_irods.FileStat(4, MTIME, None, 1))])
+        # The tree is listed with one collection query and two object queries
+        self.assertEqual([[(c.op, c.value) for c in q.criteria] for q in catalog.queries],
+                         [[('like', '/zone/my_run/%')], [('=', '/zone/my_run')], [('like', '/zone/my_run/%')]])
+
+    def test_walk_streamed(self):
+        fs = self.create_fs()
+        catalog = self.set_catalog(fs)
+        walk = fs.walk('/zone/my_run')
+        for entry in walk:
+            if not entry.isdir:
+                break
+        # The rows of the objects are fetched while walking, not all at once
+        self.assertEqual(entry.path, '/zone/my_run/a')
+        self.assertLess(catalog.fetched, len(catalog.collections) + len(catalog.objects))
+        self.assertEqual(len(list(walk)), 3)
+
+    def test_walk_pruned(self):
+        fs = self.create_fs()
+        catalog = self.set_catalog(fs)
+        entries = list(fs.walk('/zone/my_run', prune=lambda path: path.endswith('/sub')))
+        self.assertEqual(sorted(e.path for e in entries),
+                         ['/zone/my_run/a', '/zone/my_run/stale', '/zone/my_run/stale/d', '/zone/my_run/sub'])
+        # Every collection that is not pruned is listed by itself
+        self.assertTrue(all(c.op == '=' for q in catalog.queries for c in q.criteria))
+
+    def test_scandir(self):
+        fs = self.create_fs()
+        self.set_catalog(fs)
+        self.assertEqual(sorted(fs.scandir('/zone/my_run/sub')), [
+            ('/zone/my_run/sub/b', False, fs_irods.FileStat(4, MTIME, CHECKSUM, 1)),
+            ('/zone/my_run/sub/deeper', True, None)])
+
+    def test_lsindex(self):
+        fs = self.create_fs()
+        self.set_catalog(fs)
+        index = fs.lsindex('/zone/my_run/')
+        self.assertEqual(sorted(index), ['a', 'stale/d', 'sub/b', 'sub/deeper/c'])
+        self.assertEqual(index['sub/b'], fs_irods.FileStat(4, MTIME, CHECKSUM, 1))
+        self.assertEqual(index['stale/d'].replica_status, 0)
+
+    def test_set_mtime(self):
+        """
+        Test the modification time is set and cached without querying the object again
+        """
+        fs = self.create_fs()
+        fs.irods_session.query.reset_mock()
+        f = fs.getfile('/zone/file')
+        f.set_mtime(MTIME + 10)
+        fs.irods_session.data_objects.modDataObjMeta.assert_called_once_with(
+            {'objPath': '/zone/file'}, {'dataModify': MTIME + 10})
+        self.assertEqual(f.utc_mtime(), MTIME + 10)
+        fs.irods_session.query.assert_not_called()
+        fs.irods_session.data_objects.get.assert_not_called()
+
+    def test_fileexists_caches_file(self):
+        fs = self.create_fs()
+        self.set_object_rows(fs, [object_row('/zone/file')])
+        fs.irods_session.query.reset_mock()
+        self.assertTrue(fs.fileexists('/zone/file'))
+        self.assertEqual(fs.getfile('/zone/file').filesize(), 4)
+        self.assertEqual(fs.irods_session.query.call_count, 1)
+
+    def test_ls(self):
+        fs = self.create_fs()
+        coll = fs.irods_session.collections.get.return_value
+        coll.path = '/zone/coll'
+        coll.subcollections = []
+        query = fs.irods_session.query.return_value.filter.return_value.order_by.return_value
+        query.get_results.return_value = [object_row('/zone/coll/a'), object_row('/zone/coll/b', size=8)]
+        result = fs.ls('/zone/coll')
+        self.assertEqual([(f.path, f.filesize()) for f in result], [('/zone/coll/a', 4), ('/zone/coll/b', 8)])
+        fs.irods_session.data_objects.get.assert_not_called()
+
+    def test_compute_checksums(self):
+        fs = self.create_fs(checksum_threads='2')
+        fs.irods_session.data_objects.chksum.side_effect = \
+            lambda path: IRODS_CHECKSUM if path != '/zone/md5' else 'acbd18db4cc2f85cedef654fccc4a4d8'
+        result = fs.compute_checksums(['/zone/file1', '/zone/md5', '/zone/file2'])
+        self.assertEqual(result, {'/zone/file1': CHECKSUM, '/zone/file2': CHECKSUM})
+
+    def test_parallel_copy(self):
+        fs = self.create_fs(parallel_threshold='0', parallel_threads='3')
+        data = bytes(range(256)) * 1000
+        written = bytearray(len(data))
+        closed = []
+
+        class Handle():
+            def __init__(self, name):
+                self.name = name
+                self.pos = 0
+
+            def seek(self, offset, whence=0):
+                self.pos = offset
+                return offset
+
+            def write(self, b):
+                written[self.pos:self.pos + len(b)] = b
+                self.pos += len(b)
+                return len(b)
+
+            def close(self):
+                closed.append(self.name)
+
+        raw = mock.Mock()
+        raw.replica_access_info.return_value = ('token', 'resc')
+        fs.irods_session.data_objects.open_with_FileRaw.return_value = (Handle('first'), raw)
+        fs.irods_session.data_objects.open.side_effect = lambda *args, **options: Handle(options[kw.REPLICA_TOKEN_KW])
+        source = mock.Mock(path='/source/file', _checksum=None)
+        source.filesize.return_value = len(data)
+        source.open.side_effect = lambda mode: io.BytesIO(data)
+        self.assertTrue(fs.parallel_copy(source, '/zone/file'))
+        self.assertEqual(bytes(written), data)
+        # The first connection finalizes the object, after the others are closed
+        self.assertEqual(closed, ['token', 'token', 'first'])
+        self.assertEqual(fs.irods_session.data_objects.open.call_count, 2)
+
+    def test_parallel_copy_part_failure(self):
+        fs = self.create_fs(parallel_threshold='0', parallel_threads='2')
+        data = b'x' * 1000
+        raw = mock.Mock()
+        raw.replica_access_info.return_value = ('token', 'resc')
+        first = mock.Mock()
+        fs.irods_session.data_objects.open_with_FileRaw.return_value = (first, raw)
+        source = mock.Mock(path='/source/file', _checksum=None)
+        source.filesize.return_value = len(data)
+        # The source turns out to be shorter, the last part fails
+        source.open.side_effect = lambda mode: io.BytesIO(data[:-10])
+        with self.assertRaises(IOError):
+            fs.parallel_copy(source, '/zone/file')
+        first.close.assert_called_once_with()
+        fs.irods_session.data_objects.unlink.assert_called_once_with('/zone/file', True)
+
+    def test_parallel_copy_small_file(self):
+        fs = self.create_fs()
+        source = mock.Mock()
+        source.filesize.return_value = 1024
+        self.assertFalse(fs.parallel_copy(source, '/zone/file'))
+
+    def test_extract_bundle(self):
+        fs = self.create_fs()
+        bundle = io.BytesIO()
+        fs.irods_session.data_objects.open.return_value = bundle
+        conn = fs.irods_session.pool.get_connection.return_value.__enter__.return_value
+        fs.extract_bundle(io.BytesIO(b'tar'), '/zone/coll')
+        bundle_path = fs.irods_session.data_objects.open.call_args.args[0]
+        self.assertTrue(bundle_path.startswith('/zone/coll/' + fs_irods.BUNDLE_PREFIX))
+        message = conn.send.call_args.args[0]
+        self.assertEqual(message.int_info, api_number['STRUCT_FILE_EXT_AND_REG_AN'])
+        self.assertIn('<collection>/zone/coll</collection>', message.msg.pack())
+        fs.irods_session.data_objects.unlink.assert_called_once_with(bundle_path, force=True)
+
+    def test_register_files(self):
+        fs = self.create_fs(checksum='verify')
+        missing = IOError('no such file')
+
+        def register(physical, path, **options):
+            if path == '/zone/missing':
+                raise missing
+
+        fs.irods_session.data_objects.register.side_effect = register
+        errors = fs.register_files([('/data/file', '/zone/file', CHECKSUM),
+                                    ('/data/missing', '/zone/missing', None),
+                                    ('/data/other', '/zone/other', None),
+                                    ('/data/md5', '/zone/md5', hashlib.md5(b'data').hexdigest()),
+                                    ('/data/invalid', '/zone/invalid', 'not a checksum')])
+        self.assertEqual(errors, {'/zone/missing': missing})
+        calls = fs.irods_session.data_objects.register.call_args_list
+        self.assertEqual(len(calls), 5)
+        self.assertEqual(calls[0].args, ('/data/file', '/zone/file'))
+        self.assertEqual(calls[0].kwargs, {kw.DEST_RESC_NAME_KW: 'resc', kw.REG_CHKSUM_KW: IRODS_CHECKSUM})
+        # Without a sha256 checksum the server computes it
+        for call, path in zip(calls[2:], ['other', 'md5', 'invalid']):
+            self.assertEqual(call.args, ('/data/' + path, '/zone/' + path))
+            self.assertEqual(call.kwargs, {kw.DEST_RESC_NAME_KW: 'resc', kw.VERIFY_CHKSUM_KW: ''})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+
+from intorods.filesys.jobtable import ChecksumList, JobRow, JobTable
+from intorods.filesys.sync import CopyJob
+
+SHA256 = '9ee1e60c4cf9c254453b240c04a3c563380ff503485a620c55659cdb40aae43c'
+
+
+def make_jobs(n):
+    return [CopyJob('/src/dir{}/file{}'.format(i % 3, i), '/dest/dir{}/file{}'.format(i % 3, i),
+                    i % 2 == 0, SHA256 if i % 4 else 'sha2:AbC=' if i % 5 else None,
+                    i * 10 if i % 7 else None, 1700000000 + i if i % 3 else None)
+            for i in range(n)]
+
+
+def check_table(table, jobs):
+    assert len(table) == len(jobs)
+    assert list(table.values()) == [CopyJob(*job[:6]) for job in jobs]
+    assert list(table) == [job.source for job in jobs]
+    for job in jobs:
+        assert job.source in table
+        assert table[job.source] == CopyJob(*job[:6])
+    assert '/src/dir0/missing' not in table
+    assert '/other/file0' not in table
+    assert table.get('/other/file0') is None
+
+
+def test_jobtable():
+    jobs = make_jobs(50)
+    table = JobTable(job_type=CopyJob)
+    for job in jobs:
+        table.add(job)
+    check_table(table, jobs)
+    assert table.db is None
+
+
+def test_jobtable_replace():
+    table = JobTable()
+    jobs = make_jobs(5)
+    for job in jobs:
+        table.add(job)
+    # A replaced job keeps its position
+    jobs[2] = jobs[2]._replace(checksum='123', size=None)
+    table.add(jobs[2])
+    assert list(table.values()) == [JobRow(*job[:6]) for job in jobs]
+
+
+def test_jobtable_spill():
+    jobs = make_jobs(50)
+    table = JobTable(memory_budget=4000, job_type=CopyJob)
+    for job in jobs[:25]:
+        table.add(job)
+    assert table.db is not None
+    path = table.db_path
+    assert os.path.isfile(path)
+    for job in jobs[25:]:
+        table.add(job)
+    jobs[3] = jobs[3]._replace(dest='/dest/elsewhere/file3')
+    table.add(jobs[3])
+    check_table(table, jobs)
+    table.close()
+    assert not os.path.exists(path)
+
+
+def largest_first(jobs):
+    return sorted(jobs, key=lambda job: (job.size is not None, -(job.size or 0)))
+
+
+def test_jobtable_largest_first():
+    jobs = make_jobs(50)
+    table = JobTable(job_type=CopyJob)
+    for job in jobs:
+        table.add(job)
+    assert list(table.values(largest_first=True)) == [CopyJob(*job[:6]) for job in largest_first(jobs)]
+    assert table.db is None
+    # A table that cannot be ordered within its budget is ordered on disk
+    table.memory_budget = table.memory + 100
+    assert list(table.values(largest_first=True)) == [CopyJob(*job[:6]) for job in largest_first(jobs)]
+    assert table.db is not None
+    check_table(table, jobs)
+    table.close()
+
+
+def test_checksumlist():
+    cslist = ChecksumList(memory_budget=2000)
+    assert not cslist
+    for i in range(20):
+        cslist['dir/file{}'.format(i)] = SHA256 if i else None
+    assert cslist
+    assert cslist.table.db is not None
+    assert len(cslist) == 20
+    assert cslist['dir/file0'] is None
+    assert cslist['dir/file3'] == SHA256
+    assert list(cslist.items())[:2] == [('dir/file0', None), ('dir/file1', SHA256)]
+    cslist.close()
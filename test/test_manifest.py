@@ -0,0 +1,127 @@
+import gzip
+import io
+import json
+import unittest
+
+import mock
+from jsonschema import ValidationError
+
+import intorods.manifest
+from intorods.manifest import (FILE_FORMAT_BASECLEAR, FILE_FORMAT_GENERIC_JSON, FILE_FORMAT_TEXT,
+                               ManifestError, ManifestValidator, iter_json_records, iter_manifest)
+
+GENERIC_SCHEMA_FILE = 'schemas/pipeline_output_schema.json'
+BASECLEAR_SCHEMA_FILE = 'schemas/baseclear_checksum_file_schema.json'
+
+
+def generic_manifest(n):
+    return {
+        "collection": "/zone/home/run",
+        "objects": [{"path": "dir/file{}".format(i), "checksum": "{:064x}".format(i),
+                     "type": "dataobject", "create_time": 1700000000 + i}
+                    for i in range(n)] + [{"path": "dir", "checksum": "", "type": "collection"}],
+        "checksum_format": "sha256",
+        "version": 1,
+        "checksum_encoding": "hex"
+    }
+
+
+def load_validator(schema_file, file_format):
+    with open(schema_file) as f:
+        return ManifestValidator(json.load(f), intorods.manifest.MANIFEST_RECORDS[file_format])
+
+
+class TestManifest(unittest.TestCase):
+
+    def test_text_manifest(self):
+        data = b"123  file1\n456  dir/file 2\n\n"
+        result = list(iter_manifest(io.BytesIO(data), FILE_FORMAT_TEXT))
+        self.assertEqual(result, [("file1", "123"), ("dir/file 2", "456")])
+
+    def test_generic_manifest_streamed(self):
+        """
+        Test the records are read in small pieces, with members before and after the objects
+        """
+        data = json.dumps(generic_manifest(50), indent=2).encode()
+        validator = load_validator(GENERIC_SCHEMA_FILE, FILE_FORMAT_GENERIC_JSON)
+        with mock.patch.object(intorods.manifest, 'READ_SIZE', 7):
+            result = list(iter_manifest(io.BytesIO(data), FILE_FORMAT_GENERIC_JSON, validator))
+        self.assertEqual(len(result), 50)
+        self.assertEqual(result[3], ("dir/file3", "{:064x}".format(3)))
+
+    def test_gzip_manifest(self):
+        data = gzip.compress(json.dumps(generic_manifest(5)).encode())
+        result = list(iter_manifest(io.BytesIO(data), FILE_FORMAT_GENERIC_JSON))
+        self.assertEqual([path for path, _ in result], ["dir/file{}".format(i) for i in range(5)])
+
+    def test_baseclear_manifest(self):
+        validator = load_validator(BASECLEAR_SCHEMA_FILE, FILE_FORMAT_BASECLEAR)
+        with open('test/data/json_checksumfile2.json', 'rb') as fh:
+            result = list(iter_manifest(fh, FILE_FORMAT_BASECLEAR, validator))
+        self.assertEqual(len(result), 2)
+
+    def test_baseclear_duplicate_sample(self):
+        with open('test/data/json_checksumfile2.json') as f:
+            manifest = json.load(f)
+        manifest["samples"].append(manifest["samples"][0])
+        validator = load_validator(BASECLEAR_SCHEMA_FILE, FILE_FORMAT_BASECLEAR)
+        with self.assertRaises(ValidationError) as cm:
+            list(iter_manifest(io.BytesIO(json.dumps(manifest).encode()), FILE_FORMAT_BASECLEAR, validator))
+        self.assertEqual(cm.exception.validator, 'uniqueItems')
+
+    def test_record_count(self):
+        schema = {"type": "object", "properties": {"objects": {
+            "type": "array", "minItems": 2, "maxItems": 3, "items": {"type": "object"}}}}
+        for n, valid in ((1, False), (2, True), (3, True), (4, False)):
+            manifest = {"objects": [{"path": i} for i in range(n)]}
+            validator = ManifestValidator(schema, "objects")
+            header = {}
+            try:
+                for record in iter_json_records(io.StringIO(json.dumps(manifest)), "objects", header):
+                    validator.validate_record(record)
+                validator.validate_header(header)
+            except ValidationError:
+                self.assertFalse(valid, n)
+            else:
+                self.assertTrue(valid, n)
+
+    def test_unsupported_array_keyword(self):
+        schema = {"type": "object", "properties": {"objects": {
+            "type": "array", "contains": {"properties": {"type": {"const": "collection"}}, "required": ["type"]},
+            "items": {"type": "object", "required": ["path"]}}}}
+        validator = ManifestValidator(schema, "objects")
+        self.assertFalse(validator.streamed)
+        manifest = generic_manifest(3)
+        manifest["objects"].pop()
+        with self.assertRaises(ValidationError) as cm:
+            list(iter_manifest(io.BytesIO(json.dumps(manifest).encode()), FILE_FORMAT_GENERIC_JSON, validator))
+        self.assertEqual(cm.exception.validator, 'contains')
+        validator = ManifestValidator(schema, "objects")
+        result = list(iter_manifest(io.BytesIO(json.dumps(generic_manifest(3)).encode()),
+                                    FILE_FORMAT_GENERIC_JSON, validator))
+        self.assertEqual(len(result), 3)
+
+    def test_invalid_record(self):
+        manifest = generic_manifest(3)
+        del manifest["objects"][1]["checksum"]
+        validator = load_validator(GENERIC_SCHEMA_FILE, FILE_FORMAT_GENERIC_JSON)
+        records = iter_manifest(io.BytesIO(json.dumps(manifest).encode()), FILE_FORMAT_GENERIC_JSON, validator)
+        self.assertEqual(next(records)[0], "dir/file0")
+        with self.assertRaises(ValidationError):
+            next(records)
+
+    def test_missing_records(self):
+        manifest = generic_manifest(3)
+        del manifest["objects"]
+        validator = load_validator(GENERIC_SCHEMA_FILE, FILE_FORMAT_GENERIC_JSON)
+        with self.assertRaises(ValidationError):
+            list(iter_manifest(io.BytesIO(json.dumps(manifest).encode()), FILE_FORMAT_GENERIC_JSON, validator))
+
+    def test_truncated_manifest(self):
+        data = json.dumps(generic_manifest(3)).encode()[:-20]
+        with self.assertRaises(ManifestError):
+            list(iter_manifest(io.BytesIO(data), FILE_FORMAT_GENERIC_JSON))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+import sys
+
+import mock
+import pytest
+
+from intorods.filesys.fs_local import file_local, fs_local
+from intorods.filesys.plan import (PLAN_CHANGED, PLAN_EXCLUDED, PLAN_IDENTICAL, PLAN_MISSING,
+                                   PLAN_NEW, PLAN_UNKNOWN, PLAN_VERIFIED, plan_category, plan_sync,
+                                   write_plan)
+from intorods.filesys.statedb import SyncState
+from intorods.intorods import factory, main, sync
+
+
+def make_files(base, files):
+    for relpath, data in files.items():
+        path = os.path.join(base, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(data)
+
+
+def test_plan_sync(tmp_path):
+    source = os.path.join(str(tmp_path), 'source')
+    dest = os.path.join(str(tmp_path), 'dest')
+    make_files(source, {'same': 'aaaa', 'changed': 'bbbb', 'sub/new': 'cccccc',
+                        'skip.tmp': 'dd', 'work/file': 'e'})
+    make_files(dest, {'changed': 'b'})
+    shutil.copy2(os.path.join(source, 'same'), os.path.join(dest, 'same'))
+    fs = factory.createfs('local')
+    for dest_index in [True, False]:
+        totals = plan_sync(fs, source, fs, dest, filelist={'missing': None}, scan=True,
+                           excludelist=['.*\\.tmp$', 'work/'], dest_index=dest_index)
+        assert totals[PLAN_NEW] == {'files': 1, 'bytes': 6}
+        assert totals[PLAN_CHANGED] == {'files': 1, 'bytes': 4}
+        assert totals[PLAN_IDENTICAL] == {'files': 1, 'bytes': 4}
+        assert totals[PLAN_EXCLUDED] == {'files': 1, 'bytes': 2}
+        assert totals[PLAN_MISSING]['files'] == 1
+        assert totals['excluded_directories'] == 1
+        assert totals['largest'] == (os.path.join(source, 'sub', 'new'), 6)
+    # Nothing is created at the destination
+    assert not os.path.exists(os.path.join(dest, 'sub'))
+
+
+def test_plan_category():
+    assert plan_category(1, 10, None, 2, 10, None) == PLAN_CHANGED
+    assert plan_category(1, 10, None, 1, 11, None) == PLAN_CHANGED
+    assert plan_category(1, 10, None, 1, 11, None, compare=False) == PLAN_IDENTICAL
+    assert plan_category(1, 10, 'a', 1, 11, None, compareChecksums=True) == PLAN_UNKNOWN
+    assert plan_category(1, 10, 'a', 1, 11, 'a', compareChecksums=True) == PLAN_IDENTICAL
+    assert plan_category(1, 10, 'a', 1, 10, 'b', compareChecksums=True) == PLAN_CHANGED
+
+
+def test_plan_no_checksums(tmp_path):
+    """
+    Test a plan with checksums does not compute them
+    """
+    source = os.path.join(str(tmp_path), 'source')
+    dest = os.path.join(str(tmp_path), 'dest')
+    make_files(source, {'same': 'aaaa', 'changed': 'bbbb'})
+    make_files(dest, {'changed': 'b'})
+    shutil.copy2(os.path.join(source, 'same'), os.path.join(dest, 'same'))
+    fs = factory.createfs('local')
+    with mock.patch.object(file_local, 'calculate_checksum', side_effect=AssertionError('checksum computed')):
+        for dest_index in [True, False]:
+            totals = plan_sync(fs, source, fs, dest, compareChecksums=True, scan=True, dest_index=dest_index)
+            assert totals[PLAN_UNKNOWN] == {'files': 1, 'bytes': 4}
+            assert totals[PLAN_CHANGED] == {'files': 1, 'bytes': 4}
+
+
+def test_plan_state(tmp_path):
+    source = os.path.join(str(tmp_path), 'source')
+    dest = os.path.join(str(tmp_path), 'dest')
+    make_files(source, {'a': 'aaaa', 'b': 'bb'})
+    fs = factory.createfs('local')
+    state = SyncState(os.path.join(str(tmp_path), 'state.db'))
+    assert sync(fs, source, fs, dest, 'local', {}, 'local', {}, scan=True, engine='threads', state=state) == True
+    make_files(source, {'b': 'bbb'})
+    totals = plan_sync(fs, source, fs, dest, scan=True, state=state)
+    assert totals[PLAN_VERIFIED] == {'files': 1, 'bytes': 4}
+    assert totals[PLAN_CHANGED] == {'files': 1, 'bytes': 3}
+    # A plan with checksums does not rely on files verified without them
+    totals = plan_sync(fs, source, fs, dest, compareChecksums=True, scan=True, state=state)
+    assert totals[PLAN_VERIFIED]['files'] == 0
+    state.close()
+
+
+def test_main_plan_closes_state(tmp_path):
+    source = os.path.join(str(tmp_path), 'source')
+    dest = os.path.join(str(tmp_path), 'dest')
+    make_files(source, {'a': 'aaaa'})
+    os.makedirs(dest)
+    plan_file = os.path.join(str(tmp_path), 'plan.json')
+    args = ['intorods', '--plan', plan_file, '--state_db', os.path.join(str(tmp_path), 'state.db'),
+            '--debuglevel', '1', source, dest]
+    with mock.patch.dict(factory._fscreators, {'irods': lambda **options: fs_local()}), \
+            mock.patch.object(sys, 'argv', args), \
+            mock.patch.object(SyncState, 'close', autospec=True, side_effect=SyncState.close) as close:
+        with pytest.raises(SystemExit) as ex:
+            main()
+    assert ex.value.code == 0
+    assert close.call_count == 1
+    with open(plan_file) as f:
+        assert json.load(f)['folders'][0]['new']['files'] == 1
+
+
+def test_write_plan(tmp_path):
+    source = os.path.join(str(tmp_path), 'source')
+    make_files(source, {'a': 'x' * 1000, 'b/c': 'y' * 10})
+    fs = factory.createfs('local')
+    dest = os.path.join(str(tmp_path), 'dest')
+    totals = plan_sync(fs, source, fs, dest, scan=True)
+    assert totals[PLAN_NEW] == {'files': 2, 'bytes': 1010}
+    assert not os.path.exists(dest)
+    plan_file = os.path.join(str(tmp_path), 'plan.json')
+    write_plan(plan_file, [(source, dest, totals)], fs, throughput=1000, workers=2)
+    with open(plan_file) as f:
+        plan = json.load(f)
+    assert plan['throughput_measured'] == False
+    assert plan['folders'][0]['new'] == {'files': 2, 'bytes': 1010}
+    assert plan['total']['duration'] > 1.01
+    # The throughput is measured by reading the largest file
+    plan = write_plan(plan_file, [(source, dest, totals)], fs)
+    assert plan['throughput_measured'] == True
+    assert plan['throughput'] > 0
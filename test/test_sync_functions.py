@@ -4,8 +4,26 @@ import sys
 sys.path.insert(1, os.path.join(sys.path[0], ".."))
 
 import filecmp
+import re
+import shutil
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from intorods.intorods import factory, sync
+import mock
+import pytest
+
+from intorods.filesys.sync import (JOB_SYNCED, MAX_ERRQUEUE_RETRIES, AsyncioEngine, BandwidthLimiter, CopyJob,
+                                  ProcessEngine, ThreadEngine,
+                                  batch_copyjobs, dest_equal, excludes_tree, physical_path, index_copyjobs, largest_worker_load,
+                                  iter_copyjobs, stream_copyjobs, sync_file, unit_size)
+from intorods.filesys.fs_base import FileStat, fs_base, fsPool, parallel_walk
+from intorods.filesys.fs_local import file_local, fs_local
+from intorods.filesys.jobtable import JobTable
+from intorods.filesys.statedb import SyncState
+from intorods.filesys.yml_filter import PathFilter
+from intorods.intorods import factory, main, sync
 
 #
 # def sync(sourcefs, sourcepath, destfs, destpath, sfs_name, sfs_opts, dfs_name, dfs_opts,
@@ -63,3 +81,719 @@ def test_sync_scan():
 
 
 
+def test_sync_streaming(tmp_path):
+    outputpath = str(tmp_path)
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local')
+    LIST = {
+        'file1': '9ee1e60c4cf9c254453b240c04a3c563380ff503485a620c55659cdb40aae43c'
+    }
+    result = sync(fs_source, inputpath,
+            fs_dest, outputpath,
+            'local', {},
+            'local', {},
+            compareChecksums=True,
+            filelist=LIST, scan=True,
+            worker_processes=2, excludelist=[],
+            compare=True,
+            minimum_age=0, cs_filters=[],
+            scan_filters=[], streaming=True)
+    assert result == True
+    assert filecmp.cmp(os.path.join(inputpath, 'file1'), os.path.join(outputpath, 'file1'), shallow=False) == True
+    assert filecmp.cmp(os.path.join(inputpath, 'file2'), os.path.join(outputpath, 'file2'), shallow=False) == True
+
+def test_stream_copyjobs_dedup(tmp_path):
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local')
+    LIST = {'file1': '123'}
+    jobs = list(stream_copyjobs(fs_source, inputpath, fs_dest, str(tmp_path),
+                                filelist=LIST, scan=True))
+    sources = [job[0] for job in jobs]
+    assert len(sources) == len(set(sources)) == 2
+    # The filelist entry, which carries the checksum, takes precedence
+    assert jobs[0][0] == os.path.join(inputpath, 'file1')
+    assert jobs[0][3] == '123'
+
+def test_sync_missing_file(tmp_path):
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local')
+    LIST = {'file1': None, 'missing_file': None}
+    result = sync(fs_source, inputpath,
+            fs_dest, str(tmp_path),
+            'local', {},
+            'local', {},
+            filelist=LIST, scan=False,
+            worker_processes=2)
+    assert result == False
+    assert os.path.isfile(os.path.join(str(tmp_path), 'file1'))
+
+def test_batch_copyjobs():
+    jobs = [CopyJob('s{}'.format(i), 'd{}'.format(i), False, None, 100) for i in range(5)]
+    jobs.append(CopyJob('large', 'large', False, None, 10 * 1024 * 1024))
+    jobs.append(CopyJob('unknown', 'unknown', False, None, None))
+    units = list(batch_copyjobs(jobs, batch_files=2, batch_bytes=1000))
+    assert [len(unit) for unit in units] == [2, 2, 1, 1, 1]
+    assert units[2][0].source == 'large'
+    assert units[4][0].source == 's4'
+    units = list(batch_copyjobs(jobs[:5], batch_files=10, batch_bytes=250))
+    assert [len(unit) for unit in units] == [2, 2, 1]
+    units = list(batch_copyjobs(jobs))
+    assert all(len(unit) == 1 for unit in units)
+
+def test_sync_batched(tmp_path):
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local')
+    result = sync(fs_source, inputpath,
+            fs_dest, str(tmp_path),
+            'local', {},
+            'local', {},
+            compareChecksums=True, scan=True,
+            worker_processes=2, batch_files=10)
+    assert result == True
+    assert filecmp.cmp(os.path.join(inputpath, 'file1'), os.path.join(str(tmp_path), 'file1'), shallow=False) == True
+    assert filecmp.cmp(os.path.join(inputpath, 'file2'), os.path.join(str(tmp_path), 'file2'), shallow=False) == True
+
+class fs_bundles(fs_local):
+    """Local filesystem that extracts bundles like iRODS does, from memory
+    and without keeping the modification times. fail makes every extraction fail
+    """
+    supports_bundles = True
+    bundles = []
+    fail = False
+
+    def extract_bundle(self, fp, path):
+        if fs_bundles.fail:
+            raise IOError('extraction failed')
+        with tarfile.open(fileobj=fp) as tar:
+            fs_bundles.bundles.append(tar.getnames())
+            for member in tar.getmembers():
+                os.makedirs(os.path.dirname(os.path.join(path, member.name)), exist_ok=True)
+                with open(os.path.join(path, member.name), 'wb') as f:
+                    f.write(tar.extractfile(member).read())
+
+factory.register('local_bundles', fs_bundles, '')
+
+@pytest.mark.parametrize("engine", ['threads', 'asyncio'])
+def test_sync_bundle(tmp_path, engine):
+    source = os.path.join(str(tmp_path), 'source')
+    dest = os.path.join(str(tmp_path), 'dest')
+    shutil.copytree(inputpath, os.path.join(source, 'sub'))
+    shutil.copy(os.path.join(inputpath, 'file1'), source)
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local_bundles')
+    fs_bundles.bundles = []
+    result = sync(fs_source, source, fs_dest, dest, 'local', {}, 'local_bundles', {},
+                  compareChecksums=True, scan=True, worker_processes=1, batch_files=10,
+                  engine=engine, bundle=True)
+    assert result == True
+    assert [sorted(names) for names in fs_bundles.bundles] == [['file1', 'sub/file1', 'sub/file2']]
+    for relpath in ['file1', 'sub/file1', 'sub/file2']:
+        assert filecmp.cmp(os.path.join(source, relpath), os.path.join(dest, relpath), shallow=False) == True
+        assert int(os.stat(os.path.join(dest, relpath)).st_mtime) == int(os.stat(os.path.join(source, relpath)).st_mtime)
+
+def test_sync_bundle_failed(tmp_path):
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local_bundles')
+    fs_bundles.fail = True
+    try:
+        # The files are copied one by one when the bundle fails
+        result = sync(fs_source, inputpath, fs_dest, str(tmp_path), 'local', {}, 'local_bundles', {},
+                      scan=True, worker_processes=1, batch_files=10, engine='threads', bundle=True)
+    finally:
+        fs_bundles.fail = False
+    assert result == True
+    assert filecmp.cmp(os.path.join(inputpath, 'file2'), os.path.join(str(tmp_path), 'file2'), shallow=False) == True
+
+class fs_register(fs_local):
+    """Local filesystem that registers files as symbolic links to their physical path"""
+    registered = []
+    calls = 0
+
+    def register_files(self, files):
+        fs_register.calls += 1
+        for physical, path, checksum in files:
+            fs_register.registered.append((physical, path, checksum))
+            os.symlink(physical, path)
+        return {}
+
+factory.register('local_register', fs_register, '')
+
+def test_physical_path():
+    assert physical_path('/data/run/file', ('/data', '/mnt/data/')) == '/mnt/data/run/file'
+    assert physical_path('/database/file', ('/data', '/mnt/data')) == '/database/file'
+    assert physical_path('/data/file', ('', '')) == '/data/file'
+
+@pytest.mark.parametrize("engine", ['threads', 'asyncio'])
+def test_sync_register(tmp_path, engine):
+    source = os.path.join(str(tmp_path), 'source')
+    dest = os.path.join(str(tmp_path), 'dest')
+    shutil.copytree(inputpath, source)
+    os.makedirs(dest)
+    with open(os.path.join(dest, 'file2'), 'w') as f:
+        f.write('other data')
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local_register')
+    fs_register.registered = []
+    fs_register.calls = 0
+    LIST = {'file1': '9ee1e60c4cf9c254453b240c04a3c563380ff503485a620c55659cdb40aae43c'}
+    result = sync(fs_source, source, fs_dest, dest, 'local', {}, 'local_register', {},
+                  filelist=LIST, scan=True, worker_processes=2, engine=engine,
+                  register=(source, '/physical'))
+    # A destination that differs is not replaced
+    assert result == False
+    assert fs_register.registered == [('/physical/file1', os.path.join(dest, 'file1'), LIST['file1'])]
+    # The files are registered in a single call, the file that failed is
+    # retried by itself
+    assert fs_register.calls == 1 + MAX_ERRQUEUE_RETRIES
+    with open(os.path.join(dest, 'file2')) as f:
+        assert f.read() == 'other data'
+
+class fs_bundles_irods(fs_bundles):
+    """fs_bundles that takes the iRODS options, to stand in for iRODS in main"""
+
+    def __init__(self, **options):
+        super().__init__()
+
+@pytest.mark.parametrize("search", [True, False])
+def test_main_bundle(tmp_path, search):
+    source = os.path.join(str(tmp_path), 'source')
+    dest = os.path.join(str(tmp_path), 'dest')
+    shutil.copytree(inputpath, os.path.join(source, 'run'))
+    os.makedirs(dest)
+    fs_bundles.bundles = []
+    args = ['intorods', '--batch_files', '10', '--bundle', '--engine', 'threads', '--debuglevel', '1']
+    if search:
+        args += ['--search', source, dest]
+    else:
+        os.makedirs(os.path.join(dest, 'run'))
+        args += [os.path.join(source, 'run'), os.path.join(dest, 'run')]
+    with mock.patch.dict(factory._fscreators, {'irods': fs_bundles_irods}), \
+            mock.patch.object(sys, 'argv', args):
+        try:
+            main()
+        except SystemExit as ex:
+            # A single folder exits with the result of the sync
+            assert ex.code == 0
+    assert [sorted(names) for names in fs_bundles.bundles] == [['file1', 'file2']]
+    for name in ['file1', 'file2']:
+        assert filecmp.cmp(os.path.join(source, 'run', name), os.path.join(dest, 'run', name), shallow=False) == True
+
+def test_search_failure_stops_engine(tmp_path):
+    source = os.path.join(str(tmp_path), 'source')
+    dest = os.path.join(str(tmp_path), 'dest')
+    shutil.copytree(inputpath, os.path.join(source, 'run'))
+    os.makedirs(dest)
+    args = ['intorods', '--engine', 'threads', '--debuglevel', '1', '--search', source, dest]
+    with mock.patch.dict(factory._fscreators, {'irods': fs_bundles_irods}), \
+            mock.patch.object(sys, 'argv', args), \
+            mock.patch('intorods.intorods.sync_folder', side_effect=RuntimeError('sync failed')), \
+            mock.patch.object(ThreadEngine, 'stop', autospec=True, side_effect=ThreadEngine.stop) as stop, \
+            mock.patch.object(ThreadEngine, 'cleanup', autospec=True, side_effect=ThreadEngine.cleanup) as cleanup:
+        with pytest.raises(RuntimeError):
+            main()
+    # The shared workers are stopped, although the folder raised
+    assert stop.call_count == 1
+    assert cleanup.call_count == 1
+
+def test_search_parallel_folders_result(tmp_path):
+    source = os.path.join(str(tmp_path), 'source')
+    dest = os.path.join(str(tmp_path), 'dest')
+    for folder in ['run1', 'run2']:
+        shutil.copytree(inputpath, os.path.join(source, folder))
+    os.makedirs(dest)
+    args = ['intorods', '--engine', 'threads', '--parallel_folders', '2', '--debuglevel', '1',
+            '--search', source, dest]
+    createfs = factory.createfs
+
+    def connect_in_main_thread(name, **options):
+        if threading.current_thread() is not threading.main_thread():
+            raise ConnectionError('cannot connect')
+        return createfs(name, **options)
+
+    with mock.patch.dict(factory._fscreators, {'irods': fs_bundles_irods}), \
+            mock.patch.object(sys, 'argv', args):
+        # A folder that fails makes the run fail
+        with mock.patch('intorods.intorods.sync_folder', side_effect=[True, False]), \
+                pytest.raises(SystemExit) as ex:
+            main()
+        assert ex.value.code == 1
+        # An exception of a folder synced in the background is raised
+        with mock.patch('intorods.intorods.sync_folder', return_value=True), \
+                mock.patch.object(factory, 'createfs', side_effect=connect_in_main_thread), \
+                pytest.raises(ConnectionError):
+            main()
+        with mock.patch('intorods.intorods.sync_folder', return_value=True):
+            main()
+
+def test_largest_worker_load():
+    units = [[CopyJob('s', 'd', False, None, size)] for size in [None, 8, 7]]
+    units.append([CopyJob('s', 'd', False, None, 1), CopyJob('s', 'd', False, None, 3)])
+    units += [[CopyJob('s', 'd', False, None, size)] for size in [2, 1]]
+    assert [unit_size(unit) for unit in units] == [None, 8, 7, 4, 2, 1]
+    load, total_bytes, unknown = largest_worker_load(units, 2)
+    assert (load, total_bytes, unknown) == (11, 22, 1)
+
+def test_sync_threads(tmp_path):
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local')
+    result = sync(fs_source, inputpath,
+            fs_dest, str(tmp_path),
+            'local', {},
+            'local', {},
+            compareChecksums=True, scan=True,
+            worker_processes=2, engine='threads')
+    assert result == True
+    assert filecmp.cmp(os.path.join(inputpath, 'file1'), os.path.join(str(tmp_path), 'file1'), shallow=False) == True
+    assert filecmp.cmp(os.path.join(inputpath, 'file2'), os.path.join(str(tmp_path), 'file2'), shallow=False) == True
+
+def test_fspool():
+    pool = fsPool('local')
+    fs1 = pool.acquire()
+    fs2 = pool.acquire()
+    assert fs1 is not fs2
+    pool.release(fs1)
+    assert pool.acquire() is fs1
+    pool.cleanup()
+
+def test_fspool_limit():
+    pool = fsPool('local', max_connections=1)
+    fs1 = pool.acquire()
+    with ThreadPoolExecutor(1) as executor:
+        waiting = executor.submit(pool.acquire)
+        time.sleep(0.1)
+        assert not waiting.done()
+        pool.release(fs1)
+        assert waiting.result(timeout=5) is fs1
+    pool.cleanup()
+
+def test_sync_asyncio(tmp_path):
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local')
+    result = sync(fs_source, inputpath,
+            fs_dest, str(tmp_path),
+            'local', {},
+            'local', {},
+            compareChecksums=True, scan=True,
+            worker_processes=2, engine='asyncio', batch_files=10)
+    assert result == True
+    assert filecmp.cmp(os.path.join(inputpath, 'file1'), os.path.join(str(tmp_path), 'file1'), shallow=False) == True
+    assert filecmp.cmp(os.path.join(inputpath, 'file2'), os.path.join(str(tmp_path), 'file2'), shallow=False) == True
+
+class fs_slow(fs_local):
+    """Local filesystem of which every file takes a while to write. Counts
+    the connections and the files that are written at the same time
+    """
+    lock = threading.Lock()
+    connections = 0
+    active = 0
+    max_active = 0
+
+    def __init__(self):
+        super().__init__()
+        with fs_slow.lock:
+            fs_slow.connections += 1
+
+    def createfile(self, path, checksum=None):
+        with fs_slow.lock:
+            fs_slow.active += 1
+            fs_slow.max_active = max(fs_slow.max_active, fs_slow.active)
+        time.sleep(0.2)
+        fp = super().createfile(path, checksum=checksum)
+        close = fp.close
+
+        def close_written():
+            with fs_slow.lock:
+                fs_slow.active -= 1
+            close()
+        fp.close = close_written
+        return fp
+
+factory.register('local_slow', fs_slow, '')
+
+def test_sync_asyncio_concurrent(tmp_path):
+    source = os.path.join(str(tmp_path), 'source')
+    os.makedirs(source)
+    for i in range(8):
+        with open(os.path.join(source, 'file{}'.format(i)), 'w') as f:
+            f.write('data {}'.format(i))
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local_slow')
+    fs_slow.connections = 0
+    fs_slow.max_active = 0
+    result = sync(fs_source, source, fs_dest, os.path.join(str(tmp_path), 'dest'), 'local', {}, 'local_slow', {},
+                  scan=True, worker_processes=3, engine='asyncio', max_connections=4)
+    assert result == True
+    # The files are copied at the same time, by at most the number of workers,
+    # over at most max_connections connections
+    assert 2 <= fs_slow.max_active <= 3
+    assert fs_slow.connections <= 4
+
+class fs_gated(fs_local):
+    """Local filesystem of which files are only written once the gate is opened"""
+    gate = threading.Event()
+
+    def createfile(self, path, checksum=None):
+        fs_gated.gate.wait(10)
+        return super().createfile(path, checksum=checksum)
+
+factory.register('local_gated', fs_gated, '')
+
+def test_asyncio_engine_connections(tmp_path):
+    source = os.path.join(str(tmp_path), 'source')
+    dest = os.path.join(str(tmp_path), 'dest')
+    os.makedirs(source)
+    os.makedirs(dest)
+    for i in range(8):
+        with open(os.path.join(source, 'file{}'.format(i)), 'w') as f:
+            f.write('data {}'.format(i))
+        # All but two files are present at the destination
+        if i >= 2:
+            shutil.copy2(os.path.join(source, 'file{}'.format(i)), dest)
+    fs_gated.gate.clear()
+    engine = AsyncioEngine('local', {}, 'local_gated', {}, workers=1, max_connections=2)
+    channel = engine.open_channel()
+    engine.start_workers(1)
+    try:
+        for i in range(8):
+            job = CopyJob(os.path.join(source, 'file{}'.format(i)), os.path.join(dest, 'file{}'.format(i)), False, None)
+            engine.put(channel, (engine.new_unit_id(), [job]), 5)
+        # One file is being copied and the other waits for the transfer slot,
+        # without holding a connection, so the present files are compared
+        for _ in range(6):
+            _, unit_id, results = engine.get(channel, 5)
+            assert unit_id > 2
+            assert results[0][0] == JOB_SYNCED
+        fs_gated.gate.set()
+        for _ in range(2):
+            _, unit_id, results = engine.get(channel, 5)
+            assert results[0][0] == JOB_SYNCED
+    finally:
+        fs_gated.gate.set()
+        engine.stop()
+        engine.cleanup()
+    assert filecmp.cmp(os.path.join(source, 'file0'), os.path.join(dest, 'file0'), shallow=False) == True
+
+def test_sync_persistent_engine(tmp_path):
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local')
+    engine = ProcessEngine('local', {}, 'local', {})
+    for folder in ['folder1', 'folder2']:
+        outputpath = os.path.join(str(tmp_path), folder)
+        result = sync(fs_source, inputpath,
+                fs_dest, outputpath,
+                'local', {},
+                'local', {},
+                compareChecksums=True, scan=True,
+                worker_processes=2, engine=engine)
+        assert result == True
+        assert filecmp.cmp(os.path.join(inputpath, 'file1'), os.path.join(outputpath, 'file1'), shallow=False) == True
+        # The workers of the first sync are still running for the second one
+        assert len(engine.workers) == 2
+        assert engine.worker_count == 2
+    engine.stop()
+    engine.cleanup()
+    assert not engine.workers
+
+def test_sync_concurrent_folders(tmp_path):
+    engine = ThreadEngine('local', {}, 'local', {})
+
+    def sync_folder(folder):
+        outputpath = os.path.join(str(tmp_path), folder)
+        return sync(factory.createfs('local'), inputpath,
+                factory.createfs('local'), outputpath,
+                'local', {},
+                'local', {},
+                compareChecksums=True, scan=True,
+                worker_processes=2, engine=engine)
+
+    folders = ['folder{}'.format(i) for i in range(4)]
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(sync_folder, folders))
+    engine.stop()
+    engine.cleanup()
+    assert results == [True] * 4
+    for folder in folders:
+        assert filecmp.cmp(os.path.join(inputpath, 'file2'), os.path.join(str(tmp_path), folder, 'file2'), shallow=False) == True
+    # All folders share the workers of the engine
+    assert engine.worker_count == 2
+
+def test_bandwidth_limiter():
+    limiter = BandwidthLimiter(1000)
+    ts_start = time.monotonic()
+    limiter.consume(1500)
+    assert time.monotonic() - ts_start < 0.25
+    # The 500 bytes over budget are paid back before the next transfer
+    limiter.consume(10)
+    assert time.monotonic() - ts_start >= 0.45
+
+def test_index_copyjobs(tmp_path):
+    fs = factory.createfs('local')
+    os.makedirs(os.path.join(str(tmp_path), 'sub'))
+    with open(os.path.join(str(tmp_path), 'sub', 'file3'), 'w') as f:
+        f.write('abc')
+    index = fs.lsindex(str(tmp_path))
+    assert list(index) == [os.path.join('sub', 'file3')]
+    assert index[os.path.join('sub', 'file3')].size == 3
+    jobs = [CopyJob('s3', os.path.join(str(tmp_path), 'sub', 'file3'), False, None, 3),
+            CopyJob('s4', os.path.join(str(tmp_path), 'file4'), False, None, 3)]
+    jobs = list(index_copyjobs(jobs, str(tmp_path), index))
+    assert jobs[0].dest_stat.size == 3
+    assert jobs[1].dest_stat is None
+
+def test_dest_equal_checksum_after_stat(tmp_path):
+    fs = factory.createfs('local')
+    entry = fs.getfile(os.path.join(inputpath, 'file1'))
+    dest = os.path.join(str(tmp_path), 'file1')
+    shutil.copyfile(entry.path, dest)
+    size, mtime = entry.filesize(), entry.utc_mtime()
+    with mock.patch.object(fs, 'getfile', wraps=fs.getfile) as getfile:
+        # The destination checksum is only computed when size and mtime match
+        assert dest_equal(entry, fs, dest, FileStat(size + 1, mtime, None), True, True) is False
+        assert dest_equal(entry, fs, dest, FileStat(size, mtime + 1, None), True, True) is False
+        assert getfile.call_count == 0
+        assert dest_equal(entry, fs, dest, FileStat(size, mtime, None), True, True)
+        getfile.assert_called_once_with(dest)
+
+def test_sync_file_dest_stat(tmp_path):
+    fs = factory.createfs('local')
+    source = os.path.join(inputpath, 'file1')
+    dest = os.path.join(str(tmp_path), 'file1')
+    job = CopyJob(source, dest, False, None, None)
+    assert sync_file(0, fs, fs, job, True, 0)[2] == 1
+    # A destination from the index that equals the source is not copied again
+    job = job._replace(dest_stat=fs.lsindex(str(tmp_path))['file1'])
+    assert sync_file(0, fs, fs, job, True, 0) == ('synced', os.path.getsize(source), 0)
+
+def test_copyto_checksum(tmp_path):
+    fs = factory.createfs('local')
+    source = os.path.join(inputpath, 'file1')
+    entry = fs.getfile(source)
+    entry.copyto(fs, os.path.join(str(tmp_path), 'file1'))
+    # The checksum is computed while copying
+    assert entry._checksum == fs.getfile(os.path.join(str(tmp_path), 'file1')).calculate_checksum()
+    # A checksum from a checksum file is kept
+    entry = fs.getfile(source)
+    entry.checksum = '123'
+    entry.copyto(fs, os.path.join(str(tmp_path), 'file2'))
+    assert entry.checksum == '123'
+
+def test_sync_file_reads_source_once(tmp_path, monkeypatch):
+    fs = factory.createfs('local')
+    reads = []
+    open_file = file_local.open
+    monkeypatch.setattr(file_local, 'open', lambda self, mode: reads.append(self.path) or open_file(self, mode))
+    job = CopyJob(os.path.join(inputpath, 'file1'), os.path.join(str(tmp_path), 'file1'), True, None, None)
+    assert sync_file(0, fs, fs, job, True, 0)[0] == 'synced'
+    # The source is read once to copy it, the destination once to verify it
+    assert reads == [os.path.join(inputpath, 'file1'), os.path.join(str(tmp_path), 'file1')]
+
+def test_sync_dest_index(tmp_path):
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local')
+    for _ in range(2):
+        result = sync(fs_source, inputpath,
+                fs_dest, str(tmp_path),
+                'local', {},
+                'local', {},
+                compareChecksums=True, scan=True,
+                worker_processes=2, engine='threads')
+        assert result == True
+        assert filecmp.cmp(os.path.join(inputpath, 'file1'), os.path.join(str(tmp_path), 'file1'), shallow=False) == True
+        # A changed destination file is copied again
+        with open(os.path.join(str(tmp_path), 'file1'), 'w') as f:
+            f.write('changed')
+        os.utime(os.path.join(str(tmp_path), 'file1'), (0, 0))
+
+def test_walk(tmp_path):
+    fs = factory.createfs('local')
+    os.makedirs(os.path.join(str(tmp_path), 'sub', 'subsub'))
+    for relpath in ['file1', os.path.join('sub', 'file2'), os.path.join('sub', 'subsub', 'file3')]:
+        with open(os.path.join(str(tmp_path), relpath), 'w') as f:
+            f.write(relpath)
+    entries = list(fs.walk(str(tmp_path)))
+    files = {os.path.relpath(e.path, str(tmp_path)): e.stat.size for e in entries if not e.isdir}
+    assert files == {'file1': 5, 'sub/file2': 9, 'sub/subsub/file3': 16}
+    assert sorted(e.path for e in entries if e.isdir) == [os.path.join(str(tmp_path), 'sub'),
+                                                          os.path.join(str(tmp_path), 'sub', 'subsub')]
+    # The native listing has the same attributes as the generic one
+    assert sorted(fs.scandir(str(tmp_path))) == sorted(fs_base.scandir(fs, str(tmp_path)))
+
+def test_scan_broken_link(tmp_path):
+    source = os.path.join(str(tmp_path), 'source')
+    dest = os.path.join(str(tmp_path), 'dest')
+    os.makedirs(source)
+    with open(os.path.join(source, 'file'), 'w') as f:
+        f.write('data')
+    os.symlink(os.path.join(source, 'missing'), os.path.join(source, 'link'))
+    fs = factory.createfs('local')
+    assert sorted(fs.scandir(source)) == [(os.path.join(source, 'file'), False, FileStat(4, mock.ANY, None)),
+                                          (os.path.join(source, 'link'), False, None)]
+    # Only the job of the broken link fails, the other files are synced
+    assert sync(fs, source, fs, dest, 'local', {}, 'local', {}, scan=True, engine='threads') == False
+    assert filecmp.cmp(os.path.join(source, 'file'), os.path.join(dest, 'file'), shallow=False)
+
+def test_parallel_walk(tmp_path):
+    for i in range(5):
+        os.makedirs(os.path.join(str(tmp_path), 'dir{}'.format(i), 'sub'))
+        with open(os.path.join(str(tmp_path), 'dir{}'.format(i), 'sub', 'file'), 'w') as f:
+            f.write('data')
+    fs = factory.createfs('local')
+    pool = fsPool('local')
+    # In ordered mode the entries come in the order of walk
+    assert list(parallel_walk(pool, str(tmp_path), 3, ordered=True)) == list(fs.walk(str(tmp_path)))
+    assert sorted(parallel_walk(pool, str(tmp_path), 3)) == sorted(fs.walk(str(tmp_path)))
+    pool.cleanup()
+
+def test_parallel_walk_stopped(tmp_path):
+    for i in range(20):
+        os.makedirs(os.path.join(str(tmp_path), 'dir{}'.format(i), 'sub'))
+    listed = []
+    scandir = fs_local.scandir
+
+    def slow_scandir(fs, path):
+        listed.append(path)
+        time.sleep(0.02)
+        return scandir(fs, path)
+
+    pool = fsPool('local')
+    with mock.patch.object(fs_local, 'scandir', slow_scandir):
+        walk = parallel_walk(pool, str(tmp_path), 2)
+        next(walk)
+        walk.close()
+    # The listings that had not started when the walk stopped are cancelled
+    assert len(listed) < 10
+    pool.cleanup()
+
+def test_sync_scan_threads(tmp_path):
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local')
+    result = sync(fs_source, inputpath,
+            fs_dest, str(tmp_path),
+            'local', {},
+            'local', {},
+            compareChecksums=True, scan=True,
+            worker_processes=2, scan_threads=4)
+    assert result == True
+    assert filecmp.cmp(os.path.join(inputpath, 'file1'), os.path.join(str(tmp_path), 'file1'), shallow=False) == True
+
+def test_sync_job_memory(tmp_path):
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local')
+    LIST = {'file1': '9ee1e60c4cf9c254453b240c04a3c563380ff503485a620c55659cdb40aae43c'}
+    # The copy jobs do not fit in memory, so they are moved to a file
+    result = sync(fs_source, inputpath,
+            fs_dest, str(tmp_path),
+            'local', {},
+            'local', {},
+            compareChecksums=True, filelist=LIST, scan=True,
+            worker_processes=2, job_memory=1)
+    assert result == True
+    assert filecmp.cmp(os.path.join(inputpath, 'file2'), os.path.join(str(tmp_path), 'file2'), shallow=False) == True
+
+def test_sync_units_in_flight(tmp_path):
+    source = os.path.join(str(tmp_path), 'source')
+    dest = os.path.join(str(tmp_path), 'dest')
+    os.mkdir(source)
+    for i in range(20):
+        with open(os.path.join(source, 'file{}'.format(i)), 'w') as f:
+            f.write('x' * i)
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local')
+    counts = {'read': 0, 'synced': 0, 'ahead': 0}
+    values = JobTable.values
+
+    def count_values(self, largest_first=False):
+        for job in values(self, largest_first=largest_first):
+            counts['read'] += 1
+            yield job
+
+    def count_sync_file(*args, **kwargs):
+        counts['ahead'] = max(counts['ahead'], counts['read'] - counts['synced'])
+        counts['synced'] += 1
+        return sync_file(*args, **kwargs)
+
+    # Only the units in flight are read from the job table
+    with mock.patch('intorods.filesys.sync.JOB_QUEUE_SIZE', 2), \
+            mock.patch.object(JobTable, 'values', count_values), \
+            mock.patch('intorods.filesys.sync.sync_file', side_effect=count_sync_file):
+        result = sync(fs_source, source,
+                fs_dest, dest,
+                'local', {},
+                'local', {},
+                scan=True, worker_processes=1, engine='threads')
+    assert result == True
+    assert counts['synced'] == 20
+    assert counts['read'] == 20
+    assert counts['ahead'] <= 3
+    assert sorted(os.listdir(dest)) == sorted(os.listdir(source))
+
+def test_sync_state(tmp_path):
+    source = os.path.join(str(tmp_path), 'source')
+    dest = os.path.join(str(tmp_path), 'dest')
+    shutil.copytree(inputpath, source)
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local')
+    state = SyncState(os.path.join(str(tmp_path), 'state.db'))
+
+    def run():
+        return sync(fs_source, source, fs_dest, dest, 'local', {}, 'local', {},
+                    scan=True, worker_processes=2, engine='threads', state=state)
+    assert run() == True
+    # The destination is not listed when all files were verified before
+    listed = []
+    fs_dest.lsindex = lambda path: listed.append(path)
+    assert run() == True
+    assert listed == []
+    with open(os.path.join(source, 'file1'), 'a') as f:
+        f.write('changed')
+    assert run() == True
+    assert len(listed) == 1
+    assert filecmp.cmp(os.path.join(source, 'file1'), os.path.join(dest, 'file1'), shallow=False) == True
+    state.close()
+
+def test_sync_state_verification(tmp_path):
+    """
+    Test files verified less strictly than a run requires are compared again
+    """
+    dest = os.path.join(str(tmp_path), 'dest')
+    fs_source = factory.createfs('local')
+    fs_dest = factory.createfs('local')
+    state = SyncState(os.path.join(str(tmp_path), 'state.db'))
+    listed = []
+    lsindex = fs_dest.lsindex
+    fs_dest.lsindex = lambda path: listed.append(path) or lsindex(path)
+
+    def run(**options):
+        del listed[:]
+        assert sync(fs_source, inputpath, fs_dest, dest, 'local', {}, 'local', {},
+                    scan=True, worker_processes=1, engine='threads', state=state, **options) == True
+        return len(listed)
+    assert run(compare=False) == 1
+    assert run(compare=False) == 0
+    assert run() == 1
+    assert run() == 0
+    assert run(compareChecksums=True) == 1
+    assert run(compareChecksums=True) == 0
+    assert run() == 0
+    state.close()
+
+def test_excludes_tree():
+    assert excludes_tree(re.compile('.*work/', re.IGNORECASE), 'run/Work') == True
+    assert excludes_tree(re.compile('run/w', re.IGNORECASE), 'run/work') == True
+    assert excludes_tree(re.compile('.*work/$', re.IGNORECASE), 'run/work') == False
+    assert excludes_tree(re.compile('.*\\.txt', re.IGNORECASE), 'run/work') == False
+
+def test_prune_excluded_dirs(tmp_path):
+    for relpath in ['keep/file1', 'skip/file2', 'work/sub/file3', 'filtered/file4']:
+        os.makedirs(os.path.dirname(os.path.join(str(tmp_path), relpath)), exist_ok=True)
+        with open(os.path.join(str(tmp_path), relpath), 'w') as f:
+            f.write('data')
+    fs = factory.createfs('local')
+    listed = []
+    scandir = fs.scandir
+    fs.scandir = lambda path: listed.append(os.path.relpath(path, str(tmp_path))) or scandir(path)
+    jobs = list(iter_copyjobs(fs, str(tmp_path), fs, os.path.join(str(tmp_path), 'dest'),
+                              excludelist=['skip/', 'work'], filter=PathFilter(['+ /', '- filtered/'])))
+    assert [job.source for job in jobs] == [os.path.join(str(tmp_path), 'keep', 'file1')]
+    # Excluded directories are not listed at all
+    assert sorted(listed) == ['.', 'keep']
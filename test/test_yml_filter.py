@@ -1,6 +1,8 @@
+import itertools
+import random
 import unittest
 
-from intorods.filesys.yml_filter import PathFilter
+from intorods.filesys.yml_filter import CompiledPathFilter, PathFilter
 
 
 class TestYmlFilter(unittest.TestCase):
@@ -119,6 +121,23 @@ class TestYmlFilter(unittest.TestCase):
         f = pf.isFileIncluded( "A/A2/A3/file.in")
         self.assertEqual( f, True, "")
         
+    def test_tree_excluded(self):
+        filter = [ "+ /",
+                   "- A/",
+                   "+ A/A2/A3/ .*\\.in",
+                   "- B/",
+                   "+ B/B2/",
+                   "- C/"
+                 ]
+        pf = PathFilter( filter )
+        self.assertEqual( pf.isTreeExcluded( "A" ), False, "")
+        self.assertEqual( pf.isTreeExcluded( "A/A2/A3" ), False, "")
+        self.assertEqual( pf.isTreeExcluded( "A/A1" ), True, "")
+        self.assertEqual( pf.isTreeExcluded( "B" ), False, "")
+        self.assertEqual( pf.isTreeExcluded( "B/B1" ), True, "")
+        self.assertEqual( pf.isTreeExcluded( "C" ), True, "")
+        self.assertEqual( pf.isTreeExcluded( "D" ), False, "")
+
     def test_root_files(self):
         filter = [] # TODO fill in the correct filter for this test
         pf = PathFilter( filter )
@@ -160,5 +179,62 @@ class TestYmlFilter(unittest.TestCase):
         f = pf.isFileIncluded( "Data/Intensities/BaseCalls/12_S12_L001_R1_001.fastq.gz")
         self.assertEqual( f, True, "")
 
+DIRS = [ "A", "A2", "A3", "B", "B2", "BV", "Data" ]
+FILES = [ "file.txt", "file.in", "file.ex", "11_S11.fastq.gz" ]
+REGEXES = [ ".*\\.in", ".*\\.ex", "file.*", "(1|f).*", ".*", "[0-9]+_S.*" ]
+
+def all_dirs():
+    for n in range( 4 ):
+        for parts in itertools.product( DIRS[:5], repeat=n ):
+            for root in [ "", "/", "//" ]:
+                if parts or root:
+                    yield root + "/".join( parts )
+
+class TestCompiledPathFilter(unittest.TestCase):
+    """The compiled filter gives the same results as PathFilter"""
+
+    def assertEquivalent(self, filter):
+        pf = PathFilter( filter )
+        cpf = CompiledPathFilter( filter )
+        for d in all_dirs():
+            self.assertEqual( cpf.isDirIncluded( d ), pf.isDirIncluded( d ), (filter, d))
+            self.assertEqual( cpf.isTreeExcluded( d ), pf.isTreeExcluded( d ), (filter, d))
+            for f in FILES:
+                path = d.rstrip( "/" ) + "/" + f if d.strip( "/" ) else f
+                self.assertEqual( cpf.isFileIncluded( path ), pf.isFileIncluded( path ), (filter, path))
+
+    def test_filters(self):
+        for filter in [ [],
+                        [ "- /" ],
+                        [ "+ /", "- path/to/"],
+                        [ "- /", "+ A/A2/A3/ .*\\.in", "- A/A2/A3/ .*\\.ex", "+ B/", "- B/B2/"],
+                        [ "+ /", "- A/A2/A3/ .*\\.in", "+ A/A2/A3/ .*\\.ex", "- B/", "+ B/B2/"],
+                        [ "- /", "- A/A2/A3/", "+ A/A2/A3/ .*\\.in" ],
+                        [ "- /", "+ /A/" ],
+                        [ "+ A/", "- A/", "- //A/", "+ //" ] ]:
+            self.assertEquivalent( filter )
+
+    def test_random_filters(self):
+        rnd = random.Random( 42 )
+        for _ in range( 100 ):
+            filter = []
+            for _ in range( rnd.randint( 1, 8 ) ):
+                path = rnd.choice( [ "", "/", "//" ] ) + "/".join( rnd.choice( DIRS ) for _ in range( rnd.randint( 0, 3 ) ) )
+                path = path.rstrip( "/" ) + "/"
+                rule = rnd.choice( "+-" ) + " " + path
+                if rnd.random() < 0.4:
+                    rule += " " + rnd.choice( REGEXES )
+                filter.append( rule )
+            self.assertEquivalent( filter )
+
+    def test_warnings_logged(self):
+        cpf = CompiledPathFilter( [ "+ A/ .*\\.in", "- A/ a.*" ] )
+        with self.assertLogs( "intorods.filesys.yml_filter", level="WARNING" ) as logs:
+            self.assertFalse( cpf.isFileIncluded( "A/" ) )
+            self.assertFalse( cpf.isFileIncluded( "A/a.in" ) )
+        self.assertEqual( logs.output, [
+            "WARNING:intorods.filesys.yml_filter:path 'A/' doesn't contain a filename",
+            "WARNING:intorods.filesys.yml_filter:multiple matches for path: 'A/a.in'" ] )
+
 if __name__ == '__main__':
     unittest.main()